@@ -28,5 +28,6 @@ print conn.ping()
 """
 
 from .connection import *
+from .aioconnection import AsyncConnection
 
 __version__ = '1.1.2'
@@ -0,0 +1,1074 @@
+"""
+This file is part of py-sonic.
+
+py-sonic is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+py-sonic is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with py-sonic.  If not, see <http://www.gnu.org/licenses/>
+
+An asyncio version of libsonic.connection.Connection.
+
+Every API method of Connection is available on AsyncConnection with the
+same name and arguments, as a coroutine.  The requests are done on a
+small non-blocking HTTP/1.1 keep-alive client built on asyncio streams,
+so thousands of concurrent calls can run on a single event loop:
+
+    conn = AsyncConnection('https://music.example.com', 'user', 'pass',
+        port=443)
+    albums = await asyncio.gather(*[conn.getAlbum(i) for i in albumIds])
+
+Binary endpoints (stream, download, getCoverArt, ...) return an
+AsyncResponse, which is an async iterator of byte chunks:
+
+    async with await conn.download(songId) as res:
+        async for chunk in res:
+            fh.write(chunk)
+
+A response holds one of the pool's maxConnections slots until its body
+is fully read or it is closed, so responses which may not be read to the
+end must be closed, with "async with" or close().
+
+map(), the paging helpers (iterAlbumList2(), iterSearch3(), etc.) and
+the streamed *Iter() methods are async generators:
+
+    async for album in conn.iterAlbumList2('newest'):
+        print(album['name'])
+    async for kind, item in conn.getIndexesIter():
+        ...
+
+downloadTo(), streamTo() and downloadSegmented() are coroutines too, the
+files being written from worker threads.  download() and stream() don't
+take seekable=True, they raise an ArgumentError.
+"""
+
+from libsonic.connection import API_VERSION, Connection, _PositionalWriter
+from libsonic.decoders import normalizeTimestamps
+from libsonic.errors import ArgumentError, SonicError
+from libsonic.jsonstream import iterResponse
+from libsonic.overload import currentLane
+from libsonic.paging import MAX_LIST_OFFSET, MAX_PAGE_SIZE, aiterPages, \
+    asList
+from libsonic.retry import isTransient
+from libsonic.tracing import tracePhase
+from collections import deque
+from email.parser import Parser
+from http import client as http_client
+from urllib.parse import urljoin, urlsplit
+import urllib.error
+import urllib.request
+
+import asyncio
+import contextvars
+import functools
+import inspect
+import io
+import itertools
+import logging
+import os
+import ssl
+import time
+
+logger = logging.getLogger(__name__)
+
+# The number of bytes yielded per iteration of an AsyncResponse
+CHUNK_SIZE = 64 * 1024
+MAX_REDIRECTS = 10
+REDIRECT_CODES = (301, 302, 303, 307, 308)
+
+# Holds the _AsyncCall for the API call being run in the current task
+_currentCall = contextvars.ContextVar('libsonic_async_call', default=None)
+
+
+class _Captured(BaseException):
+    """
+    Raised by the request methods of AsyncConnection to stop the
+    synchronous method body once its request has been built.  This isn't
+    an Exception so the "except Exception" clauses of the method bodies
+    don't swallow it
+    """
+    pass
+
+
+class _AsyncCall(object):
+    """
+    The state for one AsyncConnection API call.  The synchronous method
+    body is run twice: once to capture the request it builds, and once
+    more to replay the (asynchronously fetched) result through the
+    method's own status checks and post-processing.  The replay reuses
+    the captured request, so each call builds a single request and uses
+    a single auth token
+    """
+    def __init__(self):
+        self.kind = None
+        self.req = None
+        self.replaying = False
+        self.result = None
+        self.error = None
+
+
+class _AsyncHTTPConn(object):
+    def __init__(self, key, reader, writer):
+        self.key = key
+        self.reader = reader
+        self.writer = writer
+        self.released = None
+
+    def isHealthy(self, idleTimeout):
+        if self.writer.is_closing() or self.reader.at_eof():
+            return False
+        if idleTimeout is not None and \
+                time.monotonic() - self.released > idleTimeout:
+            return False
+        return True
+
+    def close(self):
+        self.writer.close()
+
+
+class AsyncConnectionPool(object):
+    def __init__(self, maxSize=10, idleTimeout=60.0, maxConnections=100):
+        """
+        A pool of keep-alive asyncio stream connections
+
+        maxSize:int         The max number of idle connections kept per
+                            scheme/host/port
+        idleTimeout:float   Idle connections older than this number of
+                            seconds are closed instead of being reused
+        maxConnections:int  The max number of connections open to a
+                            single scheme/host/port at once.  Requests
+                            past this wait for a connection to free up
+        """
+        self.maxSize = int(maxSize)
+        self.idleTimeout = idleTimeout
+        self.maxConnections = int(maxConnections)
+        self._idle = {}
+        self._limits = {}
+
+    async def getConnection(self, key, sslContext=None, fresh=False):
+        """
+        Returns a (conn, reused) tuple for the given (scheme, host, port)
+        key.  This waits if maxConnections are already checked out
+        """
+        limit = self._limits.get(key)
+        if limit is None:
+            limit = self._limits[key] = asyncio.Semaphore(
+                self.maxConnections)
+        await limit.acquire()
+        try:
+            conns = self._idle.get(key)
+            while conns and not fresh:
+                conn = conns.pop()
+                if conn.isHealthy(self.idleTimeout):
+                    return conn, True
+                conn.close()
+            scheme, host, port = key
+            if scheme == 'https':
+                reader, writer = await asyncio.open_connection(host, port,
+                    ssl=sslContext, server_hostname=host)
+            else:
+                reader, writer = await asyncio.open_connection(host, port)
+            return _AsyncHTTPConn(key, reader, writer), False
+        except:
+            limit.release()
+            raise
+
+    def releaseConnection(self, conn, reusable=True):
+        """
+        Returns a connection to the pool, closing it if it isn't
+        reusable or the pool is full
+        """
+        self._limits[conn.key].release()
+        conns = self._idle.setdefault(conn.key, [])
+        if reusable and len(conns) < self.maxSize:
+            conn.released = time.monotonic()
+            conns.append(conn)
+        else:
+            conn.close()
+
+    def clear(self):
+        """
+        Closes all the idle connections in the pool
+        """
+        idle, self._idle = self._idle, {}
+        for conns in idle.values():
+            for conn in conns:
+                conn.close()
+
+
+class AsyncResponse(object):
+    """
+    A non-blocking HTTP response.  The body can be read with
+    "await res.read()" or iterated over in chunks with "async for".
+    The response must be read to the end or closed, else its connection
+    is only given back once the response is garbage collected
+    """
+    def __init__(self, conn, pool, method, url, status, reason, headers,
+            version):
+        self._conn = conn
+        self._pool = pool
+        self.url = url
+        self.status = self.code = status
+        self.reason = self.msg = reason
+        self.headers = headers
+        self._chunked = 'chunked' in headers.get('Transfer-Encoding',
+            '').lower()
+        self._chunkLeft = 0
+        self._length = None
+        connHdr = headers.get('Connection', '').lower()
+        if version == 10:
+            self._willClose = 'keep-alive' not in connHdr
+        else:
+            self._willClose = 'close' in connHdr
+        if method == 'HEAD' or status in (204, 304) or 100 <= status < 200:
+            self._length = 0
+        elif not self._chunked:
+            length = headers.get('Content-Length')
+            if length is not None:
+                self._length = int(length)
+            else:
+                self._willClose = True
+        if self._length == 0:
+            self._release()
+
+    def info(self):
+        return self.headers
+
+    def getheader(self, name, default=None):
+        return self.headers.get(name, default)
+
+    def getcode(self):
+        return self.status
+
+    @property
+    def closed(self):
+        return self._conn is None
+
+    async def read(self, amt=None):
+        """
+        Returns up to amt bytes of the body, or the rest of the body if
+        amt is None
+        """
+        if amt is None:
+            buf = []
+            while True:
+                data = await self._readSome(CHUNK_SIZE)
+                if not data:
+                    return b''.join(buf)
+                buf.append(data)
+        return await self._readSome(amt)
+
+    def close(self):
+        """
+        Closes the response.  If the body hasn't been fully read, the
+        underlying connection is closed too, since it can't be reused
+        """
+        if self._conn is not None:
+            self._release(False)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        data = await self._readSome(CHUNK_SIZE)
+        if not data:
+            raise StopAsyncIteration
+        return data
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        self.close()
+
+    def __del__(self):
+        # A response dropped unread would hold its pool slot forever
+        if getattr(self, '_conn', None) is not None:
+            try:
+                self._release(False)
+            except RuntimeError:
+                # The event loop is already closed
+                pass
+
+    async def _readSome(self, amt):
+        if self._conn is None:
+            return b''
+        reader = self._conn.reader
+        try:
+            if self._chunked:
+                if self._chunkLeft == 0:
+                    line = await reader.readline()
+                    size = int(line.split(b';', 1)[0].strip(), 16)
+                    if size == 0:
+                        # Skip the trailers
+                        while (await reader.readline()) not in (b'\r\n',
+                                b'\n', b''):
+                            pass
+                        self._release()
+                        return b''
+                    self._chunkLeft = size
+                data = await reader.read(min(amt, self._chunkLeft))
+                if not data:
+                    raise http_client.IncompleteRead(b'')
+                self._chunkLeft -= len(data)
+                if self._chunkLeft == 0:
+                    await reader.readexactly(2)
+                return data
+            if self._length is None:
+                data = await reader.read(amt)
+                if not data:
+                    self._release(False)
+                return data
+            data = await reader.read(min(amt, self._length))
+            if not data:
+                raise http_client.IncompleteRead(b'', self._length)
+            self._length -= len(data)
+            if self._length == 0:
+                self._release()
+            return data
+        except:
+            self._release(False)
+            raise
+
+    def _release(self, reusable=True):
+        conn, self._conn = self._conn, None
+        if conn is not None:
+            self._pool.releaseConnection(conn,
+                reusable and not self._willClose)
+
+
+class _BlockingReader(object):
+    """
+    A blocking file-like view of an AsyncResponse, for a parser running
+    in a worker thread while the event loop does the reading
+    """
+    def __init__(self, res, loop):
+        self._res = res
+        self._loop = loop
+
+    def read(self, amt=None):
+        return asyncio.run_coroutine_threadsafe(self._res.read(amt),
+            self._loop).result()
+
+
+def _fsync(fh):
+    fh.flush()
+    os.fsync(fh.fileno())
+
+
+def _nextBatch(items, size=256):
+    """
+    Returns the next items of an iterator as a list, empty once it is
+    exhausted.  This is run in a worker thread
+    """
+    return list(itertools.islice(items, size))
+
+
+class AsyncConnection(Connection):
+    def __init__(self, baseUrl, username=None, password=None, port=4040,
+            serverPath='/rest', appName='py-sonic', apiVersion=API_VERSION,
+            insecure=False, useNetrc=None, legacyAuth=False, useGET=False,
+            salt=None, token=None, userAgent=None, customHeaders=None,
+            poolSize=10, poolIdleTimeout=60.0, maxConnections=100,
+            tokenBatchSize=64, tokenReuseWindow=0, jsonDecoder=None,
+            retryPolicy=True, circuitBreaker=None, rateLimit=None,
+            metrics=True, tracing=None):
+        """
+        This takes the same arguments as Connection, see
+        Connection.__init__() for the details, except for keepAlive,
+        cache, coalesce and concurrencyLimiter: the requests always go
+        through the connection pool below, aren't cached or coalesced,
+        and their concurrency is bounded by maxConnections rather than by
+        the adaptive limiter.  The arguments are:
+
+        poolSize:int            The max number of idle keep-alive
+                                connections kept open
+        poolIdleTimeout:float   The number of seconds an idle connection
+                                is kept open
+        maxConnections:int      The max number of simultaneous
+                                connections to the server.  Concurrent
+                                calls past this are queued until a
+                                connection frees up
+        tokenBatchSize:int      See Connection.__init__()
+        tokenReuseWindow:float  See Connection.__init__()
+        jsonDecoder:str         See Connection.__init__()
+        retryPolicy:RetryPolicy See Connection.__init__(), the retry
+                                delays are awaited with asyncio.sleep()
+        circuitBreaker:dict     See Connection.__init__()
+        rateLimit:float         The max number of requests per second,
+                                see Connection.__init__()
+        metrics:Metrics         Where the per view metrics are kept, see
+                                Connection.__init__()
+        tracing:callable        The sink of the call spans, see
+                                Connection.__init__().  The socket
+                                phases aren't broken down, the time to
+                                the response headers is a single ttfb
+                                phase
+        """
+        super().__init__(baseUrl, username, password, port=port,
+            serverPath=serverPath, appName=appName, apiVersion=apiVersion,
+            insecure=insecure, useNetrc=useNetrc, legacyAuth=legacyAuth,
+            useGET=useGET, salt=salt, token=token, userAgent=userAgent,
+            customHeaders=customHeaders, keepAlive=False,
+            tokenBatchSize=tokenBatchSize, tokenReuseWindow=tokenReuseWindow,
+            jsonDecoder=jsonDecoder, coalesce=False, retryPolicy=retryPolicy,
+            circuitBreaker=circuitBreaker, concurrencyLimiter=None,
+            rateLimit=rateLimit, metrics=metrics, tracing=tracing)
+        self._sslContexts = {}
+        self._aioPool = AsyncConnectionPool(poolSize, poolIdleTimeout,
+            maxConnections)
+
+    async def close(self):
+        """
+        Closes all idle connections
+        """
+        self._aioPool.clear()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def map(self, method, argsList, maxWorkers=8):
+        """
+        Like Connection.map(), as an async generator: runs up to
+        maxWorkers calls at once and yields the results in the same
+        order as argsList
+
+        ex:
+            async for res in conn.map('getAlbum', albumIds):
+                print(res['album']['name'])
+        """
+        if isinstance(method, str):
+            method = getattr(self, method)
+        maxWorkers = int(maxWorkers)
+        if maxWorkers < 1:
+            raise ArgumentError('maxWorkers must be at least 1: %r' %
+                maxWorkers)
+
+        def submit(args):
+            if isinstance(args, dict):
+                return asyncio.ensure_future(method(**args))
+            if isinstance(args, tuple):
+                return asyncio.ensure_future(method(*args))
+            return asyncio.ensure_future(method(args))
+
+        pending = deque()
+        try:
+            argsIter = iter(argsList)
+            for args in argsIter:
+                pending.append(submit(args))
+                if len(pending) >= maxWorkers:
+                    break
+            while pending:
+                res = await pending.popleft()
+                for args in argsIter:
+                    pending.append(submit(args))
+                    break
+                yield res
+        finally:
+            for fut in pending:
+                fut.cancel()
+
+    def iterSearch3(self, query, kind='song', pageSize=500, prefetch=2,
+            musicFolderId=None):
+        """
+        Like Connection.iterSearch3(), as an async generator
+        """
+        if kind not in ('song', 'album', 'artist'):
+            raise ArgumentError('kind must be one of "song", "album" or '
+                '"artist": %r' % kind)
+
+        async def fetchPage(offset, size):
+            counts = {'artistCount': 0, 'albumCount': 0, 'songCount': 0}
+            counts['%sCount' % kind] = size
+            counts['%sOffset' % kind] = offset
+            res = await self.search3(query, musicFolderId=musicFolderId,
+                **counts)
+            return asList(res.get('searchResult3', {}).get(kind))
+
+        return aiterPages(fetchPage, pageSize, prefetch)
+
+    def iterAlbumList(self, ltype, pageSize=500, prefetch=2, fromYear=None,
+            toYear=None, genre=None, musicFolderId=None):
+        """
+        Like Connection.iterAlbumList(), as an async generator
+        """
+        async def fetchPage(offset, size):
+            res = await self.getAlbumList(ltype, size, offset, fromYear,
+                toYear, genre, musicFolderId)
+            return asList(res.get('albumList', {}).get('album'))
+
+        return aiterPages(fetchPage, min(int(pageSize), MAX_PAGE_SIZE),
+            prefetch, maxOffset=MAX_LIST_OFFSET)
+
+    def iterAlbumList2(self, ltype, pageSize=500, prefetch=2, fromYear=None,
+            toYear=None, genre=None, musicFolderId=None):
+        """
+        Like Connection.iterAlbumList2(), as an async generator
+        """
+        async def fetchPage(offset, size):
+            res = await self.getAlbumList2(ltype, size, offset, fromYear,
+                toYear, genre, musicFolderId)
+            return asList(res.get('albumList2', {}).get('album'))
+
+        return aiterPages(fetchPage, min(int(pageSize), MAX_PAGE_SIZE),
+            prefetch, maxOffset=MAX_LIST_OFFSET)
+
+    def iterSongsByGenre(self, genre, pageSize=500, prefetch=2,
+            musicFolderId=None):
+        """
+        Like Connection.iterSongsByGenre(), as an async generator
+        """
+        async def fetchPage(offset, size):
+            res = await self.getSongsByGenre(genre, size, offset,
+                musicFolderId)
+            return asList(res.get('songsByGenre', {}).get('song'))
+
+        return aiterPages(fetchPage, min(int(pageSize), MAX_PAGE_SIZE),
+            prefetch)
+
+    async def downloadSegmented(self, sid, path, segments=4,
+            minSegmentSize=4 * 1024 * 1024, chunkSize=1024 * 1024,
+            retries=2, fsync=False, progress=None):
+        """
+        The async version of Connection.downloadSegmented(), which takes
+        the same arguments.  The ranges are fetched concurrently on the
+        event loop and written from worker threads
+        """
+        methodName = 'download'
+        viewName = '%s.view' % methodName
+        q = {'id': sid}
+
+        start = time.monotonic()
+        # The first request tells the size, its response is used for the
+        # first range
+        res, contRange = await self._openRangeAsync(viewName, q, 0)
+        if contRange is None or contRange[2] is None:
+            res.close()
+            stats = await self._transferTo(viewName, q, path, chunkSize,
+                False, fsync, progress)
+            stats['segments'] = 1
+            return stats
+
+        size = contRange[2]
+        count = max(1, min(int(segments), size // max(minSegmentSize, 1)))
+        segSize = -(-size // count)
+        ranges = [(s, min(s + segSize, size) - 1)
+            for s in range(0, size, segSize)]
+
+        done = [0]
+
+        def onChunk(nbytes):
+            done[0] += nbytes
+            if progress is not None:
+                progress(done[0], size)
+
+        loop = asyncio.get_running_loop()
+        # See Connection.downloadSegmented()
+        partPath = path + '.part'
+        fd = os.open(partPath, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o666)
+        try:
+            try:
+                self._preallocate(fd, size)
+                with _PositionalWriter(fd, size) as writer:
+                    tasks = [asyncio.ensure_future(self._fetchSegmentAsync(
+                            viewName, q, rng, writer, chunkSize, retries,
+                            onChunk, res if i == 0 else None))
+                        for i, rng in enumerate(ranges)]
+                    try:
+                        await asyncio.gather(*tasks)
+                    finally:
+                        for task in tasks:
+                            task.cancel()
+                        await asyncio.gather(*tasks, return_exceptions=True)
+                if os.fstat(fd).st_size != size or done[0] != size:
+                    raise http_client.IncompleteRead(b'', size - done[0])
+                if fsync:
+                    await loop.run_in_executor(None, os.fsync, fd)
+            finally:
+                os.close(fd)
+        except BaseException:
+            os.remove(partPath)
+            raise
+        os.replace(partPath, path)
+
+        stats = self._transferStats(done[0], size, 0, start)
+        stats['segments'] = len(ranges)
+        return stats
+
+    #
+    # Private internal methods
+    #
+    async def _callAsync(self, method, args, kwargs):
+        """
+        Runs the synchronous API method with its request done on the
+        async transport
+        """
+        call = _AsyncCall()
+        ret = None
+        token = _currentCall.set(call)
+        try:
+            try:
+                ret = method(self, *args, **kwargs)
+            except _Captured:
+                pass
+            if call.req is None:
+                # This method didn't make a request
+                return ret
+
+            try:
+                call.result = await self._perform(call.kind, call.req)
+            except Exception as e:
+                call.error = e
+
+            call.replaying = True
+            ret = method(self, *args, **kwargs)
+        finally:
+            _currentCall.reset(token)
+            # The sockets opened during the call keep a copy of the
+            # context, and with it the call: drop the result so an
+            # unread response can still be garbage collected
+            call.req = call.result = call.error = None
+        if inspect.isawaitable(ret):
+            ret = await ret
+        return ret
+
+    def _captureOrReplay(self, kind, req):
+        call = _currentCall.get()
+        if call is None:
+            raise RuntimeError('AsyncConnection requests must be made '
+                'through its coroutine API methods')
+        if not call.replaying:
+            call.kind = kind
+            call.req = req
+            raise _Captured()
+        if call.error is not None:
+            raise call.error
+        return call.result
+
+    def _buildRequest(self, viewName, query, listMap=None):
+        # The replay of a call gets the request built by its capture pass
+        # back instead of building (and authenticating) another one
+        call = _currentCall.get()
+        if call is not None and call.replaying and call.req is not None:
+            return call.req
+        return Connection._buildRequest(self, viewName, query, listMap)
+
+    def _doInfoReq(self, req):
+        return self._captureOrReplay('info', req)
+
+    def _doBinReq(self, req):
+        return self._captureOrReplay('bin', req)
+
+    def _openSeekable(self, viewName, query):
+        # Raised before any request is made
+        raise ArgumentError('seekable=True is not supported by '
+            'AsyncConnection, read the response with Range headers instead')
+
+    def _unsupportedAPIFunction(self, methodName):
+        baseMethod = 'musicFolderSettings'
+        viewName = '%s.view' % baseMethod
+
+        url = '%s:%d/%s/%s?%s' % (self._baseUrl, self._port,
+            self._separateServerPath(), viewName, methodName)
+        req = urllib.request.Request(url, headers=self._customHeaders)
+        return self._captureOrReplay('raw', req)
+
+    async def _perform(self, kind, req):
+        rec = self._startRecord(req)
+        try:
+            return await self._withRetriesAsync(req,
+                lambda: self._performOnce(kind, req))
+        except Exception as e:
+            self._markError(rec, e)
+            raise
+        finally:
+            self._finishRecord(rec, req)
+
+    async def _withRetriesAsync(self, req, func):
+        """
+        Returns await func(), retried according to the retry policy
+        """
+        policy = self._retryPolicy
+        viewName = getattr(req, 'viewName', None)
+        if policy is None or not policy.appliesTo(viewName):
+            return await func()
+        return await policy.callAsync(func, viewName)
+
+    async def _iterResponse(self, viewName, query, targets):
+        """
+        The async version of Connection._iterResponse(), which makes the
+        *Iter() methods async generators:
+
+            async for kind, item in conn.getIndexesIter():
+                ...
+
+        The response is parsed by a StreamParser in a worker thread,
+        reading the body from the event loop, and the items are handed
+        back in batches
+        """
+        req = self._getRequest(viewName, query)
+        rec = self._startRecord(req)
+        res = None
+        try:
+            res = await self._withRetriesAsync(req,
+                lambda: self._openStreamAsync(req))
+            loop = asyncio.get_running_loop()
+            items = iterResponse(_BlockingReader(res, loop), targets,
+                self._checkStatus)
+            while True:
+                batch = await loop.run_in_executor(None, _nextBatch,
+                    items)
+                if not batch:
+                    # Read the end of the body (ex: the last chunk) so
+                    # the connection can be reused
+                    await res.read()
+                    return
+                for key, item in batch:
+                    yield key, normalizeTimestamps(item)
+        except Exception as e:
+            self._markError(rec, e)
+            raise
+        finally:
+            if res is not None:
+                res.close()
+            self._finishRecord(rec, req)
+
+    async def _transferTo(self, viewName, query, path, chunkSize, resume,
+            fsync, progress):
+        """
+        The async version of Connection._transferTo(), which makes
+        downloadTo() and streamTo() coroutines.  The file is written from
+        a worker thread so the event loop isn't blocked on the disk
+        """
+        offset = 0
+        if resume and os.path.exists(path):
+            offset = os.path.getsize(path)
+
+        start = time.monotonic()
+        req = self._getRequest(viewName, query)
+        if offset:
+            req.add_header('Range', 'bytes=%d-' % offset)
+        try:
+            res = await self._perform('bin', req)
+        except urllib.error.HTTPError as e:
+            if e.code != 416 or not offset:
+                raise
+            # Range not satisfiable, we already have the whole file
+            e.close()
+            return self._transferStats(0, offset, offset, start)
+        if isinstance(res, dict):
+            self._checkStatus(res)
+
+        size = None
+        contRange = res.headers.get('Content-Range')
+        if offset and res.status == 206 and contRange:
+            size = self._parseContentRange(contRange)[2]
+        else:
+            # The server ignored the range, start over
+            offset = 0
+            if res.headers.get('Content-Length'):
+                size = int(res.headers.get('Content-Length'))
+
+        loop = asyncio.get_running_loop()
+        written = 0
+        async with res:
+            fh = open(path, 'ab' if offset else 'wb')
+            try:
+                while True:
+                    data = await res.read(chunkSize)
+                    if not data:
+                        break
+                    await loop.run_in_executor(None, fh.write, data)
+                    written += len(data)
+                    if progress is not None:
+                        progress(offset + written, size)
+                if size is not None and offset + written < size:
+                    # The connection dropped, what we got is kept for the
+                    # next attempt to resume from
+                    raise http_client.IncompleteRead(b'',
+                        size - offset - written)
+                if fsync:
+                    await loop.run_in_executor(None, _fsync, fh)
+            finally:
+                fh.close()
+
+        return self._transferStats(written, offset + written, offset, start)
+
+    async def _openRangeAsync(self, viewName, query, first, last=None):
+        """
+        The async version of Connection._openRange()
+        """
+        req = self._getRequest(viewName, query)
+        req.add_header('Range', 'bytes=%d-%s' % (first,
+            '' if last is None else last))
+        res = await self._perform('bin', req)
+        if isinstance(res, dict):
+            self._checkStatus(res)
+        contRange = res.headers.get('Content-Range')
+        if res.status != 206 or not contRange:
+            return res, None
+        contRange = self._parseContentRange(contRange)
+        if contRange[0] != first:
+            res.close()
+            raise SonicError('Requested the range starting at %d, got %r' %
+                (first, contRange))
+        return res, contRange
+
+    async def _fetchSegmentAsync(self, viewName, query, rng, writer,
+            chunkSize, retries, onChunk, res=None):
+        """
+        The async version of Connection._fetchSegment()
+        """
+        loop = asyncio.get_running_loop()
+        pos, last = rng
+        attempt = 0
+        while pos <= last:
+            try:
+                if res is None:
+                    res, contRange = await self._openRangeAsync(viewName,
+                        query, pos, last)
+                    if contRange is None:
+                        res.close()
+                        raise SonicError('The server stopped honoring '
+                            'Range requests')
+                async with res:
+                    while pos <= last:
+                        data = await res.read(min(chunkSize,
+                            last + 1 - pos))
+                        if not data:
+                            raise http_client.IncompleteRead(b'',
+                                last + 1 - pos)
+                        await loop.run_in_executor(None, writer.write, data,
+                            pos)
+                        pos += len(data)
+                        onChunk(len(data))
+            except (OSError, http_client.HTTPException) as e:
+                if attempt >= retries:
+                    raise
+                attempt += 1
+                logger.debug('Retrying the range %d-%d: %s', pos, last, e)
+            finally:
+                res = None
+
+    async def _openStreamAsync(self, req):
+        res = await self._guardedOpen(req)
+        self._markResponse(req, res)
+        rec = getattr(req, 'record', None)
+        if rec is not None:
+            rec.bytesIn = int(res.headers.get('Content-Length') or 0)
+        return res
+
+    async def _performOnce(self, kind, req):
+        res = await self._guardedOpen(req)
+        self._markResponse(req, res)
+        if kind == 'raw':
+            res.close()
+            return res.reason.lower() == 'ok'
+        if kind == 'info':
+            return self._decodeBody(await self._readBody(req, res), req)
+
+        contType = res.headers.get('Content-Type')
+        if contType:
+            if contType.startswith('text/html') or \
+                    contType.startswith('application/json'):
+                return self._decodeBody(await self._readBody(req, res),
+                    req)
+        rec = getattr(req, 'record', None)
+        if rec is not None:
+            rec.bytesIn = int(res.headers.get('Content-Length') or 0)
+        return res
+
+    async def _readBody(self, req, res):
+        with tracePhase(getattr(req, 'span', None), 'body'):
+            return await res.read()
+
+    def _decodeBody(self, body, req):
+        dres = self._decodeResponse(body, req)
+        rec = getattr(req, 'record', None)
+        if rec is not None:
+            rec.bytesIn = len(body)
+            rec.error = self._getErrorName(dres)
+        return dres
+
+    async def _guardedOpen(self, req):
+        """
+        Opens the request through the circuit breaker of its endpoint
+        group and the rate limiter.  The concurrency of an
+        AsyncConnection is bounded by its pool's maxConnections rather
+        than by the adaptive limiter
+        """
+        viewName = getattr(req, 'viewName', None)
+        span = getattr(req, 'span', None)
+        if self._rateLimiter is not None:
+            with tracePhase(span, 'queue'):
+                await self._rateLimiter.acquireAsync(currentLane.get())
+        # The breaker is asked right before sending, so a half open
+        # breaker's trial slot isn't lost if the wait is cancelled
+        breaker = self._getBreaker(viewName) if viewName else None
+        if breaker is not None:
+            breaker.allow()
+        if breaker is None:
+            with tracePhase(span, 'ttfb'):
+                return await self._open(req)
+        start = time.monotonic()
+        failed = False
+        try:
+            with tracePhase(span, 'ttfb'):
+                return await self._open(req)
+        except Exception as e:
+            failed = isTransient(e)
+            raise
+        finally:
+            breaker.record(failed, time.monotonic() - start)
+
+    async def _open(self, req):
+        """
+        Does the request and returns an AsyncResponse.  Redirects are
+        followed and an urllib.error.HTTPError is raised for error
+        responses, like the urllib opener used by Connection
+        """
+        method = req.get_method()
+        url = req.full_url
+        data = req.data
+        headers = dict(req.header_items())
+        for i in range(MAX_REDIRECTS + 1):
+            res = await self._send(method, url, data, headers)
+            if res.status in REDIRECT_CODES and 'Location' in res.headers:
+                res.close()
+                url = urljoin(url, res.headers['Location'])
+                if res.status in (301, 302, 303) and method == 'POST':
+                    method = 'GET'
+                    data = None
+                    headers = {k: v for k, v in headers.items()
+                        if k.lower() not in ('content-length',
+                            'content-type')}
+                continue
+            if res.status >= 400:
+                body = await res.read()
+                raise urllib.error.HTTPError(url, res.status, res.reason,
+                    res.headers, io.BytesIO(body))
+            return res
+        raise urllib.error.HTTPError(url, res.status, 'Too many redirects',
+            res.headers, None)
+
+    async def _send(self, method, url, data, headers):
+        parts = urlsplit(url)
+        scheme = parts.scheme
+        port = parts.port or (443 if scheme == 'https' else 80)
+        key = (scheme, parts.hostname, port)
+        selector = parts.path or '/'
+        if parts.query:
+            selector += '?' + parts.query
+
+        hdrs = {k.title(): v for k, v in headers.items()}
+        hdrs.setdefault('Host', parts.netloc)
+        hdrs.setdefault('User-Agent', 'py-sonic')
+        hdrs.setdefault('Accept-Encoding', 'identity')
+        if data is not None:
+            hdrs.setdefault('Content-Type',
+                'application/x-www-form-urlencoded')
+            hdrs['Content-Length'] = str(len(data))
+        head = ['%s %s HTTP/1.1' % (method, selector)]
+        head.extend('%s: %s' % item for item in hdrs.items())
+        payload = ('\r\n'.join(head) + '\r\n\r\n').encode('iso-8859-1')
+        if data:
+            payload += data
+
+        sslContext = None
+        if scheme == 'https':
+            sslContext = self._getSSLContext()
+
+        fresh = False
+        while True:
+            conn, reused = await self._aioPool.getConnection(key,
+                sslContext, fresh)
+            try:
+                conn.writer.write(payload)
+                await conn.writer.drain()
+                return await self._readResponse(conn, method, url)
+            except (ConnectionError, asyncio.IncompleteReadError,
+                    http_client.RemoteDisconnected):
+                self._aioPool.releaseConnection(conn, False)
+                if not reused:
+                    raise
+                logger.debug('Stale pooled connection to %s, reconnecting',
+                    parts.netloc)
+                fresh = True
+            except:
+                self._aioPool.releaseConnection(conn, False)
+                raise
+
+    async def _readResponse(self, conn, method, url):
+        reader = conn.reader
+        while True:
+            line = await reader.readline()
+            if not line:
+                raise http_client.RemoteDisconnected('Remote end closed '
+                    'connection without response')
+            try:
+                version, status, reason = (line.decode('iso-8859-1')
+                    .rstrip('\r\n').split(' ', 2) + [''])[:3]
+                status = int(status)
+            except ValueError:
+                raise http_client.BadStatusLine(line)
+            hlines = []
+            while True:
+                hline = await reader.readline()
+                if hline in (b'\r\n', b'\n', b''):
+                    break
+                hlines.append(hline.decode('iso-8859-1'))
+            if status != 100:
+                break
+        headers = Parser(_class=http_client.HTTPMessage).parsestr(
+            ''.join(hlines))
+        return AsyncResponse(conn, self._aioPool, method, url, status,
+            reason.strip(), headers, 10 if version == 'HTTP/1.0' else 11)
+
+    def _getSSLContext(self):
+        context = self._sslContexts.get(self._insecure)
+        if context is None:
+            if self._insecure:
+                context = ssl._create_unverified_context()
+            else:
+                context = ssl.create_default_context()
+            self._sslContexts[self._insecure] = context
+        return context
+
+
+def _makeAsync(method):
+    @functools.wraps(method)
+    async def wrapper(self, *args, **kwargs):
+        return await self._callAsync(method, args, kwargs)
+    return wrapper
+
+
+def _isAPIMethod(name, attr):
+    """
+    The API methods are documented with the API version they appeared
+    in ("since: 1.2.0"), apart from the unofficial ones which go through
+    _unsupportedAPIFunction().  Helpers built on top of the API methods,
+    like map() or downloadTo(), are left synchronous
+    """
+    if name.startswith('_') or not inspect.isfunction(attr) or \
+            inspect.isgeneratorfunction(attr):
+        return False
+    doc = (attr.__doc__ or '').strip()
+    return doc.startswith('since') or \
+        '_unsupportedAPIFunction' in attr.__code__.co_names
+
+
+# Mirror all of the Connection API methods as coroutines
+for _name, _attr in list(vars(Connection).items()):
+    if _isAPIMethod(_name, _attr):
+        setattr(AsyncConnection, _name, _makeAsync(_attr))
+del _name, _attr
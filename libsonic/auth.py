@@ -0,0 +1,90 @@
+"""
+This file is part of py-sonic.
+
+py-sonic is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+py-sonic is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with py-sonic.  If not, see <http://www.gnu.org/licenses/>
+
+Token authentication (API 1.13.0+) for libsonic.connection.Connection.
+"""
+
+from collections import deque
+from hashlib import md5
+
+import os
+import threading
+import time
+
+SALT_LENGTH = 12
+
+
+class TokenManager(object):
+    def __init__(self, password, batchSize=64, reuseWindow=0):
+        """
+        Hands out salt/token pairs for token authentication.  The pairs
+        are generated in batches, from a single os.urandom() call per
+        batch, so the per-request cost is a deque pop.
+
+        password:str        The user's password
+        batchSize:int       The number of pairs generated at a time
+        reuseWindow:float   If greater than zero, the same pair is used
+                            for all requests made within this many
+                            seconds.  This saves the generation work
+                            entirely, but a captured token can then be
+                            replayed for as long as the window lasts
+        """
+        self._password = password.encode('utf-8')
+        self.batchSize = max(1, int(batchSize))
+        self.reuseWindow = reuseWindow
+        self._pairs = deque()
+        self._current = None
+        self._lock = threading.Lock()
+
+    def getSaltToken(self):
+        """
+        Returns a (salt, token) tuple
+        """
+        pair = self._get()
+        return pair[0], pair[1]
+
+    def getQuery(self):
+        """
+        Returns the url encoded "s=<salt>&t=<token>" query string
+        """
+        return self._get()[2]
+
+    def _get(self):
+        if self.reuseWindow:
+            current = self._current
+            if current is not None and current[1] > time.monotonic():
+                return current[0]
+        while True:
+            try:
+                pair = self._pairs.popleft()
+                break
+            except IndexError:
+                self._refill()
+        if self.reuseWindow:
+            self._current = (pair, time.monotonic() + self.reuseWindow)
+        return pair
+
+    def _refill(self):
+        with self._lock:
+            if self._pairs:
+                return
+            salts = os.urandom(SALT_LENGTH // 2 * self.batchSize).hex()
+            pairs = []
+            for i in range(0, len(salts), SALT_LENGTH):
+                salt = salts[i:i + SALT_LENGTH]
+                token = md5(self._password + salt.encode('ascii')).hexdigest()
+                pairs.append((salt, token, 's=%s&t=%s' % (salt, token)))
+            self._pairs.extend(pairs)
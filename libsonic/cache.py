@@ -0,0 +1,275 @@
+"""
+This file is part of py-sonic.
+
+py-sonic is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+py-sonic is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with py-sonic.  If not, see <http://www.gnu.org/licenses/>
+
+Response caching for libsonic.connection.Connection.
+
+A cache is opt-in, by passing one to Connection:
+
+    conn = Connection('https://music.example.com', 'user', 'pass',
+        cache=ResponseCache(maxBytes=128 * 1024 * 1024))
+
+Raw response bodies are cached, keyed on the user, view and query (the
+per-request auth salt/token is not part of the key), so every hit is
+decoded into a fresh result the caller is free to modify.
+
+Any object with the same methods as ResponseCache can be used as a
+cache.
+"""
+
+from collections import OrderedDict
+
+import contextvars
+import threading
+import time
+
+# True while the requests skip the cache, see Connection.bypassCache()
+cacheBypassed = contextvars.ContextVar('libsonic_cache_bypassed',
+    default=False)
+
+# The default number of seconds responses from these views are cached.
+# Views not in here are never cached
+DEFAULT_TTLS = {
+    'getMusicFolders': 3600,
+    'getGenres': 600,
+    'getIndexes': 600,
+    'getArtists': 600,
+    'getMusicDirectory': 600,
+    'getArtist': 600,
+    'getAlbum': 600,
+    'getSong': 600,
+    'getArtistInfo': 3600,
+    'getArtistInfo2': 3600,
+    'getAlbumInfo': 3600,
+    'getAlbumInfo2': 3600,
+    'getTopSongs': 3600,
+    'getPlaylists': 60,
+    'getPlaylist': 60,
+    'getStarred': 60,
+    'getStarred2': 60,
+    'getCoverArt': 86400,
+    'getAvatar': 3600,
+}
+
+# The cached views whose responses are about a single item, keyed by its
+# id.  A call changing some items only drops the entries of these views
+# which mention one of them (ex: starring a song drops its getSong entry
+# and the getAlbum and getMusicDirectory entries listing it)
+ID_VIEWS = ('getMusicDirectory', 'getArtist', 'getAlbum', 'getSong',
+    'getPlaylist')
+
+# The parameters of the mutating calls holding the ids of the changed
+# items
+ID_PARAMS = ('id', 'albumId', 'artistId', 'playlistId')
+
+_BROWSE_VIEWS = ('getIndexes', 'getArtists', 'getMusicDirectory',
+    'getArtist', 'getAlbum', 'getSong')
+
+# Maps the mutating views to the cached views whose entries they make
+# stale.  A mapping to None invalidates everything
+INVALIDATES = {
+    'star': _BROWSE_VIEWS + ('getStarred', 'getStarred2', 'getPlaylist'),
+    'unstar': _BROWSE_VIEWS + ('getStarred', 'getStarred2', 'getPlaylist'),
+    'setRating': _BROWSE_VIEWS + ('getStarred', 'getStarred2',
+        'getPlaylist'),
+    # The play counts aren't part of the indexes
+    'scrobble': ('getMusicDirectory', 'getArtist', 'getAlbum', 'getSong',
+        'getStarred', 'getStarred2', 'getPlaylist'),
+    'createPlaylist': ('getPlaylists', 'getPlaylist'),
+    'updatePlaylist': ('getPlaylists', 'getPlaylist'),
+    'deletePlaylist': ('getPlaylists', 'getPlaylist'),
+    'startScan': None,
+    'createUser': ('getAvatar',),
+    'updateUser': ('getAvatar',),
+    'deleteUser': ('getAvatar',),
+}
+
+
+def getChangedIds(query):
+    """
+    Returns the set of the ids of the items changed by a mutating call,
+    from the query of its cache key (a tuple of (name, value) pairs)
+    """
+    return {v for k, v in query if k in ID_PARAMS}
+
+
+def idMarkers(ids):
+    """
+    Returns the byte strings found in a response body mentioning one of
+    the ids.  Ids are quoted in both JSON and XML responses
+    """
+    return [('"%s"' % i).encode('utf-8') for i in ids]
+
+
+class ResponseCache(object):
+    def __init__(self, maxEntries=1024, maxBytes=64 * 1024 * 1024,
+            ttls=None):
+        """
+        A thread safe, in-memory, LRU response cache
+
+        maxEntries:int      The max number of responses to cache
+        maxBytes:int        The max total size of the cached response
+                            bodies.  The least recently used entries
+                            are evicted to stay under both limits
+        ttls:dict           A mapping of view name to the number of
+                            seconds to cache its responses.  This is
+                            merged into DEFAULT_TTLS.  Map a view to
+                            None (or 0) to not cache it
+        """
+        self.maxEntries = int(maxEntries)
+        self.maxBytes = int(maxBytes)
+        self.ttls = dict(DEFAULT_TTLS)
+        if ttls:
+            self.ttls.update(ttls)
+        self._entries = OrderedDict()
+        self._generations = {}
+        self._size = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def getTtl(self, viewName):
+        """
+        Returns the number of seconds to cache responses for the given
+        view, or None if it shouldn't be cached
+        """
+        return self.ttls.get(viewName) or None
+
+    def getGeneration(self, viewName):
+        """
+        Returns a number which changes every time the entries for this
+        view are invalidated.  Pass it back into set() so a response
+        which was fetched before an invalidation is not stored
+        """
+        with self._lock:
+            return self._generations.get(viewName, 0)
+
+    def get(self, key):
+        """
+        Returns a (headers, body) tuple for the key or None on a miss.
+        The key is a (username, viewName, query) tuple
+
+        key:tuple       The cache key
+        """
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry[2] > now:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return entry[0], entry[1]
+                self._remove(key)
+            self.misses += 1
+        return None
+
+    def set(self, key, headers, body, generation=None):
+        """
+        Caches a response
+
+        key:tuple       The cache key
+        headers:Message The response headers
+        body:bytes      The response body
+        generation:int  The getGeneration() for the view when the
+                        request was made.  If the view has been
+                        invalidated since, the response is dropped
+        """
+        viewName = key[1]
+        ttl = self.getTtl(viewName)
+        if ttl is None or len(body) > self.maxBytes:
+            return
+        with self._lock:
+            if generation is not None and \
+                    generation != self._generations.get(viewName, 0):
+                return
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (headers, body, time.monotonic() + ttl)
+            self._size += len(body)
+            while len(self._entries) > self.maxEntries or \
+                    self._size > self.maxBytes:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def invalidate(self, viewNames=None, ids=None):
+        """
+        Drops all the entries for the given views, or everything if
+        viewNames is None
+
+        viewNames:list      A list of view names, ex: ['getAlbum']
+        ids:list            If set, only the entries of the ID_VIEWS
+                            which mention one of these ids are dropped,
+                            the other views are dropped whole
+        """
+        markers = idMarkers(ids) if ids else None
+        with self._lock:
+            if viewNames is None:
+                viewNames = set(self._generations) | set(self.ttls)
+                self._entries.clear()
+                self._size = 0
+            else:
+                viewNames = set(viewNames)
+                for key, entry in list(self._entries.items()):
+                    if key[1] not in viewNames:
+                        continue
+                    if markers and key[1] in ID_VIEWS and \
+                            not any(m in entry[1] for m in markers):
+                        continue
+                    self._remove(key)
+            for viewName in viewNames:
+                self._generations[viewName] = \
+                    self._generations.get(viewName, 0) + 1
+
+    def invalidateFor(self, viewName, query=()):
+        """
+        Invalidates the entries made stale by a call to the given
+        (mutating) view.  See INVALIDATES
+
+        viewName:str        The view called
+        query:tuple         The query of the call's cache key, for the
+                            ids of the changed items
+        """
+        if viewName not in INVALIDATES:
+            return
+        self.invalidate(INVALIDATES[viewName], getChangedIds(query))
+
+    def clear(self):
+        """
+        Drops everything and resets the counters
+        """
+        self.invalidate()
+        with self._lock:
+            self.hits = self.misses = self.evictions = 0
+
+    def stats(self):
+        """
+        Returns a dict of the cache counters, like the following:
+
+        {'hits': 1023, 'misses': 12, 'evictions': 0, 'entries': 12,
+         'bytes': 40960}
+        """
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'entries': len(self._entries),
+                'bytes': self._size,
+            }
+
+    def _remove(self, key):
+        entry = self._entries.pop(key)
+        self._size -= len(entry[1])
@@ -16,30 +16,95 @@ along with py-sonic.  If not, see <http://www.gnu.org/licenses/>
 """
 
 from libsonic.errors import *
+from libsonic.pool import ConnectionPool, KeepAliveHTTPHandler, \
+    KeepAliveHTTPSHandler
+from libsonic.auth import TokenManager
+from libsonic.cache import ResponseCache, cacheBypassed
+from libsonic.decoders import getDecoder, normalizeTimestamps
+from libsonic.jsonstream import iterResponse
+from libsonic.metrics import Metrics, RequestRecord
+from libsonic.models import toModels
+from libsonic.paging import MAX_LIST_OFFSET, MAX_PAGE_SIZE, asList, \
+    iterPages
+from libsonic.overload import AdaptiveLimiter, CircuitBreaker, \
+    checkLane, currentLane, getEndpointGroup
+from libsonic.ratelimit import RateLimiter
+from libsonic.retry import RetryPolicy, isTransient
+from libsonic.seekable import SeekableRemoteFile
+from libsonic.singleflight import SingleFlight
+from libsonic.tracing import RingBufferSink, Span, tracePhase
 from netrc import netrc
 from hashlib import md5
 import urllib.request
 import urllib.error
 from http import client as http_client
-from urllib.parse import urlencode
-from io import StringIO
-
-import json
+from urllib.parse import parse_qsl, quote_plus, urlencode
+from urllib.response import addinfourl
+from io import BytesIO
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+from contextlib import contextmanager
+
+import contextvars
 import logging
-import socket
+import mmap
 import ssl
-import sys
 import os
+import threading
+import time
 
 API_VERSION = '1.16.1'
 
+# The binary views whose responses are small enough to be buffered and
+# shared between coalesced calls
+COALESCED_BINARY_VIEWS = ('getCoverArt', 'getAvatar')
+
 logger = logging.getLogger(__name__)
 
+
+class _PositionalWriter(object):
+    """
+    Writes to given offsets of a preallocated file from several threads
+    at once, with os.pwrite() where available and through a memory map
+    elsewhere
+    """
+    def __init__(self, fd, size):
+        self.fd = fd
+        self._map = None
+        if not hasattr(os, 'pwrite') and size:
+            self._map = mmap.mmap(fd, size)
+
+    def write(self, data, offset):
+        if self._map is not None:
+            self._map[offset:offset + len(data)] = data
+            return
+        while data:
+            n = os.pwrite(self.fd, data, offset)
+            data = data[n:]
+            offset += n
+
+    def close(self):
+        if self._map is not None:
+            self._map.flush()
+            self._map.close()
+            self._map = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
 class Connection(object):
     def __init__(self, baseUrl, username=None, password=None, port=4040,
             serverPath='/rest', appName='py-sonic', apiVersion=API_VERSION,
             insecure=False, useNetrc=None, legacyAuth=False, useGET=False,
-            salt=None, token=None, userAgent=None, customHeaders=None):
+            salt=None, token=None, userAgent=None, customHeaders=None,
+            keepAlive=True, poolSize=10, poolIdleTimeout=60.0, cache=None,
+            tokenBatchSize=64, tokenReuseWindow=0, jsonDecoder=None,
+            coalesce=True, retryPolicy=True, circuitBreaker=None,
+            concurrencyLimiter=None, rateLimit=None, metrics=True,
+            tracing=None):
         """
         This will create a connection to your subsonic server
 
@@ -111,7 +176,92 @@ class Connection(object):
                             shortcut instead of using `customHeaders`.
         customHeaders:dict  A dictionary of custom headers that will be sent
                             with each request.
-        """
+        keepAlive:bool      Reuse HTTP/1.1 keep-alive connections between
+                            requests instead of opening a new connection
+                            (and doing a new TLS handshake) per request
+        poolSize:int        The max number of idle keep-alive connections
+                            kept open per host
+        poolIdleTimeout:float   The number of seconds a keep-alive
+                                connection may sit idle before it is
+                                closed rather than reused
+        cache:ResponseCache     An opt-in cache for the responses of
+                                read-mostly calls, like getArtists,
+                                getAlbum or getCoverArt.  Set to True to
+                                use a ResponseCache with the defaults.
+                                Mutating calls, like star or
+                                updatePlaylist, invalidate the affected
+                                entries.  See libsonic.cache.  For a
+                                cache which persists across restarts,
+                                use a libsonic.sqlitecache.SQLiteCache
+        tokenBatchSize:int  The number of auth salt/token pairs generated
+                            at a time.  See libsonic.auth.TokenManager
+        tokenReuseWindow:float  If greater than zero, the same auth
+                                salt/token pair is sent with every
+                                request made within this many seconds,
+                                which makes authenticating cost next to
+                                nothing.  Note that a captured token can
+                                be replayed while it is being reused
+        jsonDecoder:str     The JSON backend used to decode responses.
+                            By default, the fastest one installed of
+                            orjson, simdjson, ujson and the stdlib json
+                            is used.  This can be set to one of those
+                            names or to a decoder object.  See
+                            libsonic.decoders
+        coalesce:bool       If True, identical read calls made from
+                            several threads at the same time (ex: many
+                            getAlbum() calls for the same album) share a
+                            single request to the server.  This covers
+                            the info calls plus getCoverArt and
+                            getAvatar, whose bodies are small enough to
+                            buffer.  See libsonic.singleflight
+        retryPolicy:RetryPolicy The policy for retrying the requests
+                                which fail on a transient error (a
+                                connection reset, a 503, etc.).  By
+                                default (True), the idempotent calls are
+                                retried with a RetryPolicy with the
+                                defaults.  Set to None to never retry.
+                                See libsonic.retry
+        circuitBreaker:dict     The settings of the circuit breakers
+                                kept for each endpoint group, as the
+                                keyword arguments of a
+                                libsonic.overload.CircuitBreaker, or
+                                True for the defaults.  While a breaker
+                                is open, its requests raise a
+                                CircuitOpenError.  By default (None),
+                                there are no breakers
+        concurrencyLimiter:AdaptiveLimiter  The adaptive limit of the
+                                number of requests of the "background"
+                                and "bulk" lanes in flight, see lane().
+                                If True, an AdaptiveLimiter with the
+                                defaults is used.  By default (None),
+                                these requests aren't limited
+        rateLimit:float         The max number of requests per second
+                                sent to the server, or a
+                                libsonic.ratelimit.RateLimiter.  The
+                                requests waiting for their turn go by
+                                lane priority.  By default (None), the
+                                request rate isn't limited
+        metrics:Metrics         Where the per view counters and latency
+                                histograms of the calls are kept.  By
+                                default (True), in a new
+                                libsonic.metrics.Metrics.  Set to None
+                                to not keep any.  See also
+                                addRequestHook()
+        tracing:callable        The sink the libsonic.tracing.Spans of
+                                the calls, with the time spent in each
+                                phase (connect, TLS handshake, time to
+                                first byte, body read, JSON decoding,
+                                etc.), are passed to.  If True, they are
+                                kept in a libsonic.tracing.RingBufferSink,
+                                see traceSink.  By default (None), the
+                                calls aren't traced
+
+        A Connection is thread safe.  A single instance can be shared
+        between threads, including while the properties (credentials,
+        base url, etc.) are being changed.  See map() for running many
+        calls concurrently.
+        """
+        self._lock = threading.RLock()
         self._baseUrl = baseUrl
         self._hostname = baseUrl.split('://')[1].strip()
         self._username = username
@@ -119,6 +269,12 @@ class Connection(object):
         self._salt = salt
         self._token = token
         self._legacyAuth = legacyAuth
+        self._tokenBatchSize = tokenBatchSize
+        self._tokenReuseWindow = tokenReuseWindow
+        # The encoded base query and the token manager, see _getBaseQuery()
+        self._baseQuery = None
+        # The view urls, see _getViewUrl()
+        self._viewUrls = {}
         self._useGET = useGET
         self._customHeaders = customHeaders if customHeaders else {}
         if userAgent:
@@ -137,51 +293,256 @@ class Connection(object):
         self._appName = appName
         self._serverPath = serverPath.strip('/')
         self._insecure = insecure
+        self._pool = None
+        if keepAlive:
+            self._pool = ConnectionPool(poolSize, poolIdleTimeout)
         self._opener = self._getOpener(self._username, self._rawPass)
+        if cache is True:
+            cache = ResponseCache()
+        self._cache = cache
+        self._decoder = getDecoder(jsonDecoder)
+        self._inflight = SingleFlight() if coalesce else None
+        if retryPolicy is True:
+            retryPolicy = RetryPolicy()
+        self._retryPolicy = retryPolicy or None
+        if circuitBreaker is True:
+            circuitBreaker = {}
+        elif circuitBreaker is False:
+            circuitBreaker = None
+        self._breakerArgs = circuitBreaker
+        self._breakers = {}
+        if concurrencyLimiter is True:
+            concurrencyLimiter = AdaptiveLimiter()
+        self._limiter = concurrencyLimiter or None
+        if rateLimit is not None and not isinstance(rateLimit, RateLimiter):
+            rateLimit = RateLimiter(rateLimit)
+        self._rateLimiter = rateLimit
+        if metrics is True:
+            metrics = Metrics()
+        self._metrics = metrics or None
+        self._preHooks = []
+        self._postHooks = []
+        if tracing is True:
+            tracing = RingBufferSink()
+        self._traceSink = tracing or None
 
     # Properties
     def setBaseUrl(self, url):
-        self._baseUrl = url
-        self._opener = self._getOpener(self._username, self._rawPass)
+        with self._lock:
+            self._baseUrl = url
+            self._viewUrls = {}
+            self._opener = self._getOpener(self._username, self._rawPass)
     baseUrl = property(lambda s: s._baseUrl, setBaseUrl)
 
     def setPort(self, port):
-        self._port = int(port)
+        with self._lock:
+            self._port = int(port)
+            self._viewUrls = {}
     port = property(lambda s: s._port, setPort)
 
     def setUsername(self, username):
-        self._username = username
-        self._opener = self._getOpener(self._username, self._rawPass)
+        with self._lock:
+            self._username = username
+            self._baseQuery = None
+            self._opener = self._getOpener(self._username, self._rawPass)
     username = property(lambda s: s._username, setUsername)
 
     def setPassword(self, password):
-        self._rawPass = password
-        # Redo the opener with the new creds
-        self._opener = self._getOpener(self._username, self._rawPass)
+        with self._lock:
+            self._rawPass = password
+            self._baseQuery = None
+            # Redo the opener with the new creds
+            self._opener = self._getOpener(self._username, self._rawPass)
     password = property(lambda s: s._rawPass, setPassword)
 
+    def setCredentials(self, username, password):
+        """
+        Changes both the username and password at once, so no request
+        on another thread is made with a mismatched pair
+        """
+        with self._lock:
+            self._username = username
+            self._rawPass = password
+            self._baseQuery = None
+            self._opener = self._getOpener(self._username, self._rawPass)
+
     apiVersion = property(lambda s: s._apiVersion)
 
     def setAppName(self, appName):
-        self._appName = appName
+        with self._lock:
+            self._appName = appName
+            self._baseQuery = None
     appName = property(lambda s: s._appName, setAppName)
 
     def setServerPath(self, path):
-        self._serverPath = path.strip('/')
+        with self._lock:
+            self._serverPath = path.strip('/')
+            self._viewUrls = {}
     serverPath = property(lambda s: s._serverPath, setServerPath)
 
     def setInsecure(self, insecure):
-        self._insecure = insecure
+        with self._lock:
+            self._insecure = insecure
+            # The ssl context is set up in the opener
+            self._opener = self._getOpener(self._username, self._rawPass)
     insecure = property(lambda s: s._insecure, setInsecure)
 
     def setLegacyAuth(self, lauth):
-        self._legacyAuth = lauth
+        with self._lock:
+            self._legacyAuth = lauth
+            self._baseQuery = None
     legacyAuth = property(lambda s: s._legacyAuth, setLegacyAuth)
 
     def setGET(self, get):
-        self._useGET = get
+        with self._lock:
+            self._useGET = get
     useGET = property(lambda s: s._useGET, setGET)
 
+    cache = property(lambda s: s._cache)
+    retryPolicy = property(lambda s: s._retryPolicy)
+    concurrencyLimiter = property(lambda s: s._limiter)
+    rateLimiter = property(lambda s: s._rateLimiter)
+    metrics = property(lambda s: s._metrics)
+    traceSink = property(lambda s: s._traceSink)
+
+    def addRequestHook(self, pre=None, post=None):
+        """
+        Adds functions called with the libsonic.metrics.RequestRecord of
+        every call: pre before its request is sent, and post once it
+        completed, successfully or not, with its timings, sizes and
+        error filled in.  The hooks run on the thread making the call
+        and their exceptions are logged and ignored
+
+        pre:callable        Called as pre(record)
+        post:callable       Called as post(record)
+        """
+        with self._lock:
+            if pre is not None:
+                self._preHooks = self._preHooks + [pre]
+            if post is not None:
+                self._postHooks = self._postHooks + [post]
+
+    def removeRequestHook(self, pre=None, post=None):
+        """
+        Removes hooks added with addRequestHook()
+        """
+        with self._lock:
+            if pre is not None:
+                self._preHooks = [h for h in self._preHooks if h != pre]
+            if post is not None:
+                self._postHooks = [h for h in self._postHooks if h != post]
+
+    def getCircuitBreakers(self):
+        """
+        Returns a dict of the endpoint group names to their circuit
+        breakers, for the groups requested so far
+        """
+        return dict(self._breakers)
+
+    @contextmanager
+    def lane(self, name):
+        """
+        Makes the requests made in the block (including those of map()
+        and of the iter*() methods) in the given lane: "interactive", the
+        default, "background" or "bulk", by priority.  The background
+        and bulk requests are subject to the adaptive concurrency limit,
+        and wait behind the higher priority lanes for the rate limit.
+        See libsonic.overload and libsonic.ratelimit
+
+        ex:
+            with conn.lane('bulk'):
+                for album in conn.iterAlbumList2('newest'):
+                    ...
+        """
+        token = currentLane.set(checkLane(name))
+        try:
+            yield self
+        finally:
+            currentLane.reset(token)
+
+    @contextmanager
+    def bypassCache(self):
+        """
+        Makes the read requests made in the block (including those of
+        map() and of the iter*() methods) skip the response cache: they
+        are neither served from it nor stored in it.  The mutating calls
+        still invalidate it
+
+        ex:
+            with conn.bypassCache():
+                album = conn.getAlbum(albumId)
+        """
+        token = cacheBypassed.set(True)
+        try:
+            yield self
+        finally:
+            cacheBypassed.reset(token)
+
+    def close(self):
+        """
+        Closes any idle keep-alive connections held by this connection
+        """
+        if self._pool is not None:
+            self._pool.clear()
+
+    def map(self, method, argsList, maxWorkers=8):
+        """
+        Runs many calls of the same API method concurrently on a bounded
+        thread pool and yields the results in the same order as argsList.
+        Only a few calls past maxWorkers are queued up at any time, so
+        argsList can be a (long) generator.
+
+        If a call raises an exception, it is raised here when its result
+        is reached and the remaining calls are cancelled.
+
+        method:str|callable The name of the API method, ex: 'getAlbum',
+                            or the method itself
+        argsList:iterable   The arguments for each call.  Each item can
+                            be a dict of keyword arguments, a tuple of
+                            positional arguments or a single positional
+                            argument
+        maxWorkers:int      The max number of calls to run at once
+
+        ex:
+            for res in conn.map('getAlbum', albumIds, maxWorkers=16):
+                print(res['album']['name'])
+        """
+        if isinstance(method, str):
+            method = getattr(self, method)
+        maxWorkers = int(maxWorkers)
+        if maxWorkers < 1:
+            raise ArgumentError('maxWorkers must be at least 1: %r' %
+                maxWorkers)
+
+        def submit(executor, args):
+            # Each call runs in a copy of the current context, so the
+            # lane (etc.) of the caller applies to it
+            run = contextvars.copy_context().run
+            if isinstance(args, dict):
+                return executor.submit(run, method, **args)
+            if isinstance(args, tuple):
+                return executor.submit(run, method, *args)
+            return executor.submit(run, method, args)
+
+        executor = ThreadPoolExecutor(maxWorkers)
+        pending = deque()
+        try:
+            argsIter = iter(argsList)
+            for args in argsIter:
+                pending.append(submit(executor, args))
+                if len(pending) >= maxWorkers * 2:
+                    break
+            while pending:
+                res = pending.popleft().result()
+                for args in argsIter:
+                    pending.append(submit(executor, args))
+                    break
+                yield res
+        finally:
+            for fut in pending:
+                fut.cancel()
+            executor.shutdown(wait=False)
+
     # API methods
     def ping(self):
         """
@@ -376,10 +737,34 @@ class Connection(object):
         req = self._getRequest(viewName, q)
         res = self._doInfoReq(req)
         self._checkStatus(res)
-        self._fixLastModified(res)
         return res
 
-    def getMusicDirectory(self, mid):
+    def getIndexesIter(self, musicFolderId=None, ifModifiedSince=0):
+        """
+        Like getIndexes(), but the response is parsed as it is read and
+        its items are yielded one at a time, as (kind, item) tuples, so
+        huge libraries can be processed without holding the whole
+        response in memory.  The kind is one of "artist", "shortcut" or
+        "child" (a file at the root of the music folder)
+
+        ex:
+            for kind, item in conn.getIndexesIter():
+                if kind == 'artist':
+                    print(item['name'])
+        """
+        methodName = 'getIndexes'
+        viewName = '%s.view' % methodName
+
+        q = self._getQueryDict({'musicFolderId': musicFolderId,
+            'ifModifiedSince': self._ts2milli(ifModifiedSince)})
+
+        return self._iterResponse(viewName, q, (
+            ('indexes', 'index', '*', 'artist'),
+            ('indexes', 'shortcut'),
+            ('indexes', 'child'),
+        ))
+
+    def getMusicDirectory(self, mid, models=False):
         """
         since: 1.0.0
 
@@ -389,6 +774,8 @@ class Connection(object):
         mid:str     The string ID value which uniquely identifies the
                     folder.  Obtained via calls to getIndexes or
                     getMusicDirectory.  REQUIRED
+        models:bool    If True, the entities in the response are
+                       libsonic.models objects instead of dicts
 
         Returns a dict like the following:
 
@@ -440,7 +827,7 @@ class Connection(object):
         req = self._getRequest(viewName, {'id': mid})
         res = self._doInfoReq(req)
         self._checkStatus(res)
-        return res
+        return toModels(res) if models else res
 
     def search(self, artist=None, album=None, title=None, any=None,
             count=20, offset=0, newerThan=None):
@@ -476,7 +863,8 @@ class Connection(object):
         return res
 
     def search2(self, query, artistCount=20, artistOffset=0, albumCount=20,
-            albumOffset=0, songCount=20, songOffset=0, musicFolderId=None):
+            albumOffset=0, songCount=20, songOffset=0, musicFolderId=None,
+            models=False):
         """
         since: 1.4.0
 
@@ -492,6 +880,8 @@ class Connection(object):
         songOffset:int      Search offset for songs (for paging) [default: 0]
         musicFolderId:int   Only return results from the music folder
                             with the given ID. See getMusicFolders
+        models:bool         If True, the entities in the response are
+                            libsonic.models objects instead of dicts
 
         Returns a dict like the following:
 
@@ -536,10 +926,11 @@ class Connection(object):
         req = self._getRequest(viewName, q)
         res = self._doInfoReq(req)
         self._checkStatus(res)
-        return res
+        return toModels(res) if models else res
 
     def search3(self, query, artistCount=20, artistOffset=0, albumCount=20,
-            albumOffset=0, songCount=20, songOffset=0, musicFolderId=None):
+            albumOffset=0, songCount=20, songOffset=0, musicFolderId=None,
+            models=False):
         """
         since: 1.8.0
 
@@ -555,6 +946,8 @@ class Connection(object):
         songOffset:int      Search offset for songs (for paging) [default: 0]
         musicFolderId:int   Only return results from the music folder
                             with the given ID. See getMusicFolders
+        models:bool         If True, the entities in the response are
+                            libsonic.models objects instead of dicts
 
         Returns a dict like the following (search for "Tune Yards":
             {u'searchResult3': {u'album': [{u'artist': u'Tune-Yards',
@@ -614,9 +1007,63 @@ class Connection(object):
         req = self._getRequest(viewName, q)
         res = self._doInfoReq(req)
         self._checkStatus(res)
-        return res
+        return toModels(res) if models else res
+
+    def search3Iter(self, query, artistCount=20, artistOffset=0,
+            albumCount=20, albumOffset=0, songCount=20, songOffset=0,
+            musicFolderId=None):
+        """
+        Like search3(), but yields the results one at a time, as (kind,
+        item) tuples with a kind of "artist", "album" or "song", as the
+        response is parsed.  This is meant for large counts, see
+        iterSearch3() for paging through all the results.  See also
+        getIndexesIter()
+        """
+        methodName = 'search3'
+        viewName = '%s.view' % methodName
+
+        q = self._getQueryDict({'query': query, 'artistCount': artistCount,
+            'artistOffset': artistOffset, 'albumCount': albumCount,
+            'albumOffset': albumOffset, 'songCount': songCount,
+            'songOffset': songOffset, 'musicFolderId': musicFolderId})
+
+        return self._iterResponse(viewName, q, (('searchResult3', 'artist'),
+            ('searchResult3', 'album'), ('searchResult3', 'song')))
 
-    def getPlaylists(self, username=None):
+    def iterSearch3(self, query, kind='song', pageSize=500, prefetch=2,
+            musicFolderId=None):
+        """
+        Pages through all the search3() results of one kind and yields
+        them one at a time.  The next pages are fetched in the
+        background while the current one is consumed.
+
+        query:str           The search query
+        kind:str            The kind of results: "song", "album" or
+                            "artist"
+        pageSize:int        The number of results to request per page
+        prefetch:int        The max number of pages to fetch ahead.  Set
+                            to 0 to fetch each page only when needed
+        musicFolderId:int   Only return results from the music folder
+                            with the given ID. See getMusicFolders
+
+        ex:
+            for song in conn.iterSearch3('beatles'):
+                print(song['title'])
+        """
+        if kind not in ('song', 'album', 'artist'):
+            raise ArgumentError('kind must be one of "song", "album" or '
+                '"artist": %r' % kind)
+
+        def fetchPage(offset, size):
+            counts = {'artistCount': 0, 'albumCount': 0, 'songCount': 0}
+            counts['%sCount' % kind] = size
+            counts['%sOffset' % kind] = offset
+            res = self.search3(query, musicFolderId=musicFolderId, **counts)
+            return asList(res.get('searchResult3', {}).get(kind))
+
+        return iterPages(fetchPage, pageSize, prefetch)
+
+    def getPlaylists(self, username=None, models=False):
         """
         since: 1.0.0
 
@@ -627,6 +1074,8 @@ class Connection(object):
                             rather than for the authenticated user.  The
                             authenticated user must have admin role
                             if this parameter is used
+        models:bool         If True, the entities in the response are
+                            libsonic.models objects instead of dicts
 
         Returns a dict like the following:
 
@@ -646,15 +1095,17 @@ class Connection(object):
         req = self._getRequest(viewName, q)
         res = self._doInfoReq(req)
         self._checkStatus(res)
-        return res
+        return toModels(res) if models else res
 
-    def getPlaylist(self, pid):
+    def getPlaylist(self, pid, models=False):
         """
         since: 1.0.0
 
         Returns a listing of files in a saved playlist
 
         id:str      The ID of the playlist as returned in getPlaylists()
+        models:bool    If True, the entities in the response are
+                       libsonic.models objects instead of dicts
 
         Returns a dict like the following:
 
@@ -686,7 +1137,19 @@ class Connection(object):
         req = self._getRequest(viewName, {'id': pid})
         res = self._doInfoReq(req)
         self._checkStatus(res)
-        return res
+        return toModels(res) if models else res
+
+    def getPlaylistIter(self, pid):
+        """
+        Like getPlaylist(), but yields the playlist entries one at a
+        time, as ('entry', song) tuples, as the response is parsed.  See
+        getIndexesIter()
+        """
+        methodName = 'getPlaylist'
+        viewName = '%s.view' % methodName
+
+        return self._iterResponse(viewName, {'id': pid},
+            (('playlist', 'entry'),))
 
     def createPlaylist(self, playlistId=None, name=None, songIds=[]):
         """
@@ -742,13 +1205,16 @@ class Connection(object):
         self._checkStatus(res)
         return res
 
-    def download(self, sid):
+    def download(self, sid, seekable=False):
         """
         since: 1.0.0
 
         Downloads a given music file.
 
-        sid:str     The ID of the music file to download.
+        sid:str         The ID of the music file to download.
+        seekable:bool   If True, a libsonic.seekable.SeekableRemoteFile
+                        is returned instead, which fetches the parts of
+                        the file which are read, with Range requests
 
         Returns the file-like object for reading or raises an exception
         on error
@@ -756,14 +1222,172 @@ class Connection(object):
         methodName = 'download'
         viewName = '%s.view' % methodName
 
+        if seekable:
+            return self._openSeekable(viewName, {'id': sid})
+
         req = self._getRequest(viewName, {'id': sid})
         res = self._doBinReq(req)
         if isinstance(res, dict):
             self._checkStatus(res)
         return res
 
+    def downloadTo(self, sid, path, chunkSize=1024 * 1024, resume=True,
+            fsync=False, progress=None):
+        """
+        Downloads a given music file straight to a local file, in large
+        chunks.  If the file already exists and resume is True, only the
+        missing part is requested (with an HTTP Range request), so an
+        interrupted download can be picked up where it stopped.
+
+        sid:str             The ID of the music file to download
+        path:str            The local path to write the file to
+        chunkSize:int       The number of bytes read and written at a time
+        resume:bool         If True and the file exists, resume the
+                            download at the end of the existing file
+        fsync:bool          If True, the file is fsync()ed when done
+        progress:callable   If set, this is called after every chunk with
+                            the number of bytes written so far and the
+                            total size of the file (None if unknown)
+
+        Returns a dict like the following:
+
+        {'bytes': 4123432, 'size': 31337000, 'offset': 27213568,
+         'elapsed': 0.71, 'bytesPerSec': 5807650.7}
+
+        Where "bytes" is the number of bytes downloaded by this call,
+        "size" the total size of the file and "offset" the offset the
+        download was resumed at
+        """
+        methodName = 'download'
+        viewName = '%s.view' % methodName
+
+        return self._transferTo(viewName, {'id': sid}, path, chunkSize,
+            resume, fsync, progress)
+
+    def streamTo(self, sid, path, maxBitRate=0, tformat=None,
+            chunkSize=1024 * 1024, resume=True, fsync=False, progress=None):
+        """
+        Like downloadTo(), but goes through stream() so the file can be
+        transcoded.  Servers generally don't support Range requests on
+        transcoded streams, in which case an interrupted transfer is
+        started over.
+
+        sid:str             The ID of the music file to download
+        path:str            The local path to write the file to
+        maxBitRate:int      See stream()
+        tformat:str         See stream()
+        chunkSize:int       The number of bytes read and written at a time
+        resume:bool         If True and the file exists, try to resume the
+                            download at the end of the existing file
+        fsync:bool          If True, the file is fsync()ed when done
+        progress:callable   See downloadTo()
+
+        Returns the same dict as downloadTo()
+        """
+        methodName = 'stream'
+        viewName = '%s.view' % methodName
+
+        q = self._getQueryDict({'id': sid, 'maxBitRate': maxBitRate,
+            'format': tformat})
+
+        return self._transferTo(viewName, q, path, chunkSize, resume, fsync,
+            progress)
+
+    def downloadSegmented(self, sid, path, segments=4,
+            minSegmentSize=4 * 1024 * 1024, chunkSize=1024 * 1024,
+            retries=2, fsync=False, progress=None):
+        """
+        Downloads a given music file to a local file by splitting it into
+        byte ranges which are fetched concurrently, each on its own
+        connection.  This gets around the per-connection throughput
+        limit of high latency links for large files.  The file is
+        preallocated and each range is written in place, so nothing
+        needs to be reassembled afterwards.  The ranges are written to
+        path + ".part", which is renamed to path once complete and
+        removed if the download fails.
+
+        If the server doesn't support Range requests, the file is
+        downloaded in one piece.
+
+        sid:str             The ID of the music file to download
+        path:str            The local path to write the file to.  An
+                            existing file is overwritten
+        segments:int        The max number of concurrent ranges
+        minSegmentSize:int  The min size of a range.  Smaller files are
+                            split into fewer ranges
+        chunkSize:int       The number of bytes read and written at a time
+        retries:int         The number of times a failed range is
+                            retried, from where it stopped
+        fsync:bool          If True, the file is fsync()ed when done
+        progress:callable   See downloadTo()
+
+        Returns the same dict as downloadTo(), plus the number of
+        "segments" used
+        """
+        methodName = 'download'
+        viewName = '%s.view' % methodName
+        q = {'id': sid}
+
+        start = time.monotonic()
+        # The first request tells the size, its response is used for the
+        # first range
+        res, contRange = self._openRange(viewName, q, 0)
+        if contRange is None or contRange[2] is None:
+            res.close()
+            stats = self._transferTo(viewName, q, path, chunkSize, False,
+                fsync, progress)
+            stats['segments'] = 1
+            return stats
+
+        size = contRange[2]
+        count = max(1, min(int(segments), size // max(minSegmentSize, 1)))
+        segSize = -(-size // count)
+        ranges = [(s, min(s + segSize, size) - 1)
+            for s in range(0, size, segSize)]
+
+        done = [0]
+        lock = threading.Lock()
+
+        def onChunk(nbytes):
+            with lock:
+                done[0] += nbytes
+                total = done[0]
+            if progress is not None:
+                progress(total, size)
+
+        # A failed download leaves holes, which must not be taken for a
+        # complete file (ex: by downloadTo() resuming it)
+        partPath = path + '.part'
+        fd = os.open(partPath, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o666)
+        try:
+            try:
+                self._preallocate(fd, size)
+                with _PositionalWriter(fd, size) as writer, \
+                        ThreadPoolExecutor(len(ranges)) as executor:
+                    futures = [executor.submit(self._fetchSegment, viewName,
+                            q, rng, writer, chunkSize, retries, onChunk,
+                            res if i == 0 else None)
+                        for i, rng in enumerate(ranges)]
+                    for fut in futures:
+                        fut.result()
+                if os.fstat(fd).st_size != size or done[0] != size:
+                    raise http_client.IncompleteRead(b'', size - done[0])
+                if fsync:
+                    os.fsync(fd)
+            finally:
+                os.close(fd)
+        except BaseException:
+            os.remove(partPath)
+            raise
+        os.replace(partPath, path)
+
+        stats = self._transferStats(done[0], size, 0, start)
+        stats['segments'] = len(ranges)
+        return stats
+
     def stream(self, sid, maxBitRate=0, tformat=None, timeOffset=None,
-            size=None, estimateContentLength=False, converted=False):
+            size=None, estimateContentLength=False, converted=False,
+            seekable=False):
         """
         since: 1.0.0
 
@@ -794,6 +1418,8 @@ class Connection(object):
                         the video in question, then setting this parameter
                         to "true" will cause the converted video to be
                         returned instead of the original.
+        seekable:bool   If True, a libsonic.seekable.SeekableRemoteFile
+                        is returned instead.  See download()
 
         Returns the file-like object for reading or raises an exception
         on error
@@ -806,6 +1432,9 @@ class Connection(object):
             'estimateContentLength': estimateContentLength,
             'converted': converted})
 
+        if seekable:
+            return self._openSeekable(viewName, q)
+
         req = self._getRequest(viewName, q)
         res = self._doBinReq(req)
         if isinstance(res, dict):
@@ -1147,7 +1776,7 @@ class Connection(object):
         return res
 
     def getAlbumList(self, ltype, size=10, offset=0, fromYear=None,
-            toYear=None, genre=None, musicFolderId=None):
+            toYear=None, genre=None, musicFolderId=None, models=False):
         """
         since: 1.2.0
 
@@ -1171,6 +1800,8 @@ class Connection(object):
                         genre if you set the ltype to "byGenre"
         musicFolderId:str   Only return albums in the music folder with
                             the given ID. See getMusicFolders()
+        models:bool     If True, the entities in the response are
+                        libsonic.models objects instead of dicts
 
         Returns a dict like the following:
 
@@ -1199,10 +1830,10 @@ class Connection(object):
         req = self._getRequest(viewName, q)
         res = self._doInfoReq(req)
         self._checkStatus(res)
-        return res
+        return toModels(res) if models else res
 
     def getAlbumList2(self, ltype, size=10, offset=0, fromYear=None,
-            toYear=None, genre=None, musicFolderId=None):
+            toYear=None, genre=None, musicFolderId=None, models=False):
         """
         since 1.8.0
 
@@ -1226,6 +1857,8 @@ class Connection(object):
                         genre if you set the ltype to "byGenre"
         musicFolderId:int   Only return albums in the music folder with the
                             given ID.  See getMusicFolders()
+        models:bool     If True, the entities in the response are
+                        libsonic.models objects instead of dicts
 
         Returns a dict like the following:
            {u'albumList2': {u'album': [{u'artist': u'Massive Attack',
@@ -1258,10 +1891,53 @@ class Connection(object):
         req = self._getRequest(viewName, q)
         res = self._doInfoReq(req)
         self._checkStatus(res)
-        return res
+        return toModels(res) if models else res
+
+    def iterAlbumList(self, ltype, pageSize=500, prefetch=2, fromYear=None,
+            toYear=None, genre=None, musicFolderId=None):
+        """
+        Pages through an entire getAlbumList() list and yields the albums
+        one at a time.  The next pages are fetched in the background
+        while the current one is consumed.
+
+        pageSize:int        The number of albums to request per page.
+                            Max 500, the server's limit
+        prefetch:int        The max number of pages to fetch ahead.  Set
+                            to 0 to fetch each page only when needed
+
+        See getAlbumList() for the rest of the arguments.  The server
+        doesn't accept offsets past 5000, so at most 5000 + pageSize
+        albums can be listed this way.  Paging stops there, with a
+        warning logged
+        """
+        def fetchPage(offset, size):
+            res = self.getAlbumList(ltype, size, offset, fromYear, toYear,
+                genre, musicFolderId)
+            return asList(res.get('albumList', {}).get('album'))
+
+        return iterPages(fetchPage, min(int(pageSize), MAX_PAGE_SIZE),
+            prefetch, maxOffset=MAX_LIST_OFFSET)
+
+    def iterAlbumList2(self, ltype, pageSize=500, prefetch=2, fromYear=None,
+            toYear=None, genre=None, musicFolderId=None):
+        """
+        Like iterAlbumList(), but pages through getAlbumList2(), which
+        uses ID3 tags for organization
+
+        ex:
+            for album in conn.iterAlbumList2('alphabeticalByName'):
+                print(album['name'])
+        """
+        def fetchPage(offset, size):
+            res = self.getAlbumList2(ltype, size, offset, fromYear, toYear,
+                genre, musicFolderId)
+            return asList(res.get('albumList2', {}).get('album'))
+
+        return iterPages(fetchPage, min(int(pageSize), MAX_PAGE_SIZE),
+            prefetch, maxOffset=MAX_LIST_OFFSET)
 
     def getRandomSongs(self, size=10, genre=None, fromYear=None,
-            toYear=None, musicFolderId=None):
+            toYear=None, musicFolderId=None, models=False):
         """
         since 1.2.0
 
@@ -1273,6 +1949,8 @@ class Connection(object):
         toYear:int          Only return songs before or in this year
         musicFolderId:str   Only return songs in the music folder with the
                             given ID.  See getMusicFolders
+        models:bool         If True, the entities in the response are
+                            libsonic.models objects instead of dicts
 
         Returns a dict like the following:
 
@@ -1318,7 +1996,7 @@ class Connection(object):
         req = self._getRequest(viewName, q)
         res = self._doInfoReq(req)
         self._checkStatus(res)
-        return res
+        return toModels(res) if models else res
 
     def getLyrics(self, artist=None, title=None):
         """
@@ -1395,7 +2073,7 @@ class Connection(object):
         self._checkStatus(res)
         return res
 
-    def getPodcasts(self, incEpisodes=True, pid=None):
+    def getPodcasts(self, incEpisodes=True, pid=None, models=False):
         """
         since: 1.6.0
 
@@ -1406,6 +2084,8 @@ class Connection(object):
                             episodes in the returned result.
         pid:str             (since: 1.9.0) If specified, only return
                             the Podcast channel with this ID.
+        models:bool         If True, the entities in the response are
+                            libsonic.models objects instead of dicts
 
         Returns a dict like the following:
         {u'status': u'ok',
@@ -1458,7 +2138,7 @@ class Connection(object):
         req = self._getRequest(viewName, q)
         res = self._doInfoReq(req)
         self._checkStatus(res)
-        return res
+        return toModels(res) if models else res
 
     def getShares(self):
         """
@@ -1636,7 +2316,24 @@ class Connection(object):
         self._checkStatus(res)
         return res
 
-    def getArtist(self, id):
+    def getArtistsIter(self, musicFolderId=None):
+        """
+        Like getArtists(), but yields the artists one at a time as the
+        response is parsed.  See getIndexesIter()
+
+        ex:
+            for kind, artist in conn.getArtistsIter():
+                print(artist['name'])
+        """
+        methodName = 'getArtists'
+        viewName = '%s.view' % methodName
+
+        q = self._getQueryDict({'musicFolderId': musicFolderId})
+
+        return self._iterResponse(viewName, q,
+            (('artists', 'index', '*', 'artist'),))
+
+    def getArtist(self, id, models=False):
         """
         since 1.8.0
 
@@ -1644,6 +2341,8 @@ class Connection(object):
         the ID3 tags for organization
 
         id:str      The artist ID
+        models:bool    If True, the entities in the response are
+                       libsonic.models objects instead of dicts
 
         Returns a dict like the following:
 
@@ -1679,9 +2378,9 @@ class Connection(object):
         req = self._getRequest(viewName, q)
         res = self._doInfoReq(req)
         self._checkStatus(res)
-        return res
+        return toModels(res) if models else res
 
-    def getAlbum(self, id):
+    def getAlbum(self, id, models=False):
         """
         since 1.8.0
 
@@ -1689,6 +2388,8 @@ class Connection(object):
         the ID3 tags for organization
 
         id:str      The album ID
+        models:bool    If True, the entities in the response are
+                       libsonic.models objects instead of dicts
 
         Returns a dict like the following:
 
@@ -1733,9 +2434,9 @@ class Connection(object):
         req = self._getRequest(viewName, q)
         res = self._doInfoReq(req)
         self._checkStatus(res)
-        return res
+        return toModels(res) if models else res
 
-    def getSong(self, id):
+    def getSong(self, id, models=False):
         """
         since 1.8.0
 
@@ -1743,6 +2444,8 @@ class Connection(object):
         tags for organization
 
         id:str      The song ID
+        models:bool    If True, the entities in the response are
+                       libsonic.models objects instead of dicts
 
         Returns a dict like the following:
             {u'song': {u'album': u'W H O K I L L',
@@ -1779,7 +2482,7 @@ class Connection(object):
         req = self._getRequest(viewName, q)
         res = self._doInfoReq(req)
         self._checkStatus(res)
-        return res
+        return toModels(res) if models else res
 
     def getVideos(self):
         """
@@ -1813,12 +2516,14 @@ class Connection(object):
         self._checkStatus(res)
         return res
 
-    def getStarred(self, musicFolderId=None):
+    def getStarred(self, musicFolderId=None, models=False):
         """
         since 1.8.0
 
         musicFolderId:int   Only return results from the music folder
                             with the given ID. See getMusicFolders
+        models:bool         If True, the entities in the response are
+                            libsonic.models objects instead of dicts
 
         Returns starred songs, albums and artists
 
@@ -1888,14 +2593,16 @@ class Connection(object):
         req = self._getRequest(viewName, q)
         res = self._doInfoReq(req)
         self._checkStatus(res)
-        return res
+        return toModels(res) if models else res
 
-    def getStarred2(self, musicFolderId=None):
+    def getStarred2(self, musicFolderId=None, models=False):
         """
         since 1.8.0
 
         musicFolderId:int   Only return results from the music folder
                             with the given ID. See getMusicFolders
+        models:bool         If True, the entities in the response are
+                            libsonic.models objects instead of dicts
 
         Returns starred songs, albums and artists like getStarred(),
         but this uses ID3 tags for organization
@@ -1914,7 +2621,21 @@ class Connection(object):
         req = self._getRequest(viewName, q)
         res = self._doInfoReq(req)
         self._checkStatus(res)
-        return res
+        return toModels(res) if models else res
+
+    def getStarred2Iter(self, musicFolderId=None):
+        """
+        Like getStarred2(), but yields the starred items one at a time,
+        as (kind, item) tuples with a kind of "artist", "album" or
+        "song", as the response is parsed.  See getIndexesIter()
+        """
+        methodName = 'getStarred2'
+        viewName = '%s.view' % methodName
+
+        q = self._getQueryDict({'musicFolderId': musicFolderId})
+
+        return self._iterResponse(viewName, q, (('starred2', 'artist'),
+            ('starred2', 'album'), ('starred2', 'song')))
 
     def updatePlaylist(self, lid, name=None, comment=None, songIdsToAdd=[],
             songIndexesToRemove=[]):
@@ -2064,7 +2785,8 @@ class Connection(object):
         self._checkStatus(res)
         return res
 
-    def getSongsByGenre(self, genre, count=10, offset=0, musicFolderId=None):
+    def getSongsByGenre(self, genre, count=10, offset=0, musicFolderId=None,
+            models=False):
         """
         since 1.9.0
 
@@ -2076,6 +2798,8 @@ class Connection(object):
         offset:int      The offset if you are paging.  default: 0
         musicFolderId:int   Only return results from the music folder
                             with the given ID. See getMusicFolders
+        models:bool     If True, the entities in the response are
+                        libsonic.models objects instead of dicts
         """
         methodName = 'getSongsByGenre'
         viewName = '%s.view' % methodName
@@ -2089,7 +2813,29 @@ class Connection(object):
         req = self._getRequest(viewName, q)
         res = self._doInfoReq(req)
         self._checkStatus(res)
-        return res
+        return toModels(res) if models else res
+
+    def iterSongsByGenre(self, genre, pageSize=500, prefetch=2,
+            musicFolderId=None):
+        """
+        Pages through all the songs in a genre and yields them one at a
+        time.  The next pages are fetched in the background while the
+        current one is consumed.
+
+        genre:str           The genre, as returned by getGenres()
+        pageSize:int        The number of songs to request per page.
+                            Max 500, the server's limit
+        prefetch:int        The max number of pages to fetch ahead.  Set
+                            to 0 to fetch each page only when needed
+        musicFolderId:int   Only return results from the music folder
+                            with the given ID. See getMusicFolders
+        """
+        def fetchPage(offset, size):
+            res = self.getSongsByGenre(genre, size, offset, musicFolderId)
+            return asList(res.get('songsByGenre', {}).get('song'))
+
+        return iterPages(fetchPage, min(int(pageSize), MAX_PAGE_SIZE),
+            prefetch)
 
     def hls (self, mid, bitrate=None):
         """
@@ -2509,13 +3255,15 @@ class Connection(object):
         self._checkStatus(res)
         return res
 
-    def getNewestPodcasts(self, count=20):
+    def getNewestPodcasts(self, count=20, models=False):
         """
         since 1.13.0
 
         Returns the most recently published Podcast episodes
 
         count:int       The number of episodes to return
+        models:bool     If True, the entities in the response are
+                        libsonic.models objects instead of dicts
         """
         methodName = 'getNewestPodcasts'
         viewName = '%s.view' % methodName
@@ -2525,7 +3273,7 @@ class Connection(object):
         req = self._getRequest(viewName, q)
         res = self._doInfoReq(req)
         self._checkStatus(res)
-        return res
+        return toModels(res) if models else res
 
     def scanMediaFolders(self):
         """
@@ -2647,7 +3395,16 @@ class Connection(object):
     # Private internal methods
     #
     def _getOpener(self, username, passwd):
-        return urllib.request.build_opener()
+        context = None
+        if self._insecure:
+            context = ssl._create_unverified_context()
+        if self._pool is None:
+            return urllib.request.build_opener(
+                urllib.request.HTTPSHandler(context=context))
+        return urllib.request.build_opener(
+            KeepAliveHTTPHandler(self._pool),
+            KeepAliveHTTPSHandler(self._pool, context=context),
+        )
 
     def _getQueryDict(self, d):
         """
@@ -2659,6 +3416,24 @@ class Connection(object):
         return d
 
     def _getBaseQdict(self):
+        return dict(parse_qsl(self._getBaseQuery()))
+
+    def _getBaseQuery(self):
+        """
+        Returns the url encoded query parameters sent with every request:
+        the format, version, client, user and auth.  Only the auth salt
+        and token change between requests, the rest is encoded once
+        """
+        base = self._baseQuery
+        if base is None:
+            with self._lock:
+                base = self._baseQuery = self._buildBaseQuery()
+        static, tokens = base
+        if tokens is None:
+            return static
+        return '%s&%s' % (static, tokens.getQuery())
+
+    def _buildBaseQuery(self):
         qdict = {
             'f': 'json',
             'v': self._apiVersion,
@@ -2666,63 +3441,75 @@ class Connection(object):
             'u': self._username,
         }
 
+        tokens = None
         if self._legacyAuth:
             qdict['p'] = 'enc:%s' % self._hexEnc(self._rawPass)
+        elif self._rawPass:
+            tokens = TokenManager(self._rawPass, self._tokenBatchSize,
+                self._tokenReuseWindow)
         else:
-            if self._rawPass:
-                salt = self._getSalt()
-                token = md5((self._rawPass + salt).encode('utf-8')).hexdigest()
-            else:
-                salt = self._salt
-                token = self._token
             qdict.update({
-                's': salt,
-                't': token,
+                's': self._salt,
+                't': self._token,
             })
 
-        return qdict
-
-    def _getRequest(self, viewName, query={}):
-        qdict = self._getBaseQdict()
-        qdict.update(query)
-        url = '%s:%d/%s/%s' % (self._baseUrl, self._port, self._serverPath,
-            viewName)
-        req = urllib.request.Request(
-            url,
-            urlencode(qdict).encode('utf-8'),
-            headers=self._customHeaders,
-        )
-
+        return urlencode(qdict), tokens
+
+    def _getViewUrl(self, viewName):
+        """
+        Returns the full url for a view.  The urls are built once and
+        kept until the base url, port or server path change
+        """
+        url = self._viewUrls.get(viewName)
+        if url is None:
+            with self._lock:
+                url = '%s:%d/%s/%s' % (self._baseUrl, self._port,
+                    self._serverPath, viewName)
+                self._viewUrls[viewName] = url
+        return url
+
+    def _encodeQuery(self, query, listMap=None):
+        """
+        Url encodes the query dict plus, for each listName: list item of
+        listMap, the list items as repeated listName parameters.  This
+        is done in a single pass, each key being encoded only once
+        """
+        parts = [self._getBaseQuery()]
+        for k, v in query.items():
+            parts.append('%s=%s' % (quote_plus(k), quote_plus(
+                v if isinstance(v, (str, bytes)) else str(v))))
+        if listMap:
+            for k, l in listMap.items():
+                key = '%s=' % quote_plus(k)
+                parts.extend(key + quote_plus(
+                    i if isinstance(i, (str, bytes)) else str(i)) for i in l)
+        return '&'.join(parts)
+
+    def _buildRequest(self, viewName, query, listMap=None):
+        start = None if self._traceSink is None else time.perf_counter()
+        data = self._encodeQuery(query, listMap)
+        url = self._getViewUrl(viewName)
         if self._useGET:
-            url += '?%s' % urlencode(qdict)
-            req = urllib2.Request(url, headers=self._customHeaders)
-
+            req = urllib.request.Request('%s?%s' % (url, data),
+                headers=self._customHeaders)
+        else:
+            req = urllib.request.Request(url, data.encode('utf-8'),
+                headers=self._customHeaders)
+        self._tagRequest(req, viewName, query, listMap)
+        if start is not None:
+            req.span = Span(req.viewName, start=start)
+            req.span.add('build', start, time.perf_counter())
         return req
 
+    def _getRequest(self, viewName, query={}):
+        return self._buildRequest(viewName, query)
+
     def _getRequestWithList(self, viewName, listName, alist, query={}):
         """
         Like _getRequest, but allows appending a number of items with the
         same key (listName).  This bypasses the limitation of urlencode()
         """
-        qdict = self._getBaseQdict()
-        qdict.update(query)
-        url = '%s:%d/%s/%s' % (self._baseUrl, self._port, self._serverPath,
-            viewName)
-        data = StringIO()
-        data.write(urlencode(qdict))
-        for i in alist:
-            data.write('&%s' % urlencode({listName: i}))
-        req = urllib.request.Request(
-            url,
-            data.getvalue().encode('utf-8'),
-            headers=self._customHeaders,
-        )
-
-        if self._useGET:
-            url += '?%s' % data.getvalue()
-            req = urllib2.Request(url, headers=self._customHeaders)
-
-        return req
+        return self._buildRequest(viewName, query, {listName: alist})
 
     def _getRequestWithLists(self, viewName, listMap, query={}):
         """
@@ -2734,47 +3521,570 @@ class Connection(object):
         listMap:dict        A mapping of listName to a list of entries
         query:dict          The normal query dict
         """
-        qdict = self._getBaseQdict()
-        qdict.update(query)
-        url = '%s:%d/%s/%s' % (self._baseUrl, self._port, self._serverPath,
-            viewName)
-        data = StringIO()
-        data.write(urlencode(qdict))
-        for k, l in listMap.items():
-            for i in l:
-                data.write('&%s' % urlencode({k: i}))
-        req = urllib.request.Request(
-            url,
-            data.getvalue().encode('utf-8'),
-            headers=self._customHeaders,
-        )
-
-        if self._useGET:
-            url += '?%s' % data.getvalue()
-            req = urllib2.Request(url, headers=self._customHeaders)
+        return self._buildRequest(viewName, query, listMap)
+
+    def _tagRequest(self, req, viewName, query, queryLists=None):
+        """
+        Attaches the view name (without the ".view") and the query,
+        minus the auth parameters, to a request for use by the cache
+        """
+        if viewName.endswith('.view'):
+            viewName = viewName[:-5]
+        req.viewName = viewName
+        req.query = query
+        req.queryLists = queryLists
+
+    def _getRequestKey(self, req):
+        """
+        Returns a key identifying the request by user, view and query,
+        ignoring the per-request auth salt and token
+        """
+        query = tuple(sorted((k, str(v)) for k, v in req.query.items()))
+        if req.queryLists:
+            query += tuple((k, str(i)) for k, l in req.queryLists.items()
+                for i in l)
+        return (self._username, req.viewName, query)
+
+    def _open(self, req):
+        """
+        Opens the request, or returns the response from the cache if
+        there is one.  Responses for cacheable views are stored by
+        _cacheStore() after their status has been checked
+        """
+        cache = self._cache
+        viewName = getattr(req, 'viewName', None)
+        if cache is None or viewName is None:
+            return self._urlopen(req)
+
+        if cache.getTtl(viewName) is None:
+            try:
+                return self._urlopen(req)
+            finally:
+                cache.invalidateFor(viewName, self._getRequestKey(req)[2])
+        if cacheBypassed.get():
+            return self._urlopen(req)
+
+        req.cacheKey = self._getRequestKey(req)
+        req.cacheGeneration = cache.getGeneration(viewName)
+        hit = cache.get(req.cacheKey)
+        if hit is not None:
+            res = addinfourl(BytesIO(hit[1]), hit[0], req.full_url, 200)
+            res.fromCache = True
+            return res
+        if viewName == 'getIndexes' and hasattr(cache, 'getStale'):
+            stale = cache.getStale(req.cacheKey)
+            if stale is not None:
+                return self._revalidateIndexes(req, stale)
+        return self._urlopen(req)
+
+    def _isCoalesced(self, req, binary=False):
+        """
+        Returns True if the request can share its response with identical
+        concurrent requests: a read request without a Range header
+        """
+        viewName = getattr(req, 'viewName', None)
+        if self._inflight is None or viewName is None or \
+                req.has_header('Range'):
+            return False
+        if binary:
+            return viewName in COALESCED_BINARY_VIEWS
+        return viewName.startswith(('get', 'search')) or viewName == 'ping'
+
+    def _openShared(self, req):
+        """
+        Opens the request, unless an identical one is already in flight,
+        and returns a buffered copy of the response
+        """
+        def fetch():
+            res = self._open(req)
+            with res, tracePhase(getattr(req, 'span', None), 'body'):
+                body = res.read()
+            return (res.info(), body, res.url, res.status,
+                getattr(res, 'fromCache', False))
+
+        info, body, url, status, fromCache = self._inflight.do(
+            self._getRequestKey(req), fetch)
+        res = addinfourl(BytesIO(body), info, url, status)
+        res.fromCache = fromCache
+        return res
 
-        return req
+    def _urlopen(self, req):
+        """
+        Sends the request to the server, through the circuit breaker of
+        its endpoint group, the rate limiter and, outside of the
+        interactive lane, the concurrency limiter
+        """
+        viewName = getattr(req, 'viewName', None)
+        if viewName is None:
+            return self._opener.open(req)
+        lane = currentLane.get()
+        limiter = self._limiter
+        slot = limiter is not None and lane != 'interactive'
+        if self._rateLimiter is not None or slot:
+            with tracePhase(getattr(req, 'span', None), 'queue'):
+                if self._rateLimiter is not None:
+                    self._rateLimiter.acquire(lane)
+                if slot:
+                    limiter.acquire()
+        # The breaker is asked last, right before sending, so a half open
+        # breaker's trial slot is always recorded
+        breaker = self._getBreaker(viewName)
+        allowed = False
+        start = time.monotonic()
+        failed = False
+        try:
+            if breaker is not None:
+                breaker.allow()
+            allowed = True
+            start = time.monotonic()
+            if self._pool is None:
+                # Without the keep-alive pool, the socket setup isn't
+                # broken down
+                with tracePhase(getattr(req, 'span', None), 'ttfb'):
+                    return self._opener.open(req)
+            return self._opener.open(req)
+        except Exception as e:
+            failed = isTransient(e)
+            raise
+        finally:
+            duration = time.monotonic() - start
+            if not allowed:
+                if slot:
+                    limiter.release()
+            else:
+                if breaker is not None:
+                    breaker.record(failed, duration)
+                if slot:
+                    limiter.release(duration, failed, viewName)
+                elif limiter is not None:
+                    limiter.record(duration, failed, viewName)
+
+    def _getBreaker(self, viewName):
+        if self._breakerArgs is None:
+            return None
+        group = getEndpointGroup(viewName)
+        breaker = self._breakers.get(group)
+        if breaker is None:
+            with self._lock:
+                breaker = self._breakers.get(group)
+                if breaker is None:
+                    breaker = self._breakers[group] = CircuitBreaker(group,
+                        **self._breakerArgs)
+        return breaker
+
+    def _revalidateIndexes(self, req, stale):
+        """
+        Revalidates an expired, persistently cached getIndexes response
+        by asking the server for the indexes only if they were modified
+        since the cached lastModified.  If they weren't, the cached
+        response is refreshed and returned
+        """
+        headers, body, fetched = stale
+        try:
+            lastModified = self._decoder.loadsResponse(body)['indexes'][
+                'lastModified']
+        except (ValueError, KeyError, TypeError):
+            return self._urlopen(req)
+
+        q = dict(req.query)
+        q['ifModifiedSince'] = lastModified
+        revalidation = self._getRequest('getIndexes.view', q)
+        revalidation.span = getattr(req, 'span', None)
+        res = self._urlopen(revalidation)
+        newBody = res.read()
+        dres = self._decoder.loadsResponse(newBody)
+        indexes = dres.get('indexes', {})
+        if dres.get('status') == 'ok' and not any(k in indexes
+                for k in ('index', 'shortcut', 'child')):
+            # Not modified, the cached copy is still good
+            logger.debug('Revalidated cached getIndexes response')
+            self._cache.touch(req.cacheKey)
+            res = addinfourl(BytesIO(body), headers, req.full_url, 200)
+            res.fromCache = True
+            return res
+        return addinfourl(BytesIO(newBody), res.info(), res.url, res.status)
+
+    def _cacheStore(self, req, res, body, dres=None):
+        """
+        Stores a successful response body for a cacheable request.  If
+        the cache stores entities (see SQLiteCache.storeEntities()), the
+        decoded response dres is handed to it whether or not the view
+        is cacheable
+        """
+        if getattr(res, 'fromCache', False):
+            return
+        if dres is not None and hasattr(self._cache, 'storeEntities') \
+                and not cacheBypassed.get():
+            self._cache.storeEntities(getattr(req, 'viewName', None), dres)
+        if getattr(req, 'cacheKey', None) is None:
+            return
+        self._cache.set(req.cacheKey, res.info(), body,
+            req.cacheGeneration)
+
+    def _iterResponse(self, viewName, query, targets):
+        """
+        Makes the request and yields the items of the target lists of the
+        response as it is parsed.  See libsonic.jsonstream
+        """
+        req = self._getRequest(viewName, query)
+        rec = self._startRecord(req)
+        try:
+            res = self._openStream(req)
+            self._markResponse(req, res)
+            if rec is not None:
+                rec.bytesIn = int(res.info().get('Content-Length') or 0)
+            with res:
+                for key, item in iterResponse(res, targets,
+                        self._checkStatus):
+                    yield key, normalizeTimestamps(item)
+                # Read the end of the body (ex: the last chunk) so a
+                # pooled connection can be reused
+                res.read()
+        except Exception as e:
+            self._markError(rec, e)
+            raise
+        finally:
+            self._finishRecord(rec, req)
+
+    def _openStream(self, req):
+        return self._withRetries(req, self._open)
+
+    def _withRetries(self, req, func):
+        """
+        Returns func(req), retried according to the retry policy
+        """
+        policy = self._retryPolicy
+        viewName = getattr(req, 'viewName', None)
+        if policy is None or not policy.appliesTo(viewName):
+            return func(req)
+        return policy.call(lambda: func(req), viewName)
+
+    def _openRead(self, req):
+        if self._isCoalesced(req):
+            # The body is already read, see _openShared()
+            res = self._openShared(req)
+            self._markResponse(req, res)
+            with res:
+                return res, res.read()
+        res = self._open(req)
+        self._markResponse(req, res)
+        with res, tracePhase(getattr(req, 'span', None), 'body'):
+            return res, res.read()
+
+    def _openBin(self, req):
+        if self._isCoalesced(req, True):
+            res = self._openShared(req)
+        else:
+            res = self._open(req)
+        self._markResponse(req, res)
+        return res
 
     def _doInfoReq(self, req):
-        # Returns a parsed dictionary version of the result
-        res = self._opener.open(req)
-        dres = json.loads(res.read().decode('utf-8'))
-        return dres['subsonic-response']
+        # Returns a parsed dictionary version of the result.  Failures
+        # while reading the body are retried too
+        rec = self._startRecord(req)
+        try:
+            res, body = self._withRetries(req, self._openRead)
+            dres = self._decodeResponse(body, req)
+            if rec is not None:
+                rec.bytesIn = len(body)
+                rec.error = self._getErrorName(dres)
+            if dres.get('status') == 'ok':
+                self._cacheStore(req, res, body, dres)
+            return dres
+        except Exception as e:
+            self._markError(rec, e)
+            raise
+        finally:
+            self._finishRecord(rec, req)
+
+    def _decodeResponse(self, body, req=None):
+        """
+        Decodes a response body and converts its timestamps, see
+        libsonic.decoders.normalizeTimestamps().  The decoding time is
+        recorded in the record and span of req, if any
+        """
+        rec = getattr(req, 'record', None)
+        span = getattr(req, 'span', None)
+        if rec is None and span is None:
+            return normalizeTimestamps(self._decoder.loadsResponse(body),
+                body)
+        start = time.perf_counter()
+        data = self._decoder.loadsResponse(body)
+        decoded = time.perf_counter()
+        data = normalizeTimestamps(data, body)
+        if rec is not None:
+            rec.decode = decoded - start
+        if span is not None:
+            span.add('decode', start, decoded)
+            span.add('postprocess', decoded, time.perf_counter())
+        return data
 
     def _doBinReq(self, req):
-        res = self._opener.open(req)
-        info = res.info()
-        if hasattr(info, 'getheader'):
-            contType = info.getheader('Content-Type')
-        else:
-            contType = info.get('Content-Type')
+        rec = self._startRecord(req)
+        try:
+            res = self._withRetries(req, self._openBin)
+            info = res.info()
+            if hasattr(info, 'getheader'):
+                contType = info.getheader('Content-Type')
+            else:
+                contType = info.get('Content-Type')
+
+            if contType:
+                if contType.startswith('text/html') or \
+                        contType.startswith('application/json'):
+                    body = res.read()
+                    dres = self._decodeResponse(body, req)
+                    if rec is not None:
+                        rec.bytesIn = len(body)
+                        rec.error = self._getErrorName(dres)
+                    return dres
+            if getattr(req, 'cacheKey', None) is not None and \
+                    not getattr(res, 'fromCache', False):
+                # Buffer the body so it can be cached
+                body = res.read()
+                self._cacheStore(req, res, body)
+                res = addinfourl(BytesIO(body), info, res.url, res.status)
+            if rec is not None:
+                # The body is left to the caller, go by its announced size
+                rec.bytesIn = int(info.get('Content-Length') or 0)
+            return res
+        except Exception as e:
+            self._markError(rec, e)
+            raise
+        finally:
+            self._finishRecord(rec, req)
+
+    def _startRecord(self, req):
+        """
+        Returns a new RequestRecord for the call making the request, after
+        running the pre request hooks, or None if nothing is collecting
+        them.  The record is attached to the request as req.record
+        """
+        viewName = getattr(req, 'viewName', None)
+        if viewName is None or (self._metrics is None and
+                not self._preHooks and not self._postHooks and
+                self._traceSink is None):
+            return None
+        rec = RequestRecord(viewName, currentLane.get(),
+            len(req.full_url) + len(req.data or b''))
+        req.record = rec
+        span = getattr(req, 'span', None)
+        if span is not None:
+            span.lane = rec.lane
+        self._runHooks(self._preHooks, rec)
+        return rec
+
+    def _markResponse(self, req, res):
+        """
+        Records the arrival of the response headers
+        """
+        rec = getattr(req, 'record', None)
+        if rec is not None:
+            rec.markTtfb()
+            rec.status = res.status
+            rec.fromCache = getattr(res, 'fromCache', False)
+
+    def _markError(self, rec, e):
+        if rec is not None:
+            rec.error = type(e).__name__
+            if isinstance(e, urllib.error.HTTPError):
+                rec.status = e.code
+
+    def _finishRecord(self, rec, req):
+        """
+        Completes the record of a call, adds it to the metrics, runs the
+        post request hooks and passes the span of the call to the trace
+        sink
+        """
+        if rec is None:
+            return
+        rec.finish()
+        if self._metrics is not None:
+            self._metrics.observe(rec)
+        self._runHooks(self._postHooks, rec)
+        span = getattr(req, 'span', None)
+        if span is not None and self._traceSink is not None:
+            span.finish(rec)
+            self._runHooks((self._traceSink,), span)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('%s: %s in %.3fs (%.3fs to the headers), %d bytes '
+                'in, %d bytes out%s', rec.view, rec.error or rec.status,
+                rec.total, rec.ttfb, rec.bytesIn, rec.bytesOut,
+                ', from the cache' if rec.fromCache else '')
+
+    def _runHooks(self, hooks, rec):
+        for hook in hooks:
+            try:
+                hook(rec)
+            except Exception:
+                logger.exception('Request hook %r failed', hook)
+
+    def _getErrorName(self, dres):
+        """
+        Returns the name of the exception class for a failed response,
+        see libsonic.errors.ERR_CODE_MAP, or None
+        """
+        if dres.get('status') != 'failed':
+            return None
+        try:
+            return getExcByCode(dres['error']['code']).__name__
+        except (KeyError, TypeError, ValueError):
+            return SonicError.__name__
+
+    def _transferTo(self, viewName, query, path, chunkSize, resume, fsync,
+            progress):
+        offset = 0
+        if resume and os.path.exists(path):
+            offset = os.path.getsize(path)
+
+        start = time.monotonic()
+        req = self._getRequest(viewName, query)
+        if offset:
+            req.add_header('Range', 'bytes=%d-' % offset)
+        try:
+            res = self._doBinReq(req)
+        except urllib.error.HTTPError as e:
+            if e.code != 416 or not offset:
+                raise
+            # Range not satisfiable, we already have the whole file
+            e.close()
+            return self._transferStats(0, offset, offset, start)
+        if isinstance(res, dict):
+            self._checkStatus(res)
 
-        if contType:
-            if contType.startswith('text/html') or \
-                    contType.startswith('application/json'):
-                dres = json.loads(res.read())
-                return dres['subsonic-response']
-        return res
+        size = None
+        contRange = res.info().get('Content-Range')
+        if offset and res.status == 206 and contRange:
+            size = self._parseContentRange(contRange)[2]
+        else:
+            # The server ignored the range, start over
+            offset = 0
+            if res.info().get('Content-Length'):
+                size = int(res.info().get('Content-Length'))
+
+        written = 0
+        buf = bytearray(chunkSize)
+        view = memoryview(buf)
+        with res, open(path, 'ab' if offset else 'wb') as fh:
+            while True:
+                n = res.readinto(buf)
+                if not n:
+                    break
+                fh.write(view[:n])
+                written += n
+                if progress is not None:
+                    progress(offset + written, size)
+            if size is not None and offset + written < size:
+                # The connection dropped, what we got is kept for the
+                # next attempt to resume from
+                fh.flush()
+                raise http_client.IncompleteRead(b'', size - offset - written)
+            if fsync:
+                fh.flush()
+                os.fsync(fh.fileno())
+
+        return self._transferStats(written, offset + written, offset, start)
+
+    def _openSeekable(self, viewName, query):
+        return SeekableRemoteFile(self, viewName, query)
+
+    def _openRange(self, viewName, query, first, last=None):
+        """
+        Requests the given byte range of a binary view, or the whole body
+        if first is None.  Returns the response and the parsed
+        Content-Range, which is None if the server ignored the range and
+        sent the whole body
+        """
+        req = self._getRequest(viewName, query)
+        if first is not None:
+            req.add_header('Range', 'bytes=%d-%s' % (first,
+                '' if last is None else last))
+        res = self._doBinReq(req)
+        if isinstance(res, dict):
+            self._checkStatus(res)
+        contRange = res.info().get('Content-Range')
+        if res.status != 206 or not contRange:
+            return res, None
+        contRange = self._parseContentRange(contRange)
+        if contRange[0] != first:
+            res.close()
+            raise SonicError('Requested the range starting at %d, got %r' %
+                (first, contRange))
+        return res, contRange
+
+    def _preallocate(self, fd, size):
+        if hasattr(os, 'posix_fallocate'):
+            try:
+                os.posix_fallocate(fd, 0, size)
+                return
+            except OSError:
+                # Not supported by the file system
+                pass
+        os.ftruncate(fd, size)
+
+    def _fetchSegment(self, viewName, query, rng, writer, chunkSize,
+            retries, onChunk, res=None):
+        """
+        Fetches the inclusive byte range rng into writer, resuming from
+        where it stopped on errors.  res is an already open response
+        positioned at the start of the range
+        """
+        pos, last = rng
+        buf = bytearray(chunkSize)
+        view = memoryview(buf)
+        attempt = 0
+        while pos <= last:
+            try:
+                if res is None:
+                    res, contRange = self._openRange(viewName, query, pos,
+                        last)
+                    if contRange is None:
+                        res.close()
+                        raise SonicError('The server stopped honoring '
+                            'Range requests')
+                with res:
+                    while pos <= last:
+                        n = res.readinto(view[:min(chunkSize,
+                            last + 1 - pos)])
+                        if not n:
+                            raise http_client.IncompleteRead(b'',
+                                last + 1 - pos)
+                        writer.write(view[:n], pos)
+                        pos += n
+                        onChunk(n)
+            except (OSError, http_client.HTTPException) as e:
+                if attempt >= retries:
+                    raise
+                attempt += 1
+                logger.debug('Retrying the range %d-%d: %s', pos, last, e)
+            finally:
+                res = None
+
+    def _parseContentRange(self, value):
+        """
+        Parses a "Content-Range: bytes <start>-<end>/<size>" header value
+        and returns a (start, end, size) tuple.  The size is None if the
+        server sent "*"
+        """
+        try:
+            unit, rest = value.split(None, 1)
+            span, size = rest.split('/', 1)
+            start, end = span.split('-', 1)
+            return (int(start), int(end),
+                None if size.strip() == '*' else int(size))
+        except ValueError:
+            raise SonicError('Invalid Content-Range header: %r' % value)
+
+    def _transferStats(self, nbytes, size, offset, start):
+        elapsed = time.monotonic() - start
+        return {
+            'bytes': nbytes,
+            'size': size,
+            'offset': offset,
+            'elapsed': elapsed,
+            'bytesPerSec': nbytes / elapsed if elapsed > 0 else 0.0,
+        }
 
     def _checkStatus(self, result):
         if result['status'] == 'ok':
@@ -2812,22 +4122,12 @@ class Connection(object):
 
     def _fixLastModified(self, data):
         """
-        This will recursively walk through a data structure and look for
-        a dict key/value pair where the key is "lastModified" and change
-        the shitty java millisecond timestamp to a real unix timestamp
-        of SECONDS since the unix epoch.  JAVA SUCKS!
-        """
-        if isinstance(data, dict):
-            for k, v in list(data.items()):
-                if k == 'lastModified':
-                    data[k] = int(v) / 1000.0
-                    return
-                elif isinstance(v, (tuple, list, dict)):
-                    return self._fixLastModified(v)
-        elif isinstance(data, (list, tuple)):
-            for item in data:
-                if isinstance(item, (list, tuple, dict)):
-                    return self._fixLastModified(item)
+        Converts the java millisecond timestamps in a response to unix
+        timestamps of SECONDS since the unix epoch.  The responses are
+        already converted as they are decoded, so this is only kept for
+        responses obtained some other way
+        """
+        normalizeTimestamps(data)
 
     def _process_netrc(self, use_netrc):
         """
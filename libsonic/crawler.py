@@ -0,0 +1,294 @@
+"""
+This file is part of py-sonic.
+
+py-sonic is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+py-sonic is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with py-sonic.  If not, see <http://www.gnu.org/licenses/>
+
+A concurrent crawler for walking an entire Subsonic library.
+
+    crawler = LibraryCrawler(conn, maxWorkers=16,
+        checkpoint='/var/tmp/crawl.json')
+    for kind, record in crawler.crawl():
+        if kind == 'song':
+            store(record)
+
+The crawl walks either the ID3 tree (getArtists -> getArtist ->
+getAlbum) or the folder tree (getIndexes -> getMusicDirectory) and
+yields the records as they arrive.  The remaining work is saved to the
+checkpoint file as the crawl goes, so a crawl which crashed or was
+stopped picks up where it left off.  Records are delivered at least
+once: the records of the last few requests before a crash may be
+yielded again on resume.
+"""
+
+from libsonic.errors import CircuitOpenError, DataNotFoundError
+from libsonic.paging import asList
+from libsonic.retry import isTransient
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from collections import deque
+from http import client as http_client
+from urllib.error import URLError
+
+import contextvars
+import json
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# The errors a request is retried on
+RETRY_ERRORS = (URLError, OSError, http_client.HTTPException, ValueError,
+    CircuitOpenError)
+
+MODES = ('id3', 'folder')
+
+
+class LibraryCrawler(object):
+    def __init__(self, conn, mode='id3', maxWorkers=8, retries=3,
+            retryBackoff=0.5, progress=None, checkpoint=None,
+            checkpointInterval=5.0, musicFolderId=None, skipErrors=False):
+        """
+        conn:Connection         The connection to crawl with
+        mode:str                "id3" to walk the ID3 tree, yielding
+                                "artist", "album" and "song" records, or
+                                "folder" to walk the folder tree,
+                                yielding "artist", "directory" and
+                                "song" records
+        maxWorkers:int          The max number of requests in flight
+        retries:int             The number of times a failed request is
+                                retried, with exponential backoff.  If
+                                conn has a retry policy, the transient
+                                errors it already retried aren't
+                                retried again here
+        retryBackoff:float      The delay before the first retry, in
+                                seconds.  It doubles on each retry
+        progress:callable       If set, this is called with a dict of
+                                the crawl stats (see stats()) every time
+                                a request completes
+        checkpoint:str          The path to a checkpoint file.  If it
+                                exists, the crawl resumes from it.  It is
+                                removed once the crawl completes
+        checkpointInterval:float    The min number of seconds between
+                                    checkpoint saves
+        musicFolderId:int       Only crawl the given music folder
+        skipErrors:bool         If True, requests which still fail after
+                                all retries are skipped (and listed in
+                                the "failed" attribute) instead of
+                                stopping the crawl
+        """
+        if mode not in MODES:
+            raise ValueError('mode must be one of %s: %r' % (MODES, mode))
+        self.conn = conn
+        self.mode = mode
+        self.maxWorkers = int(maxWorkers)
+        self.retries = int(retries)
+        self.retryBackoff = retryBackoff
+        self.progress = progress
+        self.checkpoint = checkpoint
+        self.checkpointInterval = checkpointInterval
+        self.musicFolderId = musicFolderId
+        self.skipErrors = skipErrors
+        self.failed = []
+        self._counts = {}
+        self._pending = 0
+        self._started = None
+        self._lock = threading.Lock()
+
+    def stats(self):
+        """
+        Returns a dict of the crawl counters, like the following:
+
+        {'artist': 12, 'album': 103, 'song': 1201, 'requests': 116,
+         'retries': 0, 'failed': 0, 'pending': 48, 'elapsed': 3.2}
+        """
+        with self._lock:
+            ret = dict(self._counts)
+        ret['pending'] = self._pending
+        ret['failed'] = len(self.failed)
+        ret['elapsed'] = time.monotonic() - self._started \
+            if self._started else 0.0
+        return ret
+
+    def crawl(self):
+        """
+        Yields (kind, record) tuples for every artist, album (or
+        directory) and song in the library as they are fetched
+        """
+        frontier = deque()
+        state = self._loadCheckpoint()
+        if state:
+            frontier.extend(tuple(t) for t in state['pending'])
+            self._counts = state['counts']
+            logger.info('Resuming crawl with %d pending requests',
+                len(frontier))
+        else:
+            frontier.append(('root', None))
+            self._counts = {'requests': 0, 'retries': 0}
+        self._started = time.monotonic()
+        lastSave = time.monotonic()
+
+        executor = ThreadPoolExecutor(self.maxWorkers)
+        inflight = {}
+        # The task whose records are being yielded
+        current = []
+        try:
+            while frontier or inflight:
+                while frontier and len(inflight) < self.maxWorkers:
+                    task = frontier.popleft()
+                    # Run in the caller's context, for its lane and cache
+                    # bypass
+                    ctx = contextvars.copy_context()
+                    inflight[executor.submit(ctx.run, self._runTask,
+                        task)] = task
+                done, _ = wait(inflight, return_when=FIRST_COMPLETED)
+                for fut in done:
+                    task = inflight.pop(fut)
+                    try:
+                        records, children = fut.result()
+                    except Exception as e:
+                        if not self.skipErrors:
+                            frontier.appendleft(task)
+                            raise
+                        logger.warning('Skipping %s %s: %s', task[0],
+                            task[1], e)
+                        self.failed.append((task, e))
+                        continue
+                    current = [task]
+                    for kind, record in records:
+                        self._count(kind)
+                        yield kind, record
+                    current = []
+                    frontier.extend(children)
+                    self._pending = len(frontier) + len(inflight)
+                    if self.progress is not None:
+                        self.progress(self.stats())
+                now = time.monotonic()
+                if self.checkpoint and \
+                        now - lastSave > self.checkpointInterval:
+                    self._saveCheckpoint(list(inflight.values()) +
+                        list(frontier))
+                    lastSave = now
+        except BaseException:
+            # Crashed or the caller stopped consuming; save what's left
+            # so the crawl can be resumed
+            if self.checkpoint:
+                self._saveCheckpoint(current + list(inflight.values()) +
+                    list(frontier))
+            raise
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+        if self.checkpoint and os.path.exists(self.checkpoint):
+            os.remove(self.checkpoint)
+
+    def _runTask(self, task):
+        """
+        Runs the request for a task, with retries.  Returns a tuple of
+        the list of (kind, record) tuples and the list of child tasks
+        """
+        for attempt in range(self.retries + 1):
+            try:
+                self._count('requests')
+                with self.conn.lane('bulk'):
+                    return self._fetch(*task)
+            except DataNotFoundError:
+                # Removed from the library since its parent was fetched
+                return [], []
+            except RETRY_ERRORS as e:
+                if attempt == self.retries or not self._isRetryable(e):
+                    raise
+                self._count('retries')
+                delay = max(self.retryBackoff * 2 ** attempt,
+                    getattr(e, 'retryAfter', 0))
+                logger.debug('Retrying %s %s in %.1fs: %s', task[0], task[1],
+                    delay, e)
+                time.sleep(delay)
+
+    def _isRetryable(self, e):
+        """
+        Returns False for the errors the connection's own retry policy
+        already gave up on, so the two don't multiply
+        """
+        return self.conn.retryPolicy is None or not isTransient(e)
+
+    def _count(self, key):
+        with self._lock:
+            self._counts[key] = self._counts.get(key, 0) + 1
+
+    def _fetch(self, kind, tid):
+        conn = self.conn
+        records = []
+        children = []
+        if kind == 'root' and self.mode == 'id3':
+            res = conn.getArtists(self.musicFolderId)
+            for index in asList(res.get('artists', {}).get('index')):
+                children.extend(('artist', a['id'])
+                    for a in asList(index.get('artist')))
+        elif kind == 'artist':
+            artist = dict(conn.getArtist(tid).get('artist', {}))
+            albums = asList(artist.pop('album', None))
+            records.append(('artist', artist))
+            children.extend(('album', a['id']) for a in albums)
+        elif kind == 'album':
+            album = dict(conn.getAlbum(tid).get('album', {}))
+            songs = asList(album.pop('song', None))
+            records.append(('album', album))
+            records.extend(('song', s) for s in songs)
+        elif kind == 'root':
+            res = conn.getIndexes(self.musicFolderId)
+            indexes = res.get('indexes', {})
+            for index in asList(indexes.get('index')):
+                for artist in asList(index.get('artist')):
+                    records.append(('artist', artist))
+                    children.append(('directory', artist['id']))
+            # Entries at the root of the music folders, outside of any
+            # index: the directories are crawled like the artists' ones
+            for entry in asList(indexes.get('child')):
+                if entry.get('isDir'):
+                    children.append(('directory', entry['id']))
+                else:
+                    records.append(('song', entry))
+        elif kind == 'directory':
+            directory = dict(conn.getMusicDirectory(tid).get('directory',
+                {}))
+            entries = asList(directory.pop('child', None))
+            records.append(('directory', directory))
+            for entry in entries:
+                if entry.get('isDir'):
+                    children.append(('directory', entry['id']))
+                else:
+                    records.append(('song', entry))
+        return records, children
+
+    def _loadCheckpoint(self):
+        if not self.checkpoint or not os.path.exists(self.checkpoint):
+            return None
+        with open(self.checkpoint) as fh:
+            state = json.load(fh)
+        if state.get('mode') != self.mode:
+            raise ValueError('The checkpoint %s is for a %r crawl' % (
+                self.checkpoint, state.get('mode')))
+        return state
+
+    def _saveCheckpoint(self, pending):
+        state = {
+            'mode': self.mode,
+            'pending': pending,
+            'counts': self._counts,
+        }
+        tmp = '%s.tmp' % self.checkpoint
+        with open(tmp, 'w') as fh:
+            json.dump(state, fh)
+        os.replace(tmp, self.checkpoint)
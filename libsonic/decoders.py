@@ -0,0 +1,225 @@
+"""
+This file is part of py-sonic.
+
+py-sonic is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+py-sonic is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with py-sonic.  If not, see <http://www.gnu.org/licenses/>
+
+JSON decoding backends for the API responses.
+
+Connection uses the fastest installed backend by default, in the order
+of DECODERS.  A specific one can be picked by name:
+
+    conn = Connection(url, user, passwd, jsonDecoder='ujson')
+
+or any object with the loads() and loadsResponse() methods of
+JSONDecoder can be passed.  The response bodies are always handed to
+the decoder as bytes.
+
+The decoded responses are then passed through normalizeTimestamps(),
+which converts the java millisecond timestamps to unix timestamps.
+"""
+
+import json
+import re
+
+# Matches the start of a response, up to its inner object
+_WRAPPER_RE = re.compile(rb'\s*\{\s*"subsonic-response"\s*:\s*')
+
+
+def _innerSpan(data):
+    """
+    Returns the (start, end) offsets of the object wrapped in
+    "subsonic-response" in a response body, or None if the body doesn't
+    look like a response
+    """
+    m = _WRAPPER_RE.match(data)
+    if m is None:
+        return None
+    end = data.rfind(b'}')
+    if end <= m.end():
+        return None
+    return m.end(), end
+
+
+class JSONDecoder(object):
+    """
+    The stdlib json backend
+    """
+    name = 'json'
+
+    def __init__(self, skipWrapper=True):
+        """
+        skipWrapper:bool    If True, loadsResponse() decodes the
+                            response's inner object only, without
+                            building the outer "subsonic-response" dict
+        """
+        self.skipWrapper = skipWrapper
+        self._decoder = json.JSONDecoder()
+
+    def loads(self, data):
+        """
+        Decodes a JSON document
+
+        data:bytes      The JSON document
+        """
+        return json.loads(data)
+
+    def loadsResponse(self, data):
+        """
+        Decodes an API response body and returns the object wrapped in
+        "subsonic-response"
+
+        data:bytes      The response body
+        """
+        if self.skipWrapper:
+            span = _innerSpan(data)
+            if span is not None:
+                try:
+                    return self._loadsSpan(data, *span)
+                except ValueError:
+                    # Not the usual layout, decode the whole thing
+                    pass
+        return self.loads(data)['subsonic-response']
+
+    def _loadsSpan(self, data, start, end):
+        # The wrapper is ascii, so start is the same offset in the str
+        text = data.decode('utf-8')
+        obj, objEnd = self._decoder.raw_decode(text, start)
+        if text[objEnd:].strip() != '}':
+            raise ValueError('Trailing data after the response object')
+        return obj
+
+
+class OrjsonDecoder(JSONDecoder):
+    name = 'orjson'
+
+    def __init__(self, skipWrapper=True):
+        import orjson
+        super().__init__(skipWrapper)
+        self._loads = orjson.loads
+
+    def loads(self, data):
+        return self._loads(data)
+
+    def _loadsSpan(self, data, start, end):
+        # orjson reads memoryviews, so slicing the body costs no copy
+        return self._loads(memoryview(data)[start:end])
+
+
+class UjsonDecoder(JSONDecoder):
+    name = 'ujson'
+
+    def __init__(self, skipWrapper=True):
+        import ujson
+        # ujson can't decode part of a buffer, so slicing would cost more
+        # than the wrapper dict
+        super().__init__(False)
+        self._loads = ujson.loads
+
+    def loads(self, data):
+        return self._loads(data)
+
+
+class SimdjsonDecoder(JSONDecoder):
+    name = 'simdjson'
+
+    def __init__(self, skipWrapper=True):
+        import simdjson
+        super().__init__(False)
+        self._loads = simdjson.loads
+
+    def loads(self, data):
+        return self._loads(data)
+
+
+# The keys of the timestamp fields.  Only their numeric values are
+# milliseconds, the ISO 8601 strings are left as they are
+TIMESTAMP_KEYS = frozenset((
+    'lastModified',
+    'changed',
+    'created',
+    'starred',
+    'publishDate',
+    'expires',
+    'lastVisited',
+    'lastPlayed',
+    'lastScan',
+    'played',
+))
+
+
+# Matches a timestamp key with a numeric value in a raw body
+_TIMESTAMP_RE = re.compile(rb'"(?:%s)"\s*:\s*-?\d' % b'|'.join(
+    k.encode('ascii') for k in sorted(TIMESTAMP_KEYS)))
+
+
+def normalizeTimestamps(data, body=None):
+    """
+    Converts every millisecond timestamp in a decoded response to a unix
+    timestamp in seconds (a float), in place, and returns the response.
+    This walks the whole structure once, without recursion
+
+    data:dict       The decoded response
+    body:bytes      The raw body data was decoded from.  If passed, the
+                    walk is skipped when the body has no numeric
+                    timestamps, which is the case for most responses
+    """
+    if body is not None and _TIMESTAMP_RE.search(body) is None:
+        return data
+    stack = [data]
+    pop = stack.pop
+    push = stack.append
+    while stack:
+        obj = pop()
+        if obj.__class__ is dict:
+            for k, v in obj.items():
+                cls = v.__class__
+                if cls is dict or cls is list:
+                    push(v)
+                elif (cls is int or cls is float) and k in TIMESTAMP_KEYS:
+                    # Replacing a value doesn't resize the dict, so this
+                    # is safe while iterating
+                    obj[k] = v / 1000.0
+        else:
+            for v in obj:
+                cls = v.__class__
+                if cls is dict or cls is list:
+                    push(v)
+    return data
+
+
+# The backends by preference
+DECODERS = (OrjsonDecoder, SimdjsonDecoder, UjsonDecoder, JSONDecoder)
+
+
+def getDecoder(decoder=None, skipWrapper=True):
+    """
+    Returns a decoder instance
+
+    decoder:str|object  None for the fastest installed backend, a
+                        backend name ("orjson", "simdjson", "ujson" or
+                        "json") or a decoder instance, which is returned
+                        as is
+    skipWrapper:bool    See JSONDecoder
+    """
+    if decoder is not None and not isinstance(decoder, str):
+        return decoder
+    for cls in DECODERS:
+        if decoder is not None and cls.name != decoder:
+            continue
+        try:
+            return cls(skipWrapper)
+        except ImportError:
+            if decoder is not None:
+                raise
+    raise ValueError('Unknown JSON decoder: %r' % decoder)
@@ -0,0 +1,280 @@
+"""
+This file is part of py-sonic.
+
+py-sonic is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+py-sonic is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with py-sonic.  If not, see <http://www.gnu.org/licenses/>
+
+A parallel, multi-file download manager.
+
+    manager = DownloadManager(conn, workers=8,
+        maxBytesPerSec=20 * 1024 * 1024)
+    for entry in manager.downloadAlbum(albumId, '/srv/mirror'):
+        if entry['error']:
+            print(entry['id'], entry['error'])
+
+Files are written to a "<path>.part" temp file which is renamed into
+place once complete, so a file at its final path is always whole.  A
+failed transfer is retried with exponential backoff, resuming from the
+end of the temp file.  The manager shares the connection between its
+workers, so the connection's poolSize should be at least the number of
+workers.
+"""
+
+from libsonic.errors import CircuitOpenError
+from libsonic.paging import asList
+from libsonic.retry import isTransient
+from concurrent.futures import ThreadPoolExecutor
+from http import client as http_client
+from urllib.error import HTTPError, URLError
+
+import logging
+import os
+import re
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# The errors a transfer is retried on
+RETRY_ERRORS = (URLError, OSError, http_client.HTTPException,
+    CircuitOpenError)
+
+# HTTP errors which are worth retrying, everything else 4xx is final
+RETRY_HTTP_CODES = (408, 429)
+
+PART_SUFFIX = '.part'
+
+
+class Throttle(object):
+    def __init__(self, bytesPerSec):
+        """
+        A thread safe token bucket limiting the combined rate of all the
+        callers of consume().  Up to one second worth of bytes can be
+        consumed in a burst
+
+        bytesPerSec:int     The max rate
+        """
+        self.rate = float(bytesPerSec)
+        self._tokens = self.rate
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def consume(self, nbytes):
+        """
+        Takes nbytes from the bucket, sleeping as long as needed to stay
+        under the rate
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.rate,
+                self._tokens + (now - self._last) * self.rate)
+            self._last = now
+            self._tokens -= nbytes
+            wait = -self._tokens / self.rate
+        if wait > 0:
+            time.sleep(wait)
+
+
+def defaultPath(song):
+    """
+    The default mapping of a song to its path under the destination
+    directory: the song's "path" if the server reports one, else its id
+    plus its suffix
+    """
+    path = song.get('path')
+    if path:
+        return path
+    if song.get('suffix'):
+        return '%s.%s' % (song['id'], song['suffix'])
+    return str(song['id'])
+
+
+class DownloadManager(object):
+    def __init__(self, conn, workers=4, maxBytesPerSec=None, retries=3,
+            retryBackoff=1.0, chunkSize=256 * 1024, pathFunc=defaultPath,
+            overwrite=False, maxBitRate=None, tformat=None, fsync=False,
+            progress=None):
+        """
+        conn:Connection         The connection to download with
+        workers:int             The number of concurrent downloads
+        maxBytesPerSec:int      If set, the combined download rate of
+                                all the workers is kept under this
+        retries:int             The number of times a failed download is
+                                retried, with exponential backoff.  If
+                                conn has a retry policy, the transient
+                                errors opening the download, which it
+                                already retried, aren't retried again
+                                here
+        retryBackoff:float      The delay before the first retry, in
+                                seconds.  It doubles on each retry
+        chunkSize:int           The number of bytes read and written at a
+                                time
+        pathFunc:callable       Called with a song dict, it returns the
+                                path of the song relative to the
+                                destination directory.  See defaultPath()
+        overwrite:bool          If False, songs whose file already exists
+                                are skipped
+        maxBitRate:int          If set (or if tformat is set), songs are
+                                fetched with stream() and possibly
+                                transcoded, instead of with download()
+        tformat:str             The format to transcode to.  See stream()
+        fsync:bool              If True, each file is fsync()ed before it
+                                is renamed into place
+        progress:callable       If set, this is called with the report
+                                entry of each file as it completes
+        """
+        self.conn = conn
+        self.workers = int(workers)
+        self.throttle = Throttle(maxBytesPerSec) if maxBytesPerSec else None
+        self.retries = int(retries)
+        self.retryBackoff = retryBackoff
+        self.chunkSize = int(chunkSize)
+        self.pathFunc = pathFunc
+        self.overwrite = overwrite
+        self.maxBitRate = maxBitRate
+        self.tformat = tformat
+        self.fsync = fsync
+        self.progress = progress
+
+    def download(self, songs, destDir):
+        """
+        Downloads the given songs into destDir and returns a report, a
+        list with an entry per song, in order, like the following:
+
+        {'id': '123', 'path': '/srv/mirror/Artist/Album/01.flac',
+         'status': 'ok', 'bytes': 31337000, 'attempts': 1,
+         'elapsed': 1.2, 'bytesPerSec': 26114166.7, 'error': None}
+
+        The status is one of "ok", "skipped" (the file exists) or
+        "failed", in which case "error" holds the exception
+
+        songs:list      A list of song ids or song dicts, as returned by
+                        getAlbum(), getPlaylist(), etc.
+        destDir:str     The directory to download to
+        """
+        songs = [s if isinstance(s, dict) else {'id': s}
+            for s in asList(songs)]
+        with ThreadPoolExecutor(self.workers) as executor:
+            return list(executor.map(
+                lambda song: self._downloadSong(song, destDir), songs))
+
+    def downloadAlbum(self, albumId, destDir):
+        """
+        Downloads all the songs of an album (as returned by getAlbum()).
+        See download() for the report
+
+        albumId:int     The album id
+        destDir:str     The directory to download to
+        """
+        res = self.conn.getAlbum(albumId)
+        return self.download(asList(res.get('album', {}).get('song')),
+            destDir)
+
+    def downloadPlaylist(self, playlistId, destDir):
+        """
+        Downloads all the songs of a playlist.  See download() for the
+        report
+
+        playlistId:str  The playlist id
+        destDir:str     The directory to download to
+        """
+        res = self.conn.getPlaylist(playlistId)
+        return self.download(asList(res.get('playlist', {}).get('entry')),
+            destDir)
+
+    def _getPath(self, song, destDir):
+        destDir = os.path.abspath(destDir)
+        path = os.path.normpath(os.path.join(destDir,
+            self.pathFunc(song).lstrip('/')))
+        if os.path.commonpath((destDir, path)) == destDir and \
+                path != destDir:
+            return path
+        # Don't let the server write outside of destDir
+        return os.path.join(destDir, re.sub(r'[^\w-]', '_', str(song['id'])))
+
+    def _downloadSong(self, song, destDir):
+        path = self._getPath(song, destDir)
+        entry = {'id': song['id'], 'path': path, 'status': 'ok',
+            'bytes': 0, 'attempts': 0, 'elapsed': 0.0, 'bytesPerSec': 0.0,
+            'error': None}
+        if not self.overwrite and os.path.exists(path):
+            entry['status'] = 'skipped'
+            return self._done(entry)
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = path + PART_SUFFIX
+        start = time.monotonic()
+        for attempt in range(self.retries + 1):
+            entry['attempts'] += 1
+            # Set once the body starts arriving
+            started = [False]
+            try:
+                self._transfer(song['id'], tmp, entry, started)
+                os.replace(tmp, path)
+                break
+            except Exception as e:
+                if attempt == self.retries or \
+                        not self._isRetryable(e, started[0]):
+                    logger.warning('Failed to download %s: %s', song['id'],
+                        e)
+                    entry['status'] = 'failed'
+                    entry['error'] = e
+                    break
+                delay = max(self.retryBackoff * 2 ** attempt,
+                    getattr(e, 'retryAfter', 0))
+                logger.debug('Retrying %s in %.1fs: %s', song['id'], delay, e)
+                time.sleep(delay)
+        entry['elapsed'] = time.monotonic() - start
+        if entry['elapsed'] > 0:
+            entry['bytesPerSec'] = entry['bytes'] / entry['elapsed']
+        return self._done(entry)
+
+    def _transfer(self, sid, path, entry, started):
+        # Count everything received, including the partial transfers of
+        # failed attempts
+        last = [os.path.getsize(path) if os.path.exists(path) else 0]
+
+        def progress(done, total):
+            started[0] = True
+            # done goes back to zero if the server ignored the range
+            nbytes = done - last[0] if done >= last[0] else done
+            last[0] = done
+            entry['bytes'] += nbytes
+            if self.throttle is not None:
+                self.throttle.consume(nbytes)
+
+        with self.conn.lane('bulk'):
+            if self.maxBitRate is not None or self.tformat is not None:
+                return self.conn.streamTo(sid, path, self.maxBitRate or 0,
+                    self.tformat, chunkSize=self.chunkSize,
+                    fsync=self.fsync, progress=progress)
+            return self.conn.downloadTo(sid, path, chunkSize=self.chunkSize,
+                fsync=self.fsync, progress=progress)
+
+    def _isRetryable(self, e, midBody=False):
+        """
+        Returns True if a failed attempt is worth retrying.  The failures
+        to open the download which the connection's own retry policy gave
+        up on aren't, so the two don't multiply
+        """
+        if not midBody and not isinstance(e, http_client.IncompleteRead) \
+                and self.conn.retryPolicy is not None and isTransient(e):
+            return False
+        if isinstance(e, HTTPError):
+            return e.code >= 500 or e.code in RETRY_HTTP_CODES
+        return isinstance(e, RETRY_ERRORS)
+
+    def _done(self, entry):
+        if self.progress is not None:
+            self.progress(entry)
+        return entry
@@ -39,6 +39,16 @@ class DataNotFoundError(SonicError):
 class ArgumentError(SonicError):
     pass
 
+class CircuitOpenError(SonicError):
+    """
+    Raised, without making the request, while the circuit breaker of the
+    request's endpoint group is open.  retryAfter is the number of
+    seconds before it lets a request through again
+    """
+    def __init__(self, message, retryAfter=0.0):
+        super().__init__(message)
+        self.retryAfter = retryAfter
+
 # This maps the error code numbers from the Subsonic server to their
 # appropriate Exceptions
 ERR_CODE_MAP = {
@@ -0,0 +1,215 @@
+"""
+This file is part of py-sonic.
+
+py-sonic is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+py-sonic is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with py-sonic.  If not, see <http://www.gnu.org/licenses/>
+
+Incremental parsing of large list responses.  See the *Iter() methods of
+libsonic.connection.Connection, like getIndexesIter().
+
+The response body is read in chunks and the items of the target lists
+(ex: every "artist" of every "index") are decoded and yielded one at a
+time, as soon as their bytes have arrived.  Only the item being decoded
+and one chunk are held in memory.
+"""
+
+from libsonic.errors import SonicError
+
+import codecs
+import json
+import re
+
+CHUNK_SIZE = 64 * 1024
+
+_WS_RE = re.compile(r'[ \t\n\r]*')
+
+_NUMBER_START = frozenset('-0123456789')
+_NUMBER_END = frozenset(' \t\n\r,]}')
+
+_ROOT = 'subsonic-response'
+
+
+class StreamParser(object):
+    def __init__(self, fh, targets, onError=None, chunkSize=CHUNK_SIZE):
+        """
+        fh:file             The response to read the body from
+        targets:list        The paths of the lists to yield the items
+                            of, relative to the "subsonic-response"
+                            object.  A path is a tuple of keys, with "*"
+                            standing for every element of a list.  ex:
+                            ('indexes', 'index', '*', 'artist')
+        onError:callable    Called with the response status and error
+                            dict as soon as a failed status is parsed
+                            (ex: Connection._checkStatus())
+        chunkSize:int       The number of bytes read at a time
+        """
+        self.fh = fh
+        self.targets = set((_ROOT,) + tuple(t) for t in targets)
+        self.prefixes = set(t[:i] for t in self.targets
+            for i in range(len(t)))
+        self.onError = onError
+        self.chunkSize = chunkSize
+        # The top level values of the response, besides the targets
+        self.response = {}
+        self._decoder = json.JSONDecoder()
+        self._utf8 = codecs.getincrementaldecoder('utf-8')()
+        self._buf = ''
+        self._pos = 0
+        self._eof = False
+
+    def __iter__(self):
+        """
+        Yields (key, item) tuples for every item of the target lists, the
+        key being the last key of the target path, ex: ('artist', {...})
+        """
+        for pair in self._walk(()):
+            yield pair
+        if self.response.get('status') != 'ok' and self.onError is not None:
+            self.onError(self.response)
+
+    def _walk(self, path):
+        c = self._peek()
+        if c == '{':
+            if path + ('*',) in self.prefixes:
+                # A single element sent instead of a list of one
+                path += ('*',)
+            self._pos += 1
+            if self._peek() == '}':
+                self._pos += 1
+                return
+            while True:
+                key = self._readValue()
+                self._expect(':')
+                sub = path + (key,)
+                if sub in self.targets:
+                    for pair in self._items(key):
+                        yield pair
+                elif sub in self.prefixes:
+                    for pair in self._walk(sub):
+                        yield pair
+                else:
+                    value = self._readValue()
+                    if path == (_ROOT,):
+                        self._setResponse(key, value)
+                if self._next('}'):
+                    return
+        elif c == '[':
+            self._pos += 1
+            if self._peek() == ']':
+                self._pos += 1
+                return
+            sub = path + ('*',)
+            while True:
+                if sub in self.prefixes:
+                    for pair in self._walk(sub):
+                        yield pair
+                else:
+                    self._readValue()
+                if self._next(']'):
+                    return
+        else:
+            self._readValue()
+
+    def _items(self, key):
+        """
+        Yields the items of a target list.  Older servers send a single
+        item as an object instead of a list of one
+        """
+        if self._peek() != '[':
+            item = self._readValue()
+            if isinstance(item, dict):
+                yield key, item
+            return
+        self._pos += 1
+        if self._peek() == ']':
+            self._pos += 1
+            return
+        while True:
+            yield key, self._readValue()
+            if self._next(']'):
+                return
+
+    def _setResponse(self, key, value):
+        self.response[key] = value
+        if key == 'error' and self.onError is not None:
+            self.onError({'status': self.response.get('status', 'failed'),
+                'error': value})
+
+    def _fill(self):
+        """
+        Reads the next chunk into the buffer, dropping what was parsed.
+        Returns False at the end of the body
+        """
+        if self._eof:
+            return False
+        data = self.fh.read(self.chunkSize)
+        if not data:
+            self._eof = True
+            text = self._utf8.decode(b'', final=True)
+        else:
+            text = self._utf8.decode(data)
+        self._buf = self._buf[self._pos:] + text
+        self._pos = 0
+        return True
+
+    def _peek(self):
+        while True:
+            self._pos = _WS_RE.match(self._buf, self._pos).end()
+            if self._pos < len(self._buf):
+                return self._buf[self._pos]
+            if not self._fill():
+                raise SonicError('Unexpected end of the response')
+
+    def _expect(self, c):
+        if self._peek() != c:
+            raise SonicError('Invalid response: expected %r at %r' % (c,
+                self._buf[self._pos:self._pos + 40]))
+        self._pos += 1
+
+    def _next(self, close):
+        """
+        Consumes the separator after a container element and returns True
+        if it was the closing bracket
+        """
+        c = self._peek()
+        self._pos += 1
+        if c == close:
+            return True
+        if c != ',':
+            raise SonicError('Invalid response: expected "," or %r, got %r'
+                % (close, c))
+        return False
+
+    def _readValue(self):
+        self._peek()
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(self._buf, self._pos)
+                # A number may continue in the next chunk
+                if self._eof or (end < len(self._buf) and
+                        (self._buf[self._pos] not in _NUMBER_START or
+                        self._buf[end] in _NUMBER_END)):
+                    self._pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self._eof:
+                    raise
+            self._fill()
+
+
+def iterResponse(fh, targets, onError=None, chunkSize=CHUNK_SIZE):
+    """
+    Yields the (key, item) tuples of the target lists of a response as
+    they are parsed.  See StreamParser
+    """
+    return iter(StreamParser(fh, targets, onError, chunkSize))
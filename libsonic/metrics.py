@@ -0,0 +1,278 @@
+"""
+This file is part of py-sonic.
+
+py-sonic is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+py-sonic is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with py-sonic.  If not, see <http://www.gnu.org/licenses/>
+
+Request instrumentation for libsonic.connection.Connection.
+
+Every call is described by a RequestRecord, which is passed to the
+request hooks before the request is sent and once it completed:
+
+    def logSlow(record):
+        if record.total > 1:
+            print(record.view, record.toDict())
+
+    conn.addRequestHook(post=logSlow)
+
+Connection also aggregates the records in a Metrics object, with per
+view counters and latency histograms:
+
+    print(conn.metrics.snapshot()['getAlbum'])
+    text = conn.metrics.toPrometheus()
+"""
+
+from bisect import bisect_left
+
+import threading
+import time
+
+# The upper bounds of the histogram buckets, in seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+    10.0, 30.0)
+
+QUANTILES = (0.5, 0.95, 0.99)
+
+
+class RequestRecord(object):
+    """
+    The measurements of a call.  The times are in seconds.  ttfb is the
+    time to the response headers (of the last attempt, if the call was
+    retried) and total the time to the end of the call.  For binary
+    responses handed to the caller unread, total stops at the headers
+    and bytesIn is the Content-Length
+    """
+    __slots__ = ('view', 'lane', 'started', 'ttfb', 'total', 'decode',
+        'bytesIn', 'bytesOut', 'status', 'error', 'fromCache', '_start')
+
+    def __init__(self, view, lane=None, bytesOut=0):
+        self.view = view
+        self.lane = lane
+        # The wall clock time the call started at
+        self.started = time.time()
+        self.ttfb = None
+        self.total = None
+        self.decode = None
+        self.bytesIn = 0
+        self.bytesOut = bytesOut
+        self.status = None
+        # The class name of the exception raised or of the API error
+        # returned, ex: "DataNotFoundError"
+        self.error = None
+        self.fromCache = False
+        self._start = time.perf_counter()
+
+    def elapsed(self):
+        """
+        Returns the number of seconds since the start of the call
+        """
+        return time.perf_counter() - self._start
+
+    def markTtfb(self):
+        self.ttfb = self.elapsed()
+
+    def finish(self):
+        self.total = self.elapsed()
+        if self.ttfb is None:
+            self.ttfb = self.total
+
+    def toDict(self):
+        return {k: getattr(self, k) for k in self.__slots__
+            if not k.startswith('_')}
+
+
+class Histogram(object):
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        # One more for the values past the last bucket
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def cumulative(self):
+        """
+        Returns the (upper bound, count of values <= upper bound) pairs,
+        the last upper bound being infinity
+        """
+        ret = []
+        total = 0
+        for bound, n in zip(self.buckets + (float('inf'),), self.counts):
+            total += n
+            ret.append((bound, total))
+        return ret
+
+    def quantile(self, q):
+        """
+        Returns an estimate of a quantile, interpolated within its bucket
+        like Prometheus' histogram_quantile()
+        """
+        if not self.count:
+            return None
+        rank = q * self.count
+        lower = 0.0
+        seen = 0
+        for bound, n in zip(self.buckets, self.counts):
+            if seen + n >= rank and n:
+                return lower + (bound - lower) * (rank - seen) / n
+            seen += n
+            lower = bound
+        return self.buckets[-1]
+
+    def toDict(self):
+        ret = {'count': self.count, 'sum': self.sum,
+            'buckets': self.cumulative()}
+        for q in QUANTILES:
+            ret['p%d' % (q * 100)] = self.quantile(q)
+        return ret
+
+
+class _ViewMetrics(object):
+    __slots__ = ('requests', 'cacheHits', 'errors', 'bytesIn', 'bytesOut',
+        'ttfb', 'total', 'decode')
+
+    def __init__(self, buckets):
+        self.requests = 0
+        self.cacheHits = 0
+        self.errors = {}
+        self.bytesIn = 0
+        self.bytesOut = 0
+        self.ttfb = Histogram(buckets)
+        self.total = Histogram(buckets)
+        self.decode = Histogram(buckets)
+
+
+class Metrics(object):
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        """
+        Aggregates RequestRecords per view.  Pass observe() as a post
+        request hook, which Connection does by default
+
+        buckets:list    The upper bounds of the latency histogram
+                        buckets, in seconds
+        """
+        self.buckets = tuple(buckets)
+        self._views = {}
+        self._lock = threading.Lock()
+
+    def observe(self, record):
+        """
+        Adds a completed call
+        """
+        with self._lock:
+            m = self._views.get(record.view)
+            if m is None:
+                m = self._views[record.view] = _ViewMetrics(self.buckets)
+            m.requests += 1
+            m.cacheHits += record.fromCache
+            m.bytesIn += record.bytesIn
+            m.bytesOut += record.bytesOut
+            if record.error is not None:
+                m.errors[record.error] = m.errors.get(record.error, 0) + 1
+            if record.ttfb is not None:
+                m.ttfb.observe(record.ttfb)
+            if record.total is not None:
+                m.total.observe(record.total)
+            if record.decode is not None:
+                m.decode.observe(record.decode)
+
+    def reset(self):
+        with self._lock:
+            self._views = {}
+
+    def snapshot(self):
+        """
+        Returns a dict of the view names to their metrics, like the
+        following:
+
+        {'getAlbum': {'requests': 120, 'cacheHits': 80,
+                      'errors': {'DataNotFoundError': 1},
+                      'bytesIn': 482133, 'bytesOut': 15120,
+                      'ttfb': {'count': 120, 'sum': 1.9, 'p50': 0.008,
+                               'p95': 0.04, 'p99': 0.09,
+                               'buckets': [(0.005, 81), ...]},
+                      'total': {...}, 'decode': {...}}}
+        """
+        with self._lock:
+            return {view: {
+                'requests': m.requests,
+                'cacheHits': m.cacheHits,
+                'errors': dict(m.errors),
+                'bytesIn': m.bytesIn,
+                'bytesOut': m.bytesOut,
+                'ttfb': m.ttfb.toDict(),
+                'total': m.total.toDict(),
+                'decode': m.decode.toDict(),
+            } for view, m in self._views.items()}
+
+    def toPrometheus(self, prefix='libsonic'):
+        """
+        Returns the metrics in the Prometheus text exposition format
+        """
+        with self._lock:
+            views = sorted(self._views.items())
+            lines = []
+            counters = (
+                ('requests_total', 'Calls made', 'requests'),
+                ('cache_hits_total', 'Calls served from the cache',
+                    'cacheHits'),
+                ('received_bytes_total', 'Response bytes received',
+                    'bytesIn'),
+                ('sent_bytes_total', 'Request bytes sent', 'bytesOut'),
+            )
+            for name, help, attr in counters:
+                name = '%s_%s' % (prefix, name)
+                lines.append('# HELP %s %s' % (name, help))
+                lines.append('# TYPE %s counter' % name)
+                for view, m in views:
+                    lines.append('%s{view="%s"} %d' % (name, _escape(view),
+                        getattr(m, attr)))
+
+            name = '%s_errors_total' % prefix
+            lines.append('# HELP %s Failed calls, by error class' % name)
+            lines.append('# TYPE %s counter' % name)
+            for view, m in views:
+                for error, n in sorted(m.errors.items()):
+                    lines.append('%s{view="%s",error="%s"} %d' % (name,
+                        _escape(view), _escape(error), n))
+
+            histograms = (
+                ('ttfb_seconds', 'Time to the response headers', 'ttfb'),
+                ('duration_seconds', 'Total call time', 'total'),
+                ('decode_seconds', 'JSON decoding time', 'decode'),
+            )
+            for name, help, attr in histograms:
+                name = '%s_%s' % (prefix, name)
+                lines.append('# HELP %s %s' % (name, help))
+                lines.append('# TYPE %s histogram' % name)
+                for view, m in views:
+                    hist = getattr(m, attr)
+                    label = _escape(view)
+                    for bound, n in hist.cumulative():
+                        le = '+Inf' if bound == float('inf') else repr(bound)
+                        lines.append('%s_bucket{view="%s",le="%s"} %d' % (
+                            name, label, le, n))
+                    lines.append('%s_sum{view="%s"} %r' % (name, label,
+                        hist.sum))
+                    lines.append('%s_count{view="%s"} %d' % (name, label,
+                        hist.count))
+        return '\n'.join(lines) + '\n'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace(
+        '\n', '\\n')
@@ -0,0 +1,295 @@
+"""
+This file is part of py-sonic.
+
+py-sonic is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+py-sonic is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with py-sonic.  If not, see <http://www.gnu.org/licenses/>
+
+Compact, typed entity objects for API responses.
+
+The methods returning library entities take a "models" argument.  When
+it is True, the entity dicts in the response are replaced with these
+objects:
+
+    res = conn.getAlbum(albumId, models=True)
+    album = res['album']
+    for song in album.songs:
+        print(song.track, song.title, song.duration)
+
+The objects use __slots__ instead of a dict per entity, and the values
+which repeat across a library (content types, genres, artist names,
+etc.) are interned, so large numbers of them take a fraction of the
+memory.  Keys the models don't know about are kept in "extra".  The
+objects also support item access with the API key names (ex:
+song['title'] or album['song']) and toDict() converts them back.
+"""
+
+import sys
+
+# Fields whose values repeat a lot across a library.  Their strings are
+# interned so all the entities share a single copy
+INTERNED = frozenset((
+    'album',
+    'albumId',
+    'artist',
+    'artistId',
+    'contentType',
+    'genre',
+    'parent',
+    'suffix',
+    'transcodedContentType',
+    'transcodedSuffix',
+    'type',
+    'mediaType',
+    'owner',
+    'channelId',
+    'status',
+))
+
+_intern = sys.intern
+
+
+class Model(object):
+    """
+    The base class of the models.  Subclasses list the API keys they
+    store in _fields and their child entity lists in _children, as a
+    mapping of API key to (attribute name, model class)
+    """
+    __slots__ = ()
+    _fields = ()
+    _children = {}
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls._known = frozenset(cls._fields) | frozenset(cls._children)
+        cls._fromDict = _compileFromDict(cls)
+
+    def __init__(self, **kwargs):
+        """
+        Takes the fields as keyword arguments.  The child entities are
+        passed by attribute name, ex: Album(id='1', songs=[...])
+        """
+        attrs = set(self._fields)
+        attrs.update(attr for attr, cls in self._children.values())
+        for attr in attrs:
+            setattr(self, attr, kwargs.get(attr))
+        self.extra = {k: v for k, v in kwargs.items()
+            if k not in attrs} or None
+
+    @classmethod
+    def fromDict(cls, d):
+        """
+        Creates an instance from an entity dict of an API response
+        """
+        return cls._fromDict(d)
+
+    def toDict(self):
+        """
+        Returns the entity as a dict like the one in the API response.
+        Fields set to None are left out
+        """
+        ret = {}
+        for field in self._fields:
+            value = getattr(self, field)
+            if value is not None:
+                ret[field] = value
+        for key, (attr, cls) in self._children.items():
+            children = getattr(self, attr)
+            if children is not None:
+                ret[key] = [c.toDict() for c in children]
+        if self.extra:
+            ret.update(self.extra)
+        return ret
+
+    def get(self, key, default=None):
+        """
+        Returns the value for an API key, like dict.get()
+        """
+        if key in self._fields:
+            value = getattr(self, key)
+        elif key in self._children:
+            value = getattr(self, self._children[key][0])
+        elif self.extra:
+            value = self.extra.get(key)
+        else:
+            value = None
+        return default if value is None else value
+
+    def __getitem__(self, key):
+        value = self.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def __eq__(self, other):
+        if other.__class__ is not self.__class__:
+            return NotImplemented
+        return self.toDict() == other.toDict()
+
+    def __repr__(self):
+        name = getattr(self, 'title', None) or getattr(self, 'name', None)
+        return '<%s %s %r>' % (self.__class__.__name__, self.id, name)
+
+
+def _compileFromDict(cls):
+    """
+    Generates the fromDict() function of a model class.  Unrolling the
+    field assignments makes the conversion several times faster than
+    looping over the fields with setattr()
+    """
+    lines = ['def fromDict(d):', '    get = d.get', '    obj = new(cls)']
+    for field in cls._fields:
+        if field in INTERNED:
+            lines.append('    v = get(%r)' % field)
+            lines.append('    obj.%s = intern(v) if v.__class__ is str '
+                'else v' % field)
+        else:
+            lines.append('    obj.%s = get(%r)' % (field, field))
+    for key, (attr, childCls) in cls._children.items():
+        lines.append('    obj.%s = fromList(children[%r], get(%r))' % (
+            attr, key, key))
+    lines.append('    obj.extra = None if known.issuperset(d) else '
+        '{k: v for k, v in d.items() if k not in known}')
+    lines.append('    return obj')
+    namespace = {
+        'new': object.__new__,
+        'cls': cls,
+        'intern': _intern,
+        'fromList': fromList,
+        'children': {k: c for k, (a, c) in cls._children.items()},
+        'known': cls._known,
+    }
+    exec('\n'.join(lines), namespace)
+    return namespace['fromDict']
+
+
+def fromList(cls, items):
+    """
+    Converts a list of entity dicts (or a single one, as some server
+    versions send single items) to a list of models
+    """
+    if items is None:
+        return None
+    if isinstance(items, dict):
+        items = [items]
+    fromDict = cls.fromDict
+    return [fromDict(i) for i in items]
+
+
+_CHILD_FIELDS = ('id', 'parent', 'isDir', 'title', 'album', 'artist',
+    'track', 'year', 'genre', 'coverArt', 'size', 'contentType', 'suffix',
+    'transcodedContentType', 'transcodedSuffix', 'duration', 'bitRate',
+    'path', 'isVideo', 'userRating', 'averageRating', 'playCount',
+    'discNumber', 'created', 'starred', 'albumId', 'artistId', 'type',
+    'mediaType', 'bookmarkPosition', 'played')
+
+
+class Song(Model):
+    """
+    A file or directory entry ("child" in the API docs): a song, a video
+    or, in the folder based calls, a directory
+    """
+    _fields = _CHILD_FIELDS
+    __slots__ = _fields + ('extra',)
+
+
+class PodcastEpisode(Model):
+    _fields = _CHILD_FIELDS + ('streamId', 'channelId', 'description',
+        'status', 'publishDate')
+    __slots__ = _fields + ('extra',)
+
+
+class Album(Model):
+    """
+    An ID3 album.  Its songs are in "songs" when the response has them
+    """
+    _fields = ('id', 'name', 'artist', 'artistId', 'coverArt', 'songCount',
+        'duration', 'playCount', 'created', 'starred', 'year', 'genre',
+        'userRating')
+    _children = {'song': ('songs', Song)}
+    __slots__ = _fields + ('songs', 'extra')
+
+
+class Artist(Model):
+    """
+    An ID3 or index artist.  Its albums are in "albums" when the
+    response has them
+    """
+    _fields = ('id', 'name', 'coverArt', 'albumCount', 'starred',
+        'artistImageUrl', 'userRating', 'averageRating')
+    _children = {'album': ('albums', Album)}
+    __slots__ = _fields + ('albums', 'extra')
+
+
+class Directory(Model):
+    _fields = ('id', 'parent', 'name', 'starred', 'userRating',
+        'averageRating', 'playCount')
+    _children = {'child': ('children', Song)}
+    __slots__ = _fields + ('children', 'extra')
+
+
+class Playlist(Model):
+    _fields = ('id', 'name', 'comment', 'owner', 'public', 'songCount',
+        'duration', 'created', 'changed', 'coverArt', 'allowedUser')
+    _children = {'entry': ('entries', Song)}
+    __slots__ = _fields + ('entries', 'extra')
+
+
+class PodcastChannel(Model):
+    _fields = ('id', 'url', 'title', 'description', 'coverArt',
+        'originalImageUrl', 'status', 'errorMessage')
+    _children = {'episode': ('episodes', PodcastEpisode)}
+    __slots__ = _fields + ('episodes', 'extra')
+
+
+# The entities at the top level of the responses
+ENTITIES = {
+    'directory': Directory,
+    'artist': Artist,
+    'album': Album,
+    'song': Song,
+    'playlist': Playlist,
+}
+
+# The lists of entities nested one level down in the responses, ex:
+# {'searchResult3': {'song': [...]}}
+LISTS = {
+    'searchResult2': {'artist': Artist, 'album': Song, 'song': Song},
+    'searchResult3': {'artist': Artist, 'album': Album, 'song': Song},
+    'starred': {'artist': Artist, 'album': Song, 'song': Song},
+    'starred2': {'artist': Artist, 'album': Album, 'song': Song},
+    'albumList': {'album': Song},
+    'albumList2': {'album': Album},
+    'randomSongs': {'song': Song},
+    'songsByGenre': {'song': Song},
+    'playlists': {'playlist': Playlist},
+    'podcasts': {'channel': PodcastChannel},
+    'newestPodcasts': {'episode': PodcastEpisode},
+}
+
+
+def toModels(res):
+    """
+    Replaces the entity dicts of a response with models, in place, and
+    returns the response
+    """
+    for key, value in res.items():
+        if key in ENTITIES and isinstance(value, dict):
+            res[key] = ENTITIES[key].fromDict(value)
+        elif key in LISTS and isinstance(value, dict):
+            for listKey, cls in LISTS[key].items():
+                if listKey in value:
+                    value[listKey] = fromList(cls, value[listKey])
+    return res
@@ -0,0 +1,326 @@
+"""
+This file is part of py-sonic.
+
+py-sonic is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+py-sonic is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with py-sonic.  If not, see <http://www.gnu.org/licenses/>
+
+Overload protection for libsonic.connection.Connection.
+
+Both protections are opt-in:
+
+    conn = Connection(url, user, passwd, circuitBreaker=True,
+        concurrencyLimiter=True)
+
+With circuitBreaker set, Connection keeps a CircuitBreaker per endpoint
+group (see getEndpointGroup()).  When too many of a group's requests
+fail or are slow, its breaker opens and the requests to the group fail
+right away with a CircuitOpenError, without reaching the server, until
+a few trial requests get through fine.
+
+Requests are made in a "lane", "interactive" by default.  The bulk jobs
+(LibraryCrawler, DownloadManager, etc.) run in the "bulk" lane, and the
+"background" lane is meant for the other work nobody is waiting on (ex:
+replaying queued scrobbles, prefetching cover art):
+
+    with conn.lane('bulk'):
+        for res in conn.map('getAlbum', albumIds):
+            ...
+
+With concurrencyLimiter set, the number of background and bulk requests
+in flight is capped by an AdaptiveLimiter, which raises the cap while
+the server keeps up and cuts it as soon as the latency rises (AIMD), so
+bulk jobs back off on their own while the interactive requests keep
+going through.
+"""
+
+from libsonic.errors import ArgumentError, CircuitOpenError
+from collections import deque
+
+import contextvars
+import threading
+import time
+
+# The lanes, by priority
+LANES = ('interactive', 'background', 'bulk')
+
+currentLane = contextvars.ContextVar('libsonic_lane', default='interactive')
+
+# The views which transfer media rather than library data
+MEDIA_VIEWS = ('stream', 'download', 'hls', 'getCoverArt', 'getAvatar',
+    'getCaptions')
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+
+
+def getEndpointGroup(viewName):
+    """
+    Returns the endpoint group of a view: "media", "search", "browse"
+    (the other read views) or "write"
+    """
+    if viewName in MEDIA_VIEWS:
+        return 'media'
+    if viewName.startswith('search'):
+        return 'search'
+    if viewName.startswith('get') or viewName == 'ping':
+        return 'browse'
+    return 'write'
+
+
+def checkLane(lane):
+    if lane not in LANES:
+        raise ArgumentError('Invalid lane %r, must be one of %s' % (lane,
+            ', '.join(LANES)))
+    return lane
+
+
+class CircuitBreaker(object):
+    def __init__(self, name=None, failureRate=0.5, slowCallDuration=10.0,
+            slowCallRate=0.8, minCalls=20, window=30.0, openDuration=10.0,
+            halfOpenCalls=3):
+        """
+        name:str                The name, for the errors and logs
+        failureRate:float       The breaker opens when at least this
+                                fraction of the calls of the window
+                                failed on a transient error
+        slowCallDuration:float  The number of seconds past which a call
+                                counts as slow
+        slowCallRate:float      The breaker opens when at least this
+                                fraction of the calls of the window were
+                                slow
+        minCalls:int            The min number of calls in the window
+                                before the rates are looked at
+        window:float            The number of seconds of calls the rates
+                                are computed over
+        openDuration:float      The number of seconds the breaker stays
+                                open before letting trial calls through
+        halfOpenCalls:int       The number of trial calls which must
+                                succeed for the breaker to close again
+        """
+        self.name = name
+        self.failureRate = failureRate
+        self.slowCallDuration = slowCallDuration
+        self.slowCallRate = slowCallRate
+        self.minCalls = int(minCalls)
+        self.window = window
+        self.openDuration = openDuration
+        self.halfOpenCalls = int(halfOpenCalls)
+        self._state = CLOSED
+        self._calls = deque()
+        self._failures = 0
+        self._slow = 0
+        self._openUntil = 0.0
+        self._trials = 0
+        self._successes = 0
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        with self._lock:
+            self._update(time.monotonic())
+            return self._state
+
+    def stats(self):
+        """
+        Returns a dict like the following:
+
+        {'state': 'closed', 'calls': 112, 'failures': 3, 'slow': 0}
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._update(now)
+            self._expire(now)
+            return {'state': self._state, 'calls': len(self._calls),
+                'failures': self._failures, 'slow': self._slow}
+
+    def allow(self):
+        """
+        Raises a CircuitOpenError if a call can't be made now.  Every
+        allowed call must be followed by a record()
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._update(now)
+            if self._state == OPEN:
+                raise CircuitOpenError('The circuit breaker for %s is open' %
+                    self.name, self._openUntil - now)
+            if self._state == HALF_OPEN:
+                if self._trials >= self.halfOpenCalls:
+                    raise CircuitOpenError('The circuit breaker for %s is '
+                        'half open, waiting for trial calls' % self.name,
+                        min(1.0, self.openDuration))
+                self._trials += 1
+
+    def record(self, failed, duration):
+        """
+        Records the outcome of an allowed call
+
+        failed:bool         True if the call failed on a transient error
+        duration:float      The number of seconds the call took
+        """
+        slow = duration >= self.slowCallDuration
+        with self._lock:
+            now = time.monotonic()
+            if self._state == HALF_OPEN:
+                if failed or slow:
+                    self._open(now)
+                else:
+                    self._successes += 1
+                    if self._successes >= self.halfOpenCalls:
+                        self._state = CLOSED
+                return
+            if self._state == OPEN:
+                # A call allowed before the breaker opened
+                return
+            self._calls.append((now, failed, slow))
+            self._failures += failed
+            self._slow += slow
+            self._expire(now)
+            n = len(self._calls)
+            if n >= self.minCalls and (
+                    self._failures >= self.failureRate * n or
+                    self._slow >= self.slowCallRate * n):
+                self._open(now)
+
+    def _update(self, now):
+        if self._state == OPEN and now >= self._openUntil:
+            self._state = HALF_OPEN
+            self._trials = 0
+            self._successes = 0
+
+    def _open(self, now):
+        self._state = OPEN
+        self._openUntil = now + self.openDuration
+        self._calls.clear()
+        self._failures = 0
+        self._slow = 0
+
+    def _expire(self, now):
+        calls = self._calls
+        limit = now - self.window
+        while calls and calls[0][0] < limit:
+            t, failed, slow = calls.popleft()
+            self._failures -= failed
+            self._slow -= slow
+
+
+class AdaptiveLimiter(object):
+    def __init__(self, initial=8, minLimit=1, maxLimit=64, backoffRatio=0.9,
+            latencyTolerance=2.0, latencyTarget=None, latencyFloor=0.05):
+        """
+        An AIMD concurrency limit: it grows by one for every "limit"
+        calls which complete in time and is multiplied by backoffRatio
+        when a call fails or is slow, at most once per round trip
+
+        initial:int             The initial limit
+        minLimit:int            The limit never goes below this
+        maxLimit:int            The limit never goes above this
+        backoffRatio:float      The factor the limit is multiplied by on
+                                a failed or slow call
+        latencyTolerance:float  Without a latencyTarget, a call is slow
+                                when it takes this many times the
+                                baseline latency of its view, which
+                                follows the fastest recent calls
+        latencyTarget:float     If set, the number of seconds past which
+                                a call is slow
+        latencyFloor:float      Calls faster than this many seconds are
+                                never slow
+        """
+        self.minLimit = int(minLimit)
+        self.maxLimit = int(maxLimit)
+        self.backoffRatio = backoffRatio
+        self.latencyTolerance = latencyTolerance
+        self.latencyTarget = latencyTarget
+        self.latencyFloor = latencyFloor
+        self._limit = float(max(self.minLimit, min(self.maxLimit, initial)))
+        self._inflight = 0
+        # The baseline latency per view
+        self._baselines = {}
+        self._lastDecrease = 0.0
+        self._cond = threading.Condition()
+
+    @property
+    def limit(self):
+        return int(self._limit)
+
+    def stats(self):
+        """
+        Returns a dict like the following:
+
+        {'limit': 12, 'inflight': 3, 'baselines': {'getAlbum': 0.021}}
+        """
+        with self._cond:
+            return {'limit': int(self._limit), 'inflight': self._inflight,
+                'baselines': dict(self._baselines)}
+
+    def acquire(self, timeout=None):
+        """
+        Waits for the number of calls in flight to be under the limit and
+        takes a slot.  Returns False if the timeout expired first.  Every
+        successful acquire() must be followed by a release()
+        """
+        with self._cond:
+            if not self._cond.wait_for(
+                    lambda: self._inflight < int(self._limit), timeout):
+                return False
+            self._inflight += 1
+            return True
+
+    def release(self, duration=None, failed=False, key=None):
+        """
+        Frees the slot of a completed call and records its outcome
+
+        duration:float      The number of seconds the call took, or None
+                            if the call wasn't made, in which case
+                            nothing is recorded
+        failed:bool         True if the call failed on a transient error
+        key:str             The kind of call (the view name), the
+                            latencies of which are compared together
+        """
+        with self._cond:
+            self._inflight -= 1
+            if duration is not None:
+                self._record(duration, failed, key)
+            self._cond.notify_all()
+
+    def record(self, duration, failed=False, key=None):
+        """
+        Records the outcome of a call made without a slot, ex: an
+        interactive request, so its latency is taken into account too.
+        See release()
+        """
+        with self._cond:
+            self._record(duration, failed, key)
+            self._cond.notify_all()
+
+    def _record(self, duration, failed, key):
+        baseline = self._baselines.get(key)
+        if baseline is None or duration < baseline:
+            baseline = duration
+        else:
+            # Drift up slowly, in case the server just got slower for good
+            baseline += (duration - baseline) * 0.01
+        self._baselines[key] = baseline
+        target = self.latencyTarget
+        if target is None:
+            target = max(self.latencyFloor,
+                baseline * self.latencyTolerance)
+        if failed or duration > target:
+            now = time.monotonic()
+            if now - self._lastDecrease >= target:
+                self._limit = max(self.minLimit,
+                    self._limit * self.backoffRatio)
+                self._lastDecrease = now
+        else:
+            self._limit = min(self.maxLimit, self._limit + 1 / self._limit)
@@ -0,0 +1,205 @@
+"""
+This file is part of py-sonic.
+
+py-sonic is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+py-sonic is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with py-sonic.  If not, see <http://www.gnu.org/licenses/>
+
+Paging helpers for the count/offset style API calls.  See the iter*()
+methods of libsonic.connection.Connection.
+"""
+
+from libsonic.errors import ArgumentError
+
+import asyncio
+import contextvars
+import logging
+import queue
+import threading
+
+logger = logging.getLogger(__name__)
+
+# The max number of items a getAlbumList(2)/getSongsByGenre page can have
+MAX_PAGE_SIZE = 500
+
+# The max offset getAlbumList(2) accepts
+MAX_LIST_OFFSET = 5000
+
+_DONE = object()
+
+
+def asList(value):
+    """
+    Subsonic returns a dict instead of a list for single items in some
+    versions.  This always returns a list
+    """
+    if value is None:
+        return []
+    if isinstance(value, dict):
+        return [value]
+    return value
+
+
+def iterPages(fetchPage, pageSize, prefetch=2, offset=0, maxOffset=None):
+    """
+    Yields the items of consecutive pages, one at a time.  Paging stops
+    at the first page shorter than pageSize, or past maxOffset.
+
+    If prefetch is greater than zero, the pages are fetched on a
+    background thread, up to prefetch pages ahead of the one being
+    consumed, so the request latency is hidden while memory stays
+    bounded.
+
+    fetchPage:callable  Called with (offset, size), it returns the list
+                        of items for that page
+    pageSize:int        The number of items to request per page
+    prefetch:int        The max number of pages to fetch ahead
+    offset:int          The offset of the first page
+    maxOffset:int       The max offset the server accepts.  If set, the
+                        page at this offset is the last one fetched
+    """
+    # Checked here rather than in the generator so a bad pageSize fails
+    # at the call, not at the first iteration
+    return _iterPages(fetchPage, _checkPageSize(pageSize), prefetch, offset,
+        maxOffset)
+
+
+def _iterPages(fetchPage, pageSize, prefetch, offset, maxOffset):
+    if prefetch <= 0:
+        while True:
+            page = fetchPage(offset, pageSize)
+            for item in page:
+                yield item
+            if len(page) < pageSize:
+                return
+            offset += pageSize
+            if _pastMax(offset, maxOffset):
+                return
+
+    pages = queue.Queue(prefetch)
+    stop = threading.Event()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                pages.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def fetch(offset):
+        try:
+            while True:
+                page = fetchPage(offset, pageSize)
+                if not put(page):
+                    return
+                if len(page) < pageSize:
+                    break
+                offset += pageSize
+                if _pastMax(offset, maxOffset):
+                    break
+        except Exception as e:
+            put(e)
+            return
+        put(_DONE)
+
+    # Run the fetcher in a copy of the current context so any context
+    # settings made by the caller apply to its requests too
+    ctx = contextvars.copy_context()
+    fetcher = threading.Thread(target=ctx.run, args=(fetch, offset),
+        name='libsonic-prefetch', daemon=True)
+    fetcher.start()
+    try:
+        while True:
+            page = pages.get()
+            if page is _DONE:
+                return
+            if isinstance(page, Exception):
+                raise page
+            for item in page:
+                yield item
+    finally:
+        stop.set()
+
+
+def aiterPages(fetchPage, pageSize, prefetch=2, offset=0, maxOffset=None):
+    """
+    Like iterPages(), as an async generator.  fetchPage is a coroutine
+    function and the pages are prefetched by a task
+    """
+    return _aiterPages(fetchPage, _checkPageSize(pageSize), prefetch,
+        offset, maxOffset)
+
+
+async def _aiterPages(fetchPage, pageSize, prefetch, offset, maxOffset):
+    if prefetch <= 0:
+        while True:
+            page = await fetchPage(offset, pageSize)
+            for item in page:
+                yield item
+            if len(page) < pageSize:
+                return
+            offset += pageSize
+            if _pastMax(offset, maxOffset):
+                return
+
+    pages = asyncio.Queue(prefetch)
+
+    async def fetch(offset):
+        try:
+            while True:
+                page = await fetchPage(offset, pageSize)
+                await pages.put(page)
+                if len(page) < pageSize:
+                    break
+                offset += pageSize
+                if _pastMax(offset, maxOffset):
+                    break
+        except Exception as e:
+            await pages.put(e)
+            return
+        await pages.put(_DONE)
+
+    # The task runs in a copy of the current context, like the fetcher
+    # thread of iterPages()
+    fetcher = asyncio.ensure_future(fetch(offset))
+    try:
+        while True:
+            page = await pages.get()
+            if page is _DONE:
+                return
+            if isinstance(page, Exception):
+                raise page
+            for item in page:
+                yield item
+    finally:
+        fetcher.cancel()
+
+
+def _checkPageSize(pageSize):
+    """
+    Returns pageSize as an int.  A page size under 1 would request the
+    same empty page forever, so it raises an ArgumentError
+    """
+    pageSize = int(pageSize)
+    if pageSize < 1:
+        raise ArgumentError('pageSize must be at least 1: %r' % pageSize)
+    return pageSize
+
+
+def _pastMax(offset, maxOffset):
+    if maxOffset is None or offset <= maxOffset:
+        return False
+    logger.warning('Stopped paging at the max offset of %d, the items '
+        'past it can\'t be listed', maxOffset)
+    return True
@@ -0,0 +1,340 @@
+"""
+This file is part of py-sonic.
+
+py-sonic is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+py-sonic is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with py-sonic.  If not, see <http://www.gnu.org/licenses/>
+
+Persistent HTTP/1.1 keep-alive transport for the urllib opener used by
+libsonic.connection.Connection.
+
+The stock urllib handlers open a new socket (and do a new TLS handshake)
+for every request and force a "Connection: close" header.  The handlers
+in here instead check out an http.client connection from a
+ConnectionPool, keyed on scheme and host:port, and hand it back to the
+pool once the response body has been completely read.
+
+When the request carries a libsonic.tracing.Span (as req.span), the
+pooled connections record the dns, connect, tls, send and ttfb phases
+of the request in it, and whether the socket was reused.
+"""
+
+from libsonic.tracing import tracePhase
+from http import client as http_client
+from urllib.error import URLError
+import urllib.request
+
+import functools
+import logging
+import select
+import socket
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Errors that indicate the server dropped an idle keep-alive connection
+# before it saw our request.  A request that fails like this on a reused
+# connection is retried once on a fresh one
+STALE_CONN_ERRORS = (
+    http_client.RemoteDisconnected,
+    ConnectionResetError,
+    ConnectionAbortedError,
+    BrokenPipeError,
+)
+
+
+class PooledResponse(http_client.HTTPResponse):
+    """
+    An HTTPResponse which returns its connection to the pool when the
+    body has been fully consumed.  If the response is closed before
+    that, the connection is discarded since there is unread data
+    sitting on the socket
+    """
+    poolRelease = None
+    _discard = False
+
+    def close(self):
+        if self.fp is not None and self.length != 0:
+            # Closed with (possibly) unread body data, the socket can't
+            # be reused
+            self._discard = True
+        super().close()
+
+    def _close_conn(self):
+        super()._close_conn()
+        release, self.poolRelease = self.poolRelease, None
+        if release is not None:
+            release(not (self._discard or self.will_close))
+
+
+class _TracedConnectionMixin(object):
+    """
+    Records the dns and connect phases of opening the socket in the span
+    of the request being sent, if any
+    """
+    span = None
+    _connectedAt = None
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._create_connection = self._createConnection
+
+    def _createConnection(self, address,
+            timeout=socket._GLOBAL_DEFAULT_TIMEOUT, source_address=None):
+        """
+        Like socket.create_connection(), with the name resolution timed
+        apart from the connection
+        """
+        span = self.span
+        if span is None:
+            return socket.create_connection(address, timeout, source_address)
+        host, port = address
+        start = time.perf_counter()
+        infos = socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)
+        resolved = time.perf_counter()
+        span.add('dns', start, resolved)
+        sock = None
+        err = None
+        try:
+            for family, socktype, proto, _, addr in infos:
+                sock = socket.socket(family, socktype, proto)
+                try:
+                    if timeout is not socket._GLOBAL_DEFAULT_TIMEOUT:
+                        sock.settimeout(timeout)
+                    if source_address:
+                        sock.bind(source_address)
+                    sock.connect(addr)
+                    return sock
+                except OSError as e:
+                    err = e
+                    sock.close()
+                    sock = None
+            if err is not None:
+                raise err
+            raise OSError('getaddrinfo returned an empty list')
+        finally:
+            self._connectedAt = time.perf_counter()
+            span.add('connect', resolved, self._connectedAt)
+
+
+class PooledHTTPConnection(_TracedConnectionMixin,
+        http_client.HTTPConnection):
+    response_class = PooledResponse
+
+
+class PooledHTTPSConnection(_TracedConnectionMixin,
+        http_client.HTTPSConnection):
+    response_class = PooledResponse
+
+    def connect(self):
+        # The TLS handshake follows the socket connection
+        span = self.span
+        self._connectedAt = None
+        super().connect()
+        if span is not None and self._connectedAt is not None:
+            span.add('tls', self._connectedAt, time.perf_counter())
+
+
+class ConnectionPool(object):
+    def __init__(self, maxSize=10, idleTimeout=60.0):
+        """
+        A thread safe pool of idle http.client connections
+
+        maxSize:int         The max number of idle connections kept per
+                            scheme/host/port.  Connections released back
+                            to a full pool are closed
+        idleTimeout:float   Idle connections older than this number of
+                            seconds are closed instead of being reused.
+                            Set to None to disable
+        """
+        self.maxSize = int(maxSize)
+        self.idleTimeout = idleTimeout
+        self._idle = {}
+        self._lock = threading.Lock()
+        self._closed = False
+
+    def getConnection(self, key, connClass, fresh=False, **connArgs):
+        """
+        Returns a (conn, reused) tuple.  An idle connection for the given
+        key is returned if a healthy one exists, otherwise a new
+        connClass instance is created with the key's host and connArgs
+
+        key:tuple           A (scheme, host) tuple, where host may
+                            include a port, ex: ('https', 'example.com:443')
+        connClass:type      The http.client connection class
+        fresh:bool          Skip the idle connections and always
+                            create a new connection
+        """
+        if not fresh:
+            while True:
+                with self._lock:
+                    conns = self._idle.get(key)
+                    if not conns:
+                        break
+                    conn, released = conns.pop()
+                if self._isHealthy(conn, released):
+                    return conn, True
+                conn.close()
+        return connClass(key[1], **connArgs), False
+
+    def releaseConnection(self, key, conn, reusable=True):
+        """
+        Returns a connection to the pool.  Connections which are not
+        reusable are closed
+
+        key:tuple           The key the connection was checked out with
+        conn:HTTPConnection The connection to return
+        reusable:bool       False if the connection must not be reused
+        """
+        if reusable and conn.sock is not None:
+            with self._lock:
+                conns = self._idle.setdefault(key, [])
+                if not self._closed and len(conns) < self.maxSize:
+                    conns.append((conn, time.monotonic()))
+                    return
+        conn.close()
+
+    def clear(self):
+        """
+        Closes all the idle connections in the pool
+        """
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for conns in idle.values():
+            for conn, _ in conns:
+                conn.close()
+
+    def close(self):
+        """
+        Closes all the idle connections and stops pooling any
+        connections released afterwards
+        """
+        self._closed = True
+        self.clear()
+
+    def _isHealthy(self, conn, released):
+        """
+        An idle connection is healthy if it hasn't been idle longer than
+        idleTimeout and the server hasn't closed it or sent unexpected
+        data on it (ie. the socket is not readable)
+        """
+        if conn.sock is None:
+            return False
+        if self.idleTimeout is not None and \
+                time.monotonic() - released > self.idleTimeout:
+            return False
+        try:
+            if hasattr(select, 'poll'):
+                poller = select.poll()
+                poller.register(conn.sock, select.POLLIN)
+                return not poller.poll(0)
+            return not select.select([conn.sock], [], [], 0)[0]
+        except (OSError, ValueError):
+            return False
+
+
+class _KeepAliveMixin(object):
+    def _poolOpen(self, connClass, req, **connArgs):
+        """
+        Like AbstractHTTPHandler.do_open(), but uses a pooled connection
+        and leaves the connection open after the response
+        """
+        host = req.host
+        if not host:
+            raise URLError('no host given')
+
+        headers = dict(req.unredirected_hdrs)
+        headers.update({k: v for k, v in req.headers.items()
+                        if k not in headers})
+        headers = {name.title(): val for name, val in headers.items()}
+
+        key = (req.type, host)
+        span = getattr(req, 'span', None)
+        fresh = False
+        while True:
+            conn, reused = self._pool.getConnection(key, connClass,
+                fresh=fresh, timeout=req.timeout, **connArgs)
+            conn.set_debuglevel(self._debuglevel)
+            conn.span = span
+            if span is not None:
+                span.reused = reused
+            try:
+                try:
+                    if conn.sock is None:
+                        # Connect up front, so the send phase is only the
+                        # sending of the request
+                        conn.connect()
+                    with tracePhase(span, 'send'):
+                        conn.request(req.get_method(), req.selector,
+                            req.data, headers, encode_chunked=req.has_header(
+                                'Transfer-encoding'))
+                    with tracePhase(span, 'ttfb'):
+                        r = conn.getresponse()
+                except STALE_CONN_ERRORS:
+                    if not reused:
+                        raise
+                    logger.debug('Stale pooled connection to %s, '
+                        'reconnecting', host)
+                    conn.close()
+                    fresh = True
+                    continue
+            except OSError as err:
+                conn.close()
+                raise URLError(err)
+            except:
+                conn.close()
+                raise
+            break
+
+        if r.fp is None:
+            # No body (HEAD, 204, Content-Length: 0), begin() already
+            # closed the response before a release callback could be set
+            self._pool.releaseConnection(key, conn, not r.will_close)
+        else:
+            r.poolRelease = functools.partial(self._pool.releaseConnection,
+                key, conn)
+        r.url = req.get_full_url()
+        # urllib clients expect the reason in .msg, see do_open()
+        r.msg = r.reason
+        return r
+
+
+class KeepAliveHTTPHandler(_KeepAliveMixin, urllib.request.HTTPHandler):
+    def __init__(self, pool, debuglevel=0):
+        """
+        pool:ConnectionPool     The pool to check connections out of
+        """
+        super().__init__(debuglevel)
+        self._pool = pool
+
+    def http_open(self, req):
+        return self._poolOpen(PooledHTTPConnection, req)
+
+
+class KeepAliveHTTPSHandler(_KeepAliveMixin, urllib.request.HTTPSHandler):
+    def __init__(self, pool, debuglevel=0, context=None):
+        """
+        pool:ConnectionPool     The pool to check connections out of
+        context:SSLContext      The ssl context to use for connections
+        """
+        super().__init__(debuglevel, context=context)
+        self._pool = pool
+
+    def https_open(self, req):
+        if req._tunnel_host:
+            # Proxy tunnels are set up per connection, just use the
+            # stock, non-pooled behavior
+            return self.do_open(http_client.HTTPSConnection, req,
+                context=self._context)
+        return self._poolOpen(PooledHTTPSConnection, req,
+            context=self._context)
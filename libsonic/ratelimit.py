@@ -0,0 +1,134 @@
+"""
+This file is part of py-sonic.
+
+py-sonic is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+py-sonic is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with py-sonic.  If not, see <http://www.gnu.org/licenses/>
+
+Client side rate limiting for libsonic.connection.Connection.
+
+    conn = Connection(url, user, passwd, rateLimit=20)
+
+caps the requests sent to the server at 20 per second.  Responses from
+the cache and calls coalesced with identical ones in flight don't count.
+The requests waiting for the limiter are let through by lane priority
+(see libsonic.overload.LANES): an interactive request goes ahead of all
+the waiting background and bulk requests, so bulk work never adds to
+the latency of the user facing calls.
+"""
+
+from libsonic.overload import LANES, checkLane
+
+import asyncio
+import threading
+import time
+
+
+class RateLimiter(object):
+    def __init__(self, rate, burst=None):
+        """
+        A thread safe token bucket serving its waiters by lane priority,
+        and in order within a lane
+
+        rate:float      The max number of requests per second
+        burst:int       The max number of requests which can be made at
+                        once after a quiet period.  Defaults to one
+                        second worth of requests
+        """
+        self.rate = float(rate)
+        self.burst = max(1.0, float(burst if burst is not None else rate))
+        self._tokens = self.burst
+        self._last = time.monotonic()
+        self._queues = {lane: [] for lane in LANES}
+        self._cond = threading.Condition()
+
+    def stats(self):
+        """
+        Returns a dict like the following:
+
+        {'rate': 20.0, 'tokens': 3.5,
+         'waiting': {'interactive': 0, 'background': 0, 'bulk': 12}}
+        """
+        with self._cond:
+            self._refill()
+            return {'rate': self.rate, 'tokens': self._tokens,
+                'waiting': {lane: len(q) for lane, q in self._queues.items()}}
+
+    def acquire(self, lane='interactive'):
+        """
+        Waits for a token, behind the waiters of the same or a higher
+        priority lane, and takes it
+        """
+        waiter = self._enqueue(lane)
+        with self._cond:
+            try:
+                while True:
+                    wait = self._poll(waiter, lane)
+                    if wait == 0:
+                        return
+                    self._cond.wait(wait)
+            finally:
+                self._dequeue(waiter, lane)
+
+    async def acquireAsync(self, lane='interactive'):
+        """
+        Like acquire(), without blocking the event loop
+        """
+        waiter = self._enqueue(lane)
+        try:
+            while True:
+                with self._cond:
+                    wait = self._poll(waiter, lane)
+                if wait == 0:
+                    return
+                # A waiter ahead of this one isn't a token away, check
+                # again shortly
+                await asyncio.sleep(wait if wait is not None else 0.01)
+        finally:
+            with self._cond:
+                self._dequeue(waiter, lane)
+
+    def _enqueue(self, lane):
+        waiter = object()
+        with self._cond:
+            self._queues[checkLane(lane)].append(waiter)
+        return waiter
+
+    def _dequeue(self, waiter, lane):
+        queue = self._queues[lane]
+        if waiter in queue:
+            queue.remove(waiter)
+        self._cond.notify_all()
+
+    def _poll(self, waiter, lane):
+        """
+        Takes a token for the waiter if it is its turn and returns 0.
+        Otherwise returns the number of seconds until the next token if
+        the waiter is next in line, or None if it is behind others
+        """
+        self._refill()
+        for queue in self._queues.values():
+            if queue:
+                if queue[0] is not waiter:
+                    return None
+                break
+        if self._tokens >= 1:
+            self._tokens -= 1
+            self._queues[lane].pop(0)
+            return 0
+        return (1 - self._tokens) / self.rate
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.burst,
+            self._tokens + (now - self._last) * self.rate)
+        self._last = now
@@ -0,0 +1,217 @@
+"""
+This file is part of py-sonic.
+
+py-sonic is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+py-sonic is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with py-sonic.  If not, see <http://www.gnu.org/licenses/>
+
+Automatic retries of failed requests for libsonic.connection.Connection.
+
+Connection retries requests which failed on a transient error (a
+connection reset or refused, a timeout, a 502/503/504, etc.) with a
+RetryPolicy by default.  Only the idempotent views are retried, unless
+others are opted in:
+
+    policy = RetryPolicy(retries=5, retryViews=('scrobble',))
+    conn = Connection(url, user, passwd, retryPolicy=policy)
+
+Retries are spread out with exponential backoff and jitter, and are
+limited by a retry budget, so a server which is down doesn't get
+several times its normal load from the clients retrying.
+"""
+
+from urllib.error import HTTPError, URLError
+from http import client as http_client
+
+import asyncio
+import logging
+import random
+import ssl
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# The errors a request is retried on
+RETRY_ERRORS = (OSError, http_client.HTTPException)
+
+# The HTTP errors which are worth retrying, everything else is final
+RETRY_HTTP_CODES = (408, 429, 500, 502, 503, 504)
+
+# The views retried by default, besides the get* and search* views
+IDEMPOTENT_VIEWS = ('ping', 'stream', 'download', 'hls')
+
+
+def isTransient(e):
+    """
+    Returns True if the exception raised by a request is a transient
+    failure (a network error, an overloaded server, etc.) as opposed to
+    an error the same request would get again
+    """
+    if isinstance(e, HTTPError):
+        return e.code in RETRY_HTTP_CODES
+    if isinstance(e, URLError) and \
+            isinstance(e.reason, ssl.SSLCertVerificationError):
+        return False
+    return isinstance(e, RETRY_ERRORS)
+
+
+class RetryPolicy(object):
+    def __init__(self, retries=3, backoff=0.25, maxBackoff=10.0,
+            jitter=True, budget=20, budgetRatio=0.1, retryViews=()):
+        """
+        retries:int         The max number of times a request is retried
+        backoff:float       The delay before the first retry, in seconds.
+                            It doubles on each retry
+        maxBackoff:float    The max delay before a retry, in seconds.
+                            This also caps the delays asked for by the
+                            server with a Retry-After header
+        jitter:bool         If True, each delay is a random duration
+                            between 0 and the backoff delay ("full
+                            jitter"), so the clients which failed at the
+                            same time don't all retry at the same time
+        budget:float        The max number of retries which can be made
+                            in a row.  The budget is refilled by
+                            budgetRatio for every request made, so once
+                            it is spent, at most budgetRatio retries are
+                            made per request
+        budgetRatio:float   See budget
+        retryViews:list     The names of the non idempotent views to
+                            retry as well, ex: ('scrobble',
+                            'createPlaylist').  Note that such a call
+                            may be applied twice if the server got it
+                            but the response was lost
+        """
+        self.retries = int(retries)
+        self.backoff = backoff
+        self.maxBackoff = maxBackoff
+        self.jitter = jitter
+        self.budget = budget
+        self.budgetRatio = budgetRatio
+        self.retryViews = frozenset(retryViews)
+        self._balance = float(budget)
+        self._lock = threading.Lock()
+        self._counts = {'requests': 0, 'retries': 0, 'budgetExhausted': 0}
+
+    def stats(self):
+        """
+        Returns a dict of counters like the following:
+
+        {'requests': 1024, 'retries': 3, 'budgetExhausted': 0,
+         'budget': 20.0}
+        """
+        with self._lock:
+            ret = dict(self._counts)
+            ret['budget'] = self._balance
+        return ret
+
+    def appliesTo(self, viewName):
+        """
+        Returns True if calls to the view are retried
+        """
+        if viewName is None:
+            return False
+        return viewName.startswith(('get', 'search')) or \
+            viewName in IDEMPOTENT_VIEWS or viewName in self.retryViews
+
+    def isRetryable(self, e):
+        """
+        Returns True if the exception is a transient failure
+        """
+        return isTransient(e)
+
+    def getDelay(self, attempt, e=None):
+        """
+        Returns the number of seconds to wait before the given retry
+        (starting at 0) of a request which failed with e
+        """
+        delay = min(self.maxBackoff, self.backoff * 2 ** attempt)
+        if self.jitter:
+            delay = random.uniform(0, delay)
+        retryAfter = self._getRetryAfter(e)
+        if retryAfter is not None:
+            delay = max(delay, min(self.maxBackoff, retryAfter))
+        return delay
+
+    def call(self, func, viewName=None):
+        """
+        Calls func() and returns its result, retrying on the transient
+        failures
+
+        func:callable       Makes the request
+        viewName:str        The view name, for the logs
+        """
+        self._deposit()
+        attempt = 0
+        while True:
+            try:
+                return func()
+            except Exception as e:
+                delay = self._getRetryDelay(attempt, e, viewName)
+                if delay is None:
+                    raise
+            time.sleep(delay)
+            attempt += 1
+
+    async def callAsync(self, func, viewName=None):
+        """
+        Like call(), for a coroutine function
+        """
+        self._deposit()
+        attempt = 0
+        while True:
+            try:
+                return await func()
+            except Exception as e:
+                delay = self._getRetryDelay(attempt, e, viewName)
+                if delay is None:
+                    raise
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    def _getRetryDelay(self, attempt, e, viewName):
+        """
+        Returns the delay before retrying after the failure e, or None if
+        the request isn't to be retried
+        """
+        if attempt >= self.retries or not self.isRetryable(e) or \
+                not self._withdraw():
+            return None
+        delay = self.getDelay(attempt, e)
+        if isinstance(e, HTTPError):
+            e.close()
+        logger.debug('Retrying %s in %.2fs after: %s', viewName, delay, e)
+        return delay
+
+    def _getRetryAfter(self, e):
+        if not isinstance(e, HTTPError) or e.headers is None:
+            return None
+        try:
+            return float(e.headers.get('Retry-After'))
+        except (TypeError, ValueError):
+            # Missing, or an HTTP date, which is rare enough to ignore
+            return None
+
+    def _deposit(self):
+        with self._lock:
+            self._counts['requests'] += 1
+            self._balance = min(float(self.budget),
+                self._balance + self.budgetRatio)
+
+    def _withdraw(self):
+        with self._lock:
+            if self._balance < 1:
+                self._counts['budgetExhausted'] += 1
+                return False
+            self._balance -= 1
+            self._counts['retries'] += 1
+            return True
@@ -0,0 +1,220 @@
+"""
+This file is part of py-sonic.
+
+py-sonic is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+py-sonic is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with py-sonic.  If not, see <http://www.gnu.org/licenses/>
+
+Random access to remote files.  See the "seekable" option of
+Connection.download() and Connection.stream():
+
+    fh = conn.download(songId, seekable=True)
+    fh.seek(-128, os.SEEK_END)
+    tag = fh.read(128)
+
+Only the blocks which are read are fetched, with HTTP Range requests.
+"""
+
+from collections import OrderedDict
+from urllib.error import HTTPError
+
+import io
+import shutil
+import tempfile
+
+# Files of servers which ignore Range requests are spooled to disk past
+# this size
+SPOOL_SIZE = 8 * 1024 * 1024
+
+
+class SeekableRemoteFile(io.RawIOBase):
+    def __init__(self, conn, viewName, query, blockSize=64 * 1024,
+            maxBlocks=64, maxReadahead=1024 * 1024):
+        """
+        A read-only, seekable file object for a remote file.  Reads are
+        served from an LRU cache of fixed size blocks, and the missing
+        blocks are fetched with Range requests.  Sequential reads fetch
+        increasingly more blocks ahead, up to maxReadahead bytes.
+
+        The first block is fetched on creation, which also gives the
+        file size.  If the server doesn't support Range requests (ex: for
+        transcoded streams), the whole file is read into a temp file
+        instead.
+
+        This is not thread safe, use a file per thread.
+
+        conn:Connection     The connection to use
+        viewName:str        The binary view, ex: "download.view"
+        query:dict          The query for the view
+        blockSize:int       The block size, in bytes
+        maxBlocks:int       The max number of blocks cached
+        maxReadahead:int    The max number of bytes fetched ahead on
+                            sequential reads
+        """
+        super().__init__()
+        self.conn = conn
+        self.viewName = viewName
+        self.query = query
+        self.blockSize = int(blockSize)
+        self.maxBlocks = max(2, int(maxBlocks))
+        self.maxReadahead = max(self.blockSize, int(maxReadahead))
+        self.requests = 0
+        self.bytesFetched = 0
+        self._blocks = OrderedDict()
+        self._pos = 0
+        self._nextSeq = 0
+        self._readahead = self.blockSize
+        self._spool = None
+
+        try:
+            res, contRange = self._open(0, self.blockSize - 1)
+        except HTTPError as e:
+            if e.code != 416:
+                raise
+            # An empty file
+            e.close()
+            self.headers = e.headers
+            self.size = 0
+            return
+        if contRange is not None and contRange[2] is None:
+            # The size is unknown ("bytes 0-N/*"), only the first block
+            # was sent: get the whole file without a Range header
+            res.close()
+            res, contRange = self._open(None, None)
+        self.headers = res.info()
+        if contRange is None or contRange[2] is None:
+            self._spool = tempfile.SpooledTemporaryFile(SPOOL_SIZE)
+            with res:
+                shutil.copyfileobj(res, self._spool)
+            self.size = self._spool.tell()
+            self.bytesFetched = self.size
+            self._spool.seek(0)
+            return
+        self.size = contRange[2]
+        self._store(0, res, contRange[1] + 1)
+
+    def info(self):
+        """
+        Returns the headers of the first response, like the response
+        objects returned by download() and stream()
+        """
+        return self.headers
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        self._checkClosed()
+        return self._pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        self._checkClosed()
+        if whence == io.SEEK_SET:
+            pos = offset
+        elif whence == io.SEEK_CUR:
+            pos = self._pos + offset
+        elif whence == io.SEEK_END:
+            pos = self.size + offset
+        else:
+            raise ValueError('Invalid whence: %r' % whence)
+        if pos < 0:
+            raise ValueError('Negative seek position %d' % pos)
+        self._pos = pos
+        return pos
+
+    def readinto(self, b):
+        self._checkClosed()
+        view = memoryview(b).cast('B')
+        if self._spool is not None:
+            self._spool.seek(self._pos)
+            n = self._spool.readinto(view)
+            self._pos += n
+            return n
+
+        if self._pos != self._nextSeq:
+            self._readahead = self.blockSize
+        n = 0
+        while n < len(view) and self._pos < self.size:
+            idx, off = divmod(self._pos, self.blockSize)
+            block = self._getBlock(idx, off + len(view) - n)
+            chunk = block[off:off + len(view) - n]
+            view[n:n + len(chunk)] = chunk
+            n += len(chunk)
+            self._pos += len(chunk)
+        self._nextSeq = self._pos
+        return n
+
+    def readall(self):
+        self._checkClosed()
+        return self.read(max(0, self.size - self._pos))
+
+    def close(self):
+        if self._spool is not None:
+            self._spool.close()
+        self._blocks.clear()
+        super().close()
+
+    def _getBlock(self, idx, wanted):
+        """
+        Returns the block at index idx, fetching it if needed, along
+        with the missing blocks following it which cover the wanted
+        number of bytes plus the readahead
+        """
+        block = self._blocks.get(idx)
+        if block is not None:
+            self._blocks.move_to_end(idx)
+            return block
+
+        wanted += self._readahead
+        self._readahead = min(self._readahead * 2, self.maxReadahead)
+        lastIdx = min(idx + -(-wanted // self.blockSize),
+            idx + self.maxBlocks // 2, -(-self.size // self.blockSize)) - 1
+        # Only fetch the run of missing blocks
+        for i in range(idx + 1, lastIdx + 1):
+            if i in self._blocks:
+                lastIdx = i - 1
+                break
+        first = idx * self.blockSize
+        last = min((lastIdx + 1) * self.blockSize, self.size) - 1
+        res, contRange = self._open(first, last)
+        if contRange is None:
+            res.close()
+            raise IOError('The server stopped honoring Range requests')
+        self._store(idx, res, contRange[1] + 1)
+        return self._blocks[idx]
+
+    def _open(self, first, last):
+        self.requests += 1
+        return self.conn._openRange(self.viewName, self.query, first, last)
+
+    def _store(self, idx, res, end):
+        """
+        Reads the response, starting at block idx, into the cache
+        """
+        with res:
+            pos = idx * self.blockSize
+            while pos < end:
+                size = min(self.blockSize, end - pos)
+                block = res.read(size)
+                if len(block) != size:
+                    raise IOError('Got %d bytes of block %d, expected %d' % (
+                        len(block), idx, size))
+                self.bytesFetched += size
+                self._blocks[idx] = block
+                self._blocks.move_to_end(idx)
+                idx += 1
+                pos += size
+        while len(self._blocks) > self.maxBlocks:
+            self._blocks.popitem(last=False)
@@ -0,0 +1,89 @@
+"""
+This file is part of py-sonic.
+
+py-sonic is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+py-sonic is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with py-sonic.  If not, see <http://www.gnu.org/licenses/>
+
+Coalescing of concurrent identical requests.
+
+When several threads make the same read request at the same time (ex:
+hundreds of getAlbum() calls for an album which just got popular), only
+the first one goes to the server.  The others wait for it and get a copy
+of its response.  Connection does this by default for the read views,
+see the "coalesce" argument of Connection.
+"""
+
+import threading
+
+
+class _Call(object):
+    __slots__ = ('done', 'result', 'error')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight(object):
+    def __init__(self):
+        """
+        Runs at most one call per key at a time, sharing its outcome with
+        the callers asking for the same key while it runs
+        """
+        self._calls = {}
+        self._lock = threading.Lock()
+        # The number of calls made and of callers who got the outcome of
+        # another caller's call
+        self.calls = 0
+        self.shared = 0
+
+    def do(self, key, func):
+        """
+        Calls func() and returns its result, unless a call for key is
+        already running, in which case this waits for that call and
+        returns its result (or raises its exception) instead.  The
+        result is shared, so it should be immutable
+
+        key:hashable        The key identifying the call
+        func:callable       The function to call
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+                self.calls += 1
+            else:
+                self.shared += 1
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+        try:
+            call.result = func()
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result
+
+    def inflight(self):
+        """
+        Returns the number of calls running
+        """
+        return len(self._calls)
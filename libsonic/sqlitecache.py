@@ -0,0 +1,463 @@
+"""
+This file is part of py-sonic.
+
+py-sonic is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+py-sonic is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with py-sonic.  If not, see <http://www.gnu.org/licenses/>
+
+A persistent, SQLite backed cache for libsonic.connection.Connection.
+
+SQLiteCache has the same interface as libsonic.cache.ResponseCache, so
+it is used the same way:
+
+    conn = Connection('https://music.example.com', 'user', 'pass',
+        cache=SQLiteCache('/var/cache/myapp/subsonic.db'))
+
+The cached responses survive restarts, so a new process starts warm.
+The artists, albums and songs found in the responses the connection
+receives are also stored as entities which can be looked up directly,
+see getAlbum(), iterSongs() etc.  This is independent of the TTLs: the
+songs of a getRandomSongs or search3 response are stored even though the
+response itself isn't cached.
+
+Expired getIndexes responses are kept and lazily revalidated with the
+"ifModifiedSince" parameter when they are next requested, so an
+unchanged library costs a single, tiny request.
+"""
+
+from libsonic.cache import DEFAULT_TTLS, ID_VIEWS, INVALIDATES, \
+    getChangedIds, idMarkers
+from email.parser import Parser
+from http import client as http_client
+
+import json
+import sqlite3
+import threading
+import time
+
+# The views whose expired responses are kept around for revalidation
+REVALIDATE_VIEWS = ('getIndexes',)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS responses (
+    username TEXT NOT NULL,
+    view TEXT NOT NULL,
+    query TEXT NOT NULL,
+    headers TEXT NOT NULL,
+    body BLOB NOT NULL,
+    fetched REAL NOT NULL,
+    expires REAL NOT NULL,
+    PRIMARY KEY (username, view, query)
+);
+CREATE TABLE IF NOT EXISTS artists (
+    id TEXT PRIMARY KEY,
+    name TEXT,
+    data TEXT NOT NULL,
+    updated REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS albums (
+    id TEXT PRIMARY KEY,
+    artistId TEXT,
+    name TEXT,
+    data TEXT NOT NULL,
+    updated REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS albums_artistId ON albums (artistId);
+CREATE TABLE IF NOT EXISTS songs (
+    id TEXT PRIMARY KEY,
+    albumId TEXT,
+    artistId TEXT,
+    title TEXT,
+    data TEXT NOT NULL,
+    updated REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS songs_albumId ON songs (albumId);
+"""
+
+# The entity kinds and the columns (besides id) pulled out of each entity
+ENTITY_COLUMNS = {
+    'artist': ('name',),
+    'album': ('artistId', 'name'),
+    'song': ('albumId', 'artistId', 'title'),
+}
+
+
+def _asList(value):
+    """
+    Subsonic returns a dict instead of a list for single items in some
+    versions.  This always returns a list
+    """
+    if value is None:
+        return []
+    if isinstance(value, dict):
+        return [value]
+    return value
+
+
+def _extractEntities(viewName, res):
+    """
+    Returns a list of (kind, entity) tuples found in the given parsed
+    "subsonic-response" of the view
+    """
+    ents = []
+    if viewName == 'getArtists':
+        for index in _asList(res.get('artists', {}).get('index')):
+            ents.extend(('artist', a) for a in _asList(index.get('artist')))
+    elif viewName == 'getArtist':
+        artist = dict(res.get('artist', {}))
+        albums = _asList(artist.pop('album', None))
+        ents.append(('artist', artist))
+        ents.extend(('album', a) for a in albums)
+    elif viewName == 'getAlbum':
+        album = dict(res.get('album', {}))
+        songs = _asList(album.pop('song', None))
+        ents.append(('album', album))
+        ents.extend(('song', s) for s in songs)
+    elif viewName == 'getSong':
+        ents.append(('song', res.get('song', {})))
+    elif viewName == 'getAlbumList2':
+        ents.extend(('album', a) for a in
+            _asList(res.get('albumList2', {}).get('album')))
+    elif viewName in ('search3', 'getStarred2'):
+        key = 'searchResult3' if viewName == 'search3' else 'starred2'
+        result = res.get(key, {})
+        for kind in ('artist', 'album', 'song'):
+            ents.extend((kind, e) for e in _asList(result.get(kind)))
+    elif viewName in ('getSongsByGenre', 'getRandomSongs', 'getTopSongs'):
+        key = {'getSongsByGenre': 'songsByGenre',
+            'getRandomSongs': 'randomSongs',
+            'getTopSongs': 'topSongs'}[viewName]
+        ents.extend(('song', s) for s in
+            _asList(res.get(key, {}).get('song')))
+    elif viewName == 'getPlaylist':
+        ents.extend(('song', s) for s in
+            _asList(res.get('playlist', {}).get('entry')))
+    return [(kind, e) for kind, e in ents if e.get('id') is not None]
+
+
+class SQLiteCache(object):
+    def __init__(self, path, ttls=None, maxEntries=None):
+        """
+        A persistent response and entity cache stored in an SQLite
+        database.  This is thread safe and several processes can share
+        the same database file.
+
+        path:str            The path to the database file.  It is created
+                            if it doesn't exist
+        ttls:dict           A mapping of view name to the number of
+                            seconds to cache its responses.  This is
+                            merged into libsonic.cache.DEFAULT_TTLS
+        maxEntries:int      If set, the oldest responses are dropped to
+                            keep at most this many cached
+        """
+        self.path = path
+        self.maxEntries = maxEntries
+        self.ttls = dict(DEFAULT_TTLS)
+        if ttls:
+            self.ttls.update(ttls)
+        self._generations = {}
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.executescript(_SCHEMA)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def getTtl(self, viewName):
+        """
+        Returns the number of seconds to cache responses for the given
+        view, or None if it shouldn't be cached
+        """
+        return self.ttls.get(viewName) or None
+
+    def getGeneration(self, viewName):
+        """
+        See ResponseCache.getGeneration()
+        """
+        with self._lock:
+            return self._generations.get(viewName, 0)
+
+    def get(self, key):
+        """
+        Returns a (headers, body) tuple for the key or None on a miss
+
+        key:tuple       A (username, viewName, query) tuple
+        """
+        row = self._getRow(key)
+        with self._lock:
+            if row is not None and row[3] > time.time():
+                self.hits += 1
+                return self._parseHeaders(row[0]), row[1]
+            self.misses += 1
+        return None
+
+    def getStale(self, key):
+        """
+        Returns a (headers, body, fetched) tuple for the key, even if the
+        entry has expired, or None if there is no entry or the view is
+        not one of the REVALIDATE_VIEWS.  It doesn't count as a hit or
+        miss
+        """
+        if key[1] not in REVALIDATE_VIEWS:
+            return None
+        row = self._getRow(key)
+        if row is None:
+            return None
+        return self._parseHeaders(row[0]), row[1], row[2]
+
+    def touch(self, key):
+        """
+        Marks the entry as freshly fetched, after it has been
+        revalidated with the server
+        """
+        ttl = self.getTtl(key[1])
+        if ttl is None:
+            return
+        now = time.time()
+        with self._lock, self._db:
+            self._db.execute('UPDATE responses SET fetched = ?, '
+                'expires = ? WHERE username = ? AND view = ? AND query = ?',
+                (now, now + ttl) + self._dbKey(key))
+
+    def set(self, key, headers, body, generation=None):
+        """
+        Caches a response.  See ResponseCache.set()
+        """
+        viewName = key[1]
+        ttl = self.getTtl(viewName)
+        if ttl is None:
+            return
+        now = time.time()
+        with self._lock:
+            if generation is not None and \
+                    generation != self._generations.get(viewName, 0):
+                return
+            with self._db:
+                self._db.execute('INSERT OR REPLACE INTO responses '
+                    '(username, view, query, headers, body, fetched, '
+                    'expires) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                    self._dbKey(key) + (headers.as_string(), body, now,
+                        now + ttl))
+                if self.maxEntries is not None:
+                    cur = self._db.execute('DELETE FROM responses WHERE '
+                        'rowid NOT IN (SELECT rowid FROM responses ORDER BY '
+                        'fetched DESC LIMIT ?)', (self.maxEntries,))
+                    self.evictions += cur.rowcount
+
+    def storeEntities(self, viewName, res):
+        """
+        Stores the artists, albums and songs found in a successful
+        response.  The connection calls this with every response it
+        decodes, so the entities are stored even for views whose
+        responses aren't cached
+
+        viewName:str        The name of the view, ex: "getAlbum"
+        res:dict            The decoded "subsonic-response"
+        """
+        ents = _extractEntities(viewName, res)
+        if not ents:
+            return
+        with self._lock:
+            with self._db:
+                self._putEntities(ents, time.time())
+
+    def invalidate(self, viewNames=None, ids=None):
+        """
+        Drops all the cached responses for the given views, or all of
+        them if viewNames is None.  Entities are not dropped.  See
+        ResponseCache.invalidate() for ids
+        """
+        markers = idMarkers(ids) if ids else None
+        with self._lock, self._db:
+            if viewNames is None:
+                viewNames = set(self._generations) | set(self.ttls)
+                self._db.execute('DELETE FROM responses')
+            else:
+                viewNames = set(viewNames)
+                for v in viewNames:
+                    if markers and v in ID_VIEWS:
+                        self._db.executemany('DELETE FROM responses WHERE '
+                            'view = ? AND instr(body, ?) > 0',
+                            [(v, m) for m in markers])
+                    else:
+                        self._db.execute('DELETE FROM responses WHERE '
+                            'view = ?', (v,))
+            for viewName in viewNames:
+                self._generations[viewName] = \
+                    self._generations.get(viewName, 0) + 1
+
+    def invalidateFor(self, viewName, query=()):
+        """
+        Invalidates the responses made stale by a call to the given
+        (mutating) view.  See ResponseCache.invalidateFor()
+        """
+        if viewName not in INVALIDATES:
+            return
+        self.invalidate(INVALIDATES[viewName], getChangedIds(query))
+
+    def clear(self):
+        """
+        Drops all the cached responses and entities and resets the
+        counters
+        """
+        self.invalidate()
+        with self._lock:
+            with self._db:
+                for kind in ENTITY_COLUMNS:
+                    self._db.execute('DELETE FROM %ss' % kind)
+            self.hits = self.misses = self.evictions = 0
+
+    def stats(self):
+        """
+        Returns a dict of the cache counters, like ResponseCache.stats(),
+        plus the number of stored entities of each kind
+        """
+        with self._lock:
+            entries, size = self._db.execute('SELECT COUNT(*), '
+                'COALESCE(SUM(LENGTH(body)), 0) FROM responses').fetchone()
+            ret = {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'entries': entries,
+                'bytes': size,
+            }
+            for kind in ENTITY_COLUMNS:
+                ret['%ss' % kind] = self._db.execute(
+                    'SELECT COUNT(*) FROM %ss' % kind).fetchone()[0]
+        return ret
+
+    # Entity access
+    def getArtist(self, aid):
+        """
+        Returns the stored artist dict for the ID3 artist id, or None
+        """
+        return self._getEntity('artist', aid)
+
+    def getAlbum(self, aid):
+        """
+        Returns the stored album dict (without its songs), or None
+        """
+        return self._getEntity('album', aid)
+
+    def getSong(self, sid):
+        """
+        Returns the stored song dict, or None
+        """
+        return self._getEntity('song', sid)
+
+    def iterArtists(self):
+        """
+        Yields all the stored artist dicts
+        """
+        return self._iterEntities('artist')
+
+    def iterAlbums(self, artistId=None):
+        """
+        Yields the stored album dicts, optionally only for one artist
+        """
+        return self._iterEntities('album', 'artistId', artistId)
+
+    def iterSongs(self, albumId=None):
+        """
+        Yields the stored song dicts, optionally only for one album
+        """
+        return self._iterEntities('song', 'albumId', albumId)
+
+    def getEntityUpdated(self, kind, eid):
+        """
+        Returns the unix timestamp the entity was last stored at, or None
+        if it isn't stored
+
+        kind:str        One of "artist", "album" or "song"
+        eid:str         The entity id
+        """
+        with self._lock:
+            row = self._db.execute('SELECT updated FROM %ss WHERE id = ?' %
+                kind, (str(eid),)).fetchone()
+        return row[0] if row else None
+
+    def putEntities(self, kind, entities):
+        """
+        Stores (or replaces) the given entities
+
+        kind:str            One of "artist", "album" or "song"
+        entities:list       A list of entity dicts, each with an "id"
+        """
+        with self._lock:
+            with self._db:
+                self._putEntities([(kind, e) for e in entities],
+                    time.time())
+
+    def deleteEntities(self, kind, ids):
+        """
+        Removes the entities with the given ids
+
+        kind:str            One of "artist", "album" or "song"
+        ids:list            A list of entity ids
+        """
+        with self._lock:
+            with self._db:
+                self._db.executemany('DELETE FROM %ss WHERE id = ?' % kind,
+                    [(str(i),) for i in ids])
+
+    def _putEntities(self, ents, now):
+        for kind, ent in ents:
+            cols = ENTITY_COLUMNS[kind]
+            self._db.execute('INSERT OR REPLACE INTO %ss (id, %s, data, '
+                'updated) VALUES (?, %s, ?, ?)' % (kind, ', '.join(cols),
+                    ', '.join('?' * len(cols))),
+                (str(ent['id']),) + tuple(ent.get(c) for c in cols) +
+                    (json.dumps(ent), now))
+
+    def _getEntity(self, kind, eid):
+        with self._lock:
+            row = self._db.execute('SELECT data FROM %ss WHERE id = ?' %
+                kind, (str(eid),)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def _iterEntities(self, kind, column=None, value=None, batchSize=500):
+        # This pages through the table by rowid so the lock isn't held
+        # while the caller consumes the results
+        sql = 'SELECT rowid, data FROM %ss WHERE rowid > ?' % kind
+        args = ()
+        if value is not None:
+            sql += ' AND %s = ?' % column
+            args = (str(value),)
+        sql += ' ORDER BY rowid LIMIT %d' % batchSize
+        last = -1
+        while True:
+            with self._lock:
+                rows = self._db.execute(sql, (last,) + args).fetchall()
+            for row in rows:
+                yield json.loads(row[1])
+            if len(rows) < batchSize:
+                return
+            last = rows[-1][0]
+
+    def _getRow(self, key):
+        with self._lock:
+            return self._db.execute('SELECT headers, body, fetched, expires '
+                'FROM responses WHERE username = ? AND view = ? AND '
+                'query = ?', self._dbKey(key)).fetchone()
+
+    def _dbKey(self, key):
+        username, viewName, query = key
+        return (username or '', viewName, json.dumps(query))
+
+    def _parseHeaders(self, headers):
+        return Parser(_class=http_client.HTTPMessage).parsestr(headers)
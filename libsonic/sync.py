@@ -0,0 +1,275 @@
+"""
+This file is part of py-sonic.
+
+py-sonic is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+py-sonic is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with py-sonic.  If not, see <http://www.gnu.org/licenses/>
+
+Incremental library sync.
+
+LibrarySync keeps a local store of artists, albums and songs up to date
+and yields the changes it makes as Delta tuples:
+
+    store = SQLiteCache('/var/lib/myapp/library.db')
+    syncer = LibrarySync(conn, store)
+    for delta in syncer.sync(token):
+        print(delta.action, delta.kind, delta.id)
+    token = syncer.token
+
+The first sync (token is None) crawls the whole library.  Later syncs
+only fetch what changed since the token: getIndexes with
+ifModifiedSince tells whether anything was rescanned.  If it was, the
+whole album list is walked and the albums differing from the stored
+copies (name, song count, duration, created or changed time) are
+re-fetched, and the artists whose album counts changed are re-listed.
+Past the 5000 albums the album list can be paged through, every artist
+is re-listed instead.  The "newest" album list is then paged until it
+reaches albums older than the token.  An unchanged library costs two
+requests.
+
+The store can be a libsonic.sqlitecache.SQLiteCache or any object with
+its entity methods: getArtist(), getAlbum(), getSong(), iterArtists(),
+iterAlbums(), iterSongs(), putEntities() and deleteEntities().  It must
+not be the cache of conn: the entities of the responses cached by conn
+would be stored before the sync could diff them, and their deltas lost.
+The sync requests bypass conn's cache (see Connection.bypassCache()), so
+they never see stale responses.
+"""
+
+from libsonic.crawler import LibraryCrawler
+from libsonic.errors import ArgumentError
+from libsonic.paging import MAX_LIST_OFFSET, MAX_PAGE_SIZE, asList
+from collections import namedtuple
+
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+ADDED = 'added'
+CHANGED = 'changed'
+REMOVED = 'removed'
+
+Delta = namedtuple('Delta', ('action', 'kind', 'id', 'record'))
+
+# An album (or artist) listing differing from the stored copy in any of
+# these fields is re-fetched in full
+ALBUM_KEYS = ('name', 'songCount', 'duration', 'created', 'changed')
+ARTIST_KEYS = ('name', 'albumCount')
+
+
+def _differs(listed, stored, keys):
+    return any(listed.get(k) != stored.get(k) for k in keys)
+
+
+class LibrarySync(object):
+    def __init__(self, conn, store, musicFolderId=None, maxWorkers=8,
+            pageSize=50):
+        """
+        conn:Connection         The connection to sync from
+        store:SQLiteCache       The local store to sync into
+        musicFolderId:int       Only sync the given music folder
+        maxWorkers:int          The max number of requests in flight
+        pageSize:int            The page size used when paging the
+                                "newest" album list
+        """
+        if store is getattr(conn, 'cache', None):
+            raise ArgumentError('The sync store must not be the cache of '
+                'the connection')
+        self.conn = conn
+        self.store = store
+        self.musicFolderId = musicFolderId
+        self.maxWorkers = int(maxWorkers)
+        self.pageSize = int(pageSize)
+        self.token = None
+
+    def sync(self, token=None):
+        """
+        Syncs the store and yields a Delta for every added, changed or
+        removed artist, album and song.  Each delta has already been
+        applied to the store when it is yielded.
+
+        Once the generator is exhausted, the "token" attribute holds the
+        token to pass to the next sync.  It is a JSON serializable dict.
+
+        token:dict      The token from the previous sync, or None to
+                        sync everything
+        """
+        steps = self._sync(token)
+        while True:
+            # The bypass isn't left on for the caller between deltas
+            with self.conn.bypassCache():
+                try:
+                    delta = next(steps)
+                except StopIteration:
+                    return
+            yield delta
+
+    def _sync(self, token):
+        newToken = {'synced': time.time()}
+        res = self.conn.getIndexes(self.musicFolderId,
+            token['indexesModified'] if token else 0)
+        indexes = res.get('indexes', {})
+        newToken['indexesModified'] = indexes.get('lastModified',
+            token['indexesModified'] if token else 0)
+
+        if token is None:
+            # Anything created after this is picked up by the next sync
+            res = self.conn.getAlbumList2('newest', 1,
+                musicFolderId=self.musicFolderId)
+            for album in asList(res.get('albumList2', {}).get('album')):
+                newToken['newestCreated'] = album.get('created')
+            for delta in self._fullSync():
+                yield delta
+        else:
+            newToken['newestCreated'] = token.get('newestCreated')
+            albumIds = set()
+            if any(k in indexes for k in ('index', 'shortcut', 'child')):
+                # Something was rescanned, check the albums and artists
+                complete = self._diffAlbumList(albumIds)
+                for delta in self._syncArtists(albumIds,
+                        relistAll=not complete):
+                    yield delta
+            for delta in self._syncAlbums(albumIds, newToken):
+                yield delta
+        self.token = newToken
+
+    def _fullSync(self):
+        seen = {'artist': set(), 'album': set(), 'song': set()}
+        crawler = LibraryCrawler(self.conn, maxWorkers=self.maxWorkers,
+            musicFolderId=self.musicFolderId)
+        for kind, record in crawler.crawl():
+            seen[kind].add(str(record['id']))
+            for delta in self._upsert(kind, record):
+                yield delta
+        for kind, iterFunc in (('song', self.store.iterSongs),
+                ('album', self.store.iterAlbums),
+                ('artist', self.store.iterArtists)):
+            gone = [e for e in iterFunc() if str(e['id']) not in seen[kind]]
+            for delta in self._remove(kind, gone):
+                yield delta
+
+    def _diffAlbumList(self, albumIds):
+        """
+        Walks the whole album list and adds the ids of the albums which
+        are new or differ from the store to albumIds.  Returns False if
+        the list was too long to be walked to the end
+        """
+        n = 0
+        for album in self.conn.iterAlbumList2('alphabeticalByName',
+                pageSize=MAX_PAGE_SIZE, prefetch=0,
+                musicFolderId=self.musicFolderId):
+            n += 1
+            stored = self.store.getAlbum(album['id'])
+            if stored is None or _differs(album, stored, ALBUM_KEYS):
+                albumIds.add(str(album['id']))
+        return n < MAX_LIST_OFFSET + MAX_PAGE_SIZE
+
+    def _syncArtists(self, albumIds, relistAll=False):
+        """
+        Diffs the artist list against the store.  New and changed
+        artists, or all of them if relistAll is True, are re-listed and
+        the ids of their new or changed albums are added to albumIds
+        """
+        res = self.conn.getArtists(self.musicFolderId)
+        current = {}
+        for index in asList(res.get('artists', {}).get('index')):
+            for artist in asList(index.get('artist')):
+                current[str(artist['id'])] = artist
+        stored = {str(a['id']): a for a in self.store.iterArtists()}
+
+        for aid in set(stored) - set(current):
+            for delta in self._removeArtist(stored[aid]):
+                yield delta
+
+        toList = [aid for aid, artist in current.items()
+            if relistAll or aid not in stored or
+                _differs(artist, stored[aid], ARTIST_KEYS)]
+        for res in self.conn.map('getArtist', toList, self.maxWorkers):
+            artist = dict(res.get('artist', {}))
+            albums = {str(a['id']): a for a in
+                asList(artist.pop('album', None))}
+            for delta in self._upsert('artist', artist):
+                yield delta
+            storedAlbums = {str(a['id']): a for a in
+                self.store.iterAlbums(artist['id'])}
+            gone = [storedAlbums[i] for i in set(storedAlbums) - set(albums)]
+            for album in gone:
+                for delta in self._removeAlbum(album):
+                    yield delta
+            for alid, album in albums.items():
+                if alid not in storedAlbums or \
+                        _differs(album, storedAlbums[alid], ALBUM_KEYS):
+                    albumIds.add(alid)
+
+    def _syncAlbums(self, albumIds, token):
+        """
+        Fetches the given albums plus any albums newer than the token
+        and diffs their songs against the store.  The token's
+        newestCreated is moved forward
+        """
+        newest = token['newestCreated']
+        albums = self.conn.iterAlbumList2('newest', pageSize=self.pageSize,
+            prefetch=0, musicFolderId=self.musicFolderId)
+        for i, album in enumerate(albums):
+            created = album.get('created', '')
+            if i == 0:
+                token['newestCreated'] = created
+            if newest is not None and created <= newest:
+                break
+            stored = self.store.getAlbum(album['id'])
+            if stored is None or _differs(album, stored, ALBUM_KEYS):
+                albumIds.add(str(album['id']))
+
+        for res in self.conn.map('getAlbum', sorted(albumIds),
+                self.maxWorkers):
+            album = dict(res.get('album', {}))
+            songs = {str(s['id']): s for s in asList(album.pop('song', None))}
+            for delta in self._upsert('album', album):
+                yield delta
+            storedSongs = {str(s['id']): s for s in
+                self.store.iterSongs(album['id'])}
+            gone = [storedSongs[i] for i in set(storedSongs) - set(songs)]
+            for delta in self._remove('song', gone):
+                yield delta
+            for song in songs.values():
+                for delta in self._upsert('song', song):
+                    yield delta
+
+    def _upsert(self, kind, record):
+        stored = getattr(self.store, 'get%s' % kind.title())(record['id'])
+        if stored == record:
+            return
+        self.store.putEntities(kind, [record])
+        yield Delta(ADDED if stored is None else CHANGED, kind,
+            record['id'], record)
+
+    def _remove(self, kind, records):
+        if not records:
+            return
+        self.store.deleteEntities(kind, [r['id'] for r in records])
+        for record in records:
+            yield Delta(REMOVED, kind, record['id'], record)
+
+    def _removeAlbum(self, album):
+        for delta in self._remove('song', list(
+                self.store.iterSongs(album['id']))):
+            yield delta
+        for delta in self._remove('album', [album]):
+            yield delta
+
+    def _removeArtist(self, artist):
+        for album in list(self.store.iterAlbums(artist['id'])):
+            for delta in self._removeAlbum(album):
+                yield delta
+        for delta in self._remove('artist', [artist]):
+            yield delta
@@ -0,0 +1,174 @@
+"""
+This file is part of py-sonic.
+
+py-sonic is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+py-sonic is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with py-sonic.  If not, see <http://www.gnu.org/licenses/>
+
+Request tracing for libsonic.connection.Connection.
+
+With tracing on, every call produces a Span breaking its time down into
+phases, which is handed to a sink once the call completed.  The default
+sink keeps the last spans in memory, so slow calls can be looked into
+after the fact:
+
+    conn = Connection(url, user, passwd, tracing=True)
+    ...
+    for span in conn.traceSink.slowest(5):
+        print(span.view, span.durations())
+
+The phases, in order:
+
+    build       Building the request (url, query and auth token)
+    queue       Waiting for the rate and concurrency limiters
+    dns         Resolving the server's host name
+    connect     Opening the socket
+    tls         The TLS handshake
+    send        Sending the request
+    ttfb        Waiting for the response headers
+    body        Reading the response body
+    decode      Decoding the JSON
+    postprocess Converting the timestamps of the response
+
+The dns, connect and tls phases only occur when a new socket is opened,
+span.reused tells whether a pooled one was used instead.  The socket
+phases are recorded by the keep-alive pool, so with keepAlive=False, and
+with AsyncConnection, the time to the response headers is a single ttfb
+phase.  A phase occurs more than once when the call was retried.
+"""
+
+from collections import deque
+from contextlib import contextmanager, nullcontext
+
+import threading
+import time
+
+_NULL_PHASE = nullcontext()
+
+
+class Span(object):
+    __slots__ = ('view', 'lane', 'started', 'phases', 'reused', 'record',
+        'duration', '_start')
+
+    def __init__(self, view, lane=None, start=None):
+        """
+        The trace of a call
+
+        view:str        The view name
+        lane:str        The lane the call was made in
+        start:float     The time.perf_counter() time the call started at
+        """
+        self.view = view
+        self.lane = lane
+        self._start = time.perf_counter() if start is None else start
+        # The wall clock time the call started at
+        self.started = time.time() - (time.perf_counter() - self._start)
+        # (name, offset from the start, duration) tuples, in seconds
+        self.phases = []
+        # Whether a pooled socket was used, None if unknown
+        self.reused = None
+        # The libsonic.metrics.RequestRecord of the call, for its status,
+        # error and sizes
+        self.record = None
+        self.duration = None
+
+    def add(self, name, start, end):
+        """
+        Adds a phase from its time.perf_counter() start and end times
+        """
+        self.phases.append((name, start - self._start, end - start))
+
+    @contextmanager
+    def phase(self, name):
+        """
+        Adds a phase timing the block
+        """
+        start = time.perf_counter()
+        try:
+            yield self
+        finally:
+            self.add(name, start, time.perf_counter())
+
+    def finish(self, record=None):
+        self.duration = time.perf_counter() - self._start
+        self.record = record
+
+    def durations(self):
+        """
+        Returns a dict of the phase names to their total durations, plus
+        "other" for the time outside of the phases (ex: retry delays)
+        """
+        ret = {}
+        for name, offset, duration in self.phases:
+            ret[name] = ret.get(name, 0.0) + duration
+        if self.duration is not None:
+            ret['other'] = max(0.0, self.duration - sum(ret.values()))
+        return ret
+
+    def toDict(self):
+        ret = self.record.toDict() if self.record is not None else {}
+        ret.update({
+            'view': self.view,
+            'lane': self.lane,
+            'started': self.started,
+            'duration': self.duration,
+            'reused': self.reused,
+            'phases': list(self.phases),
+        })
+        return ret
+
+
+def tracePhase(span, name):
+    """
+    Returns a context manager timing the block as a phase of span, or
+    doing nothing if span is None
+    """
+    if span is None:
+        return _NULL_PHASE
+    return span.phase(name)
+
+
+class RingBufferSink(object):
+    def __init__(self, size=1000):
+        """
+        A thread safe trace sink keeping the last spans
+
+        size:int        The max number of spans kept
+        """
+        self._spans = deque(maxlen=int(size))
+        self._lock = threading.Lock()
+
+    def __call__(self, span):
+        with self._lock:
+            self._spans.append(span)
+
+    def spans(self, view=None):
+        """
+        Returns the spans kept, oldest first, optionally only those of
+        the given view
+        """
+        with self._lock:
+            spans = list(self._spans)
+        if view is not None:
+            spans = [s for s in spans if s.view == view]
+        return spans
+
+    def slowest(self, n=10, view=None):
+        """
+        Returns the n longest spans kept, longest first
+        """
+        return sorted(self.spans(view), key=lambda s: s.duration or 0,
+            reverse=True)[:n]
+
+    def clear(self):
+        with self._lock:
+            self._spans.clear()
@@ -37,7 +37,7 @@ setup(name='py-sonic',
     packages=['libsonic'],
     package_dir={'libsonic': 'libsonic'},
     install_requires=requirements,
-    python_requires='>=3',
+    python_requires='>=3.9',
     classifiers=[
         'Development Status :: 4 - Beta',
         'Intended Audience :: System Administrators',
@@ -46,6 +46,12 @@ setup(name='py-sonic',
         'Natural Language :: English',
         'Operating System :: POSIX',
         'Programming Language :: Python',
+        'Programming Language :: Python :: 3',
+        'Programming Language :: Python :: 3 :: Only',
+        'Programming Language :: Python :: 3.9',
+        'Programming Language :: Python :: 3.10',
+        'Programming Language :: Python :: 3.11',
+        'Programming Language :: Python :: 3.12',
         'Topic :: System :: Systems Administration',
         'Topic :: Internet :: WWW/HTTP',
         'Topic :: Software Development :: Libraries :: Python Modules',
@@ -0,0 +1,147 @@
+"""
+This file is part of py-sonic.
+
+py-sonic is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+py-sonic is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with py-sonic.  If not, see <http://www.gnu.org/licenses/>
+
+A scripted, threaded HTTP/1.1 keep-alive server for the tests of the
+synchronous Connection.  The responses come from a script function
+called with the view name and the query, which returns a
+(status, body) or a (status, headers, body) tuple:
+
+    def script(view, query):
+        if view == 'getAlbum':
+            return 200, jsonBody(album={'id': query['id']})
+        return 404, b'Not found'
+
+    server = ScriptedServer(script)
+    conn = Connection('http://127.0.0.1', 'user', 'pass', port=server.port)
+"""
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+import json
+import socket
+import threading
+
+
+def jsonBody(**kw):
+    """
+    Returns the body of an "ok" JSON response with the given fields.  Pass
+    status='failed' and error={...} for a failed one
+    """
+    res = {'status': 'ok', 'version': '1.16.1'}
+    res.update(kw)
+    return json.dumps({'subsonic-response': res}).encode('utf-8')
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        super().setup()
+        self.handled = 0
+        owner = self.server.owner
+        with owner.lock:
+            owner.connections += 1
+            owner.sockets.append(self.connection)
+
+    def do_GET(self):
+        self._handle()
+
+    def do_POST(self):
+        self._handle()
+
+    def log_message(self, format, *args):
+        pass
+
+    def _handle(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        data = self.rfile.read(length) if length else b''
+        parts = urlsplit(self.path)
+        query = {k: v[0] for k, v in parse_qs(parts.query or
+            data.decode('latin-1')).items()}
+        view = parts.path.rsplit('/', 1)[-1][:-len('.view')]
+        self.handled += 1
+        server = self.server.owner
+        with server.lock:
+            server.requests.append((view, query))
+        if server.dropReused and self.handled > 1:
+            # Like a server which closed the idle connection just as the
+            # request was sent
+            self.close_connection = True
+            return
+
+        ret = server.script(view, query)
+        if len(ret) == 2:
+            status, body = ret
+            headers = [('Content-Type', 'application/json' if status < 400
+                else 'text/plain')]
+        else:
+            status, headers, body = ret
+        self.send_response(status)
+        for name, value in headers:
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class ScriptedServer(object):
+    def __init__(self, script):
+        """
+        Starts serving on a free port of 127.0.0.1, on a background
+        thread
+
+        script:callable     Called with (view, query) for every request,
+                            from the thread serving it
+        """
+        self.script = script
+        self.connections = 0
+        self.requests = []
+        self.sockets = []
+        self.dropReused = False
+        self.lock = threading.Lock()
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), _Handler)
+        self._server.daemon_threads = True
+        self._server.owner = self
+        self.port = self._server.server_address[1]
+        self._thread = threading.Thread(target=self._server.serve_forever,
+            args=(0.01,), daemon=True)
+        self._thread.start()
+
+    def views(self):
+        """
+        Returns the list of the views requested so far, in order
+        """
+        with self.lock:
+            return [view for view, _ in self.requests]
+
+    def closeConnections(self):
+        """
+        Closes all the open connections from the server side, like a
+        server whose keep-alive timeout expired
+        """
+        with self.lock:
+            socks, self.sockets[:] = list(self.sockets), []
+        for sock in socks:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def stop(self):
+        self.closeConnections()
+        self._server.shutdown()
+        self._server.server_close()
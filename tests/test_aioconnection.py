@@ -0,0 +1,348 @@
+"""
+This file is part of py-sonic.
+
+py-sonic is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+py-sonic is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with py-sonic.  If not, see <http://www.gnu.org/licenses/>
+
+Tests for libsonic.aioconnection, against a scripted HTTP/1.1 server.
+"""
+
+from libsonic.aioconnection import AsyncConnection
+from libsonic.errors import ArgumentError, AuthError, \
+    DataNotFoundError
+from urllib.error import HTTPError
+from urllib.parse import parse_qs, urlsplit
+
+import asyncio
+import gc
+import json
+import os
+import tempfile
+import unittest
+
+BLOB = bytes(range(256)) * 300
+
+
+def _json(**kw):
+    res = {'status': 'ok', 'version': '1.16.1'}
+    res.update(kw)
+    return json.dumps({'subsonic-response': res}).encode('utf-8')
+
+
+def _response(status, headers, body=b''):
+    head = ['HTTP/1.1 %d %s' % (status, 'OK' if status < 400 else 'Error')]
+    head.extend('%s: %s' % h for h in headers)
+    return ('\r\n'.join(head) + '\r\n\r\n').encode('latin-1') + body
+
+
+def _chunked(body, size=1000):
+    out = b''
+    for i in range(0, len(body), size):
+        chunk = body[i:i + size]
+        out += b'%x;ext=1\r\n%s\r\n' % (len(chunk), chunk)
+    return out + b'0\r\nX-Trailer: 1\r\n\r\n'
+
+
+class _Server(object):
+    """
+    Answers the requests by view name and "id" parameter
+    """
+    def __init__(self):
+        self.connections = 0
+        self.requests = 0
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle, '127.0.0.1',
+            0)
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        self.server.close()
+        await self.server.wait_closed()
+
+    async def handle(self, reader, writer):
+        self.connections += 1
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    return
+                method, target, _ = line.decode('latin-1').split(' ', 2)
+                length = 0
+                self.range = None
+                while True:
+                    hline = await reader.readline()
+                    if hline in (b'\r\n', b''):
+                        break
+                    name, value = hline.decode('latin-1').split(':', 1)
+                    if name.lower() == 'content-length':
+                        length = int(value)
+                    elif name.lower() == 'range':
+                        self.range = value.strip()
+                body = await reader.readexactly(length) if length else b''
+                self.requests += 1
+                parts = urlsplit(target)
+                query = parse_qs(parts.query or body.decode('latin-1'))
+                view = parts.path.rsplit('/', 1)[-1][:-len('.view')]
+                close = await self.respond(writer, view,
+                    query.get('id', [''])[0])
+                await writer.drain()
+                if close:
+                    return
+        finally:
+            writer.close()
+
+    async def respond(self, writer, view, id):
+        if view == 'getAlbum':
+            if id == 'missing':
+                body = _json(status='failed', error={'code': 70,
+                    'message': 'Album not found'})
+            else:
+                body = _json(album={'id': id, 'name': 'Album %s' % id,
+                    'created': 1303318347000})
+            writer.write(_response(200, [('Content-Type',
+                'application/json'), ('Content-Length', len(body))], body))
+        elif view == 'getIndexes':
+            body = _json(indexes={'index': [{'name': c, 'artist': [
+                {'id': '%s%d' % (c, i), 'name': 'Artist %s%d' % (c, i)}
+                for i in range(500)]} for c in 'ABC'],
+                'child': {'id': 'song', 'created': 1303318347000}})
+            writer.write(_response(200, [('Content-Type',
+                'application/json'), ('Transfer-Encoding', 'chunked')],
+                _chunked(body)))
+        elif view == 'getStarred2':
+            body = _json(status='failed', error={'code': 50,
+                'message': 'Not authorized'})
+            writer.write(_response(200, [('Content-Type',
+                'application/json'), ('Content-Length', len(body))], body))
+        elif view == 'getAlbumList2':
+            body = _json(albumList2={'album': [{'id': str(i)}
+                for i in range(3)]})
+            writer.write(_response(200, [('Content-Type',
+                'application/json'), ('Content-Length', len(body))], body))
+        elif id in ('length', 'broken') and self.range:
+            first, last = self.range[len('bytes='):].split('-')
+            first = int(first)
+            last = int(last) if last else len(BLOB) - 1
+            if first >= len(BLOB):
+                writer.write(_response(416, [('Content-Length', 0)]))
+            elif id == 'broken' and first:
+                # Only the first range can be fetched
+                writer.write(_response(503, [('Content-Length', 0)]))
+            else:
+                body = BLOB[first:last + 1]
+                writer.write(_response(206, [('Content-Type', 'audio/flac'),
+                    ('Content-Range', 'bytes %d-%d/%d' % (first, last,
+                    len(BLOB))), ('Content-Length', len(body))], body))
+        elif id == 'length':
+            writer.write(_response(200, [('Content-Type', 'audio/flac'),
+                ('Content-Length', len(BLOB))], BLOB))
+        elif id == 'chunked':
+            writer.write(_response(200, [('Content-Type', 'audio/flac'),
+                ('Transfer-Encoding', 'chunked')], _chunked(BLOB)))
+        elif id == 'eof':
+            # No length, the body ends when the connection is closed
+            writer.write(_response(200, [('Content-Type', 'audio/flac')],
+                BLOB))
+            return True
+        elif id == 'empty':
+            writer.write(_response(204, []))
+        else:
+            writer.write(_response(404, [('Content-Length', 9)],
+                b'Not found'))
+        return False
+
+
+class AsyncConnectionTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.server = _Server()
+        await self.server.start()
+        self.conn = AsyncConnection('http://127.0.0.1', 'user', 'pass',
+            port=self.server.port)
+
+    async def asyncTearDown(self):
+        await self.conn.close()
+        await self.server.stop()
+
+    async def test_info_call_is_replayed(self):
+        res = await self.conn.getAlbum('1')
+        self.assertEqual(res['album']['name'], 'Album 1')
+        self.assertEqual(res['album']['created'], 1303318347.0)
+
+    async def test_failed_status_raises(self):
+        with self.assertRaises(DataNotFoundError):
+            await self.conn.getAlbum('missing')
+
+    async def test_content_length_body(self):
+        res = await self.conn.download('length')
+        self.assertEqual(await res.read(), BLOB)
+        self.assertTrue(res.closed)
+        # The connection went back to the pool and is reused
+        res = await self.conn.download('length')
+        self.assertEqual(await res.read(), BLOB)
+        self.assertEqual(self.server.connections, 1)
+
+    async def test_chunked_body(self):
+        res = await self.conn.download('chunked')
+        chunks = [chunk async for chunk in res]
+        self.assertEqual(b''.join(chunks), BLOB)
+        await self.conn.getAlbum('1')
+        self.assertEqual(self.server.connections, 1)
+
+    async def test_body_read_to_eof(self):
+        res = await self.conn.download('eof')
+        self.assertEqual(await res.read(), BLOB)
+        await self.conn.getAlbum('1')
+        self.assertEqual(self.server.connections, 2)
+
+    async def test_empty_body(self):
+        res = await self.conn.download('empty')
+        self.assertEqual(res.status, 204)
+        self.assertEqual(await res.read(), b'')
+
+    async def test_dropped_response_releases_connection(self):
+        conn = AsyncConnection('http://127.0.0.1', 'user', 'pass',
+            port=self.server.port, maxConnections=1)
+        try:
+            res = await conn.download('length')
+            await res.read(10)
+            del res
+            gc.collect()
+            # This would wait forever if the slot wasn't released
+            res = await asyncio.wait_for(conn.download('length'), 5)
+            async with res:
+                self.assertEqual(await res.read(10), BLOB[:10])
+            self.assertTrue(res.closed)
+        finally:
+            await conn.close()
+
+    async def test_error_status_raises(self):
+        with self.assertRaises(HTTPError) as ctx:
+            await self.conn.download('nope')
+        self.assertEqual(ctx.exception.code, 404)
+        self.assertEqual(ctx.exception.read(), b'Not found')
+
+    async def test_connection_arguments(self):
+        conn = AsyncConnection('http://127.0.0.1', 'user', 'pass',
+            port=self.server.port, retryPolicy=None, circuitBreaker=None,
+            jsonDecoder='json', tokenBatchSize=1, tokenReuseWindow=0)
+        try:
+            res = await conn.getAlbum('1')
+        finally:
+            await conn.close()
+        self.assertEqual(res['album']['id'], '1')
+        self.assertIsNone(conn._retryPolicy)
+
+    async def test_map(self):
+        ids = [str(i) for i in range(10)]
+        res = [r['album']['id'] async for r in self.conn.map('getAlbum',
+            ids, maxWorkers=3)]
+        self.assertEqual(res, ids)
+
+    async def test_map_raises_in_order(self):
+        res = []
+        with self.assertRaises(DataNotFoundError):
+            async for r in self.conn.map('getAlbum', ['1', 'missing', '2']):
+                res.append(r['album']['id'])
+        self.assertEqual(res, ['1'])
+
+    async def test_iter_album_list(self):
+        albums = [a['id'] async for a in self.conn.iterAlbumList2('newest',
+            pageSize=10)]
+        self.assertEqual(albums, ['0', '1', '2'])
+
+    async def test_streamed_iter(self):
+        items = [(kind, item) async for kind, item in
+            self.conn.getIndexesIter()]
+        self.assertEqual(len(items), 1501)
+        self.assertEqual(items[0], ('artist', {'id': 'A0',
+            'name': 'Artist A0'}))
+        self.assertEqual(items[-1][0], 'child')
+        self.assertEqual(items[-1][1]['created'], 1303318347.0)
+        # The connection went back to the pool
+        await self.conn.getAlbum('1')
+        self.assertEqual(self.server.connections, 1)
+
+    async def test_streamed_iter_failed_status(self):
+        with self.assertRaises(AuthError):
+            async for item in self.conn.getStarred2Iter():
+                pass
+
+    async def test_download_to(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'song.flac')
+            stats = await self.conn.downloadTo('length', path)
+            self.assertEqual(stats['bytes'], len(BLOB))
+            with open(path, 'rb') as fh:
+                self.assertEqual(fh.read(), BLOB)
+
+            # Resumed from where the file stops
+            with open(path, 'r+b') as fh:
+                fh.truncate(1000)
+            stats = await self.conn.downloadTo('length', path)
+            self.assertEqual((stats['offset'], stats['bytes']),
+                (1000, len(BLOB) - 1000))
+            with open(path, 'rb') as fh:
+                self.assertEqual(fh.read(), BLOB)
+
+            # Already complete
+            stats = await self.conn.downloadTo('length', path)
+            self.assertEqual((stats['offset'], stats['bytes']),
+                (len(BLOB), 0))
+
+    async def test_stream_to_without_ranges(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'song.flac')
+            with open(path, 'wb') as fh:
+                fh.write(b'junk')
+            stats = await self.conn.streamTo('chunked', path)
+            self.assertEqual(stats['offset'], 0)
+            with open(path, 'rb') as fh:
+                self.assertEqual(fh.read(), BLOB)
+
+    async def test_seekable_rejected(self):
+        with self.assertRaises(ArgumentError):
+            await self.conn.download('length', seekable=True)
+        self.assertEqual(self.server.requests, 0)
+
+    async def test_download_segmented(self):
+        sizes = []
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'song.flac')
+            stats = await self.conn.downloadSegmented('length', path,
+                minSegmentSize=10000, chunkSize=4096,
+                progress=lambda n, size: sizes.append(size))
+            self.assertEqual(stats['segments'], 4)
+            self.assertEqual(stats['bytes'], len(BLOB))
+            self.assertEqual(set(sizes), {len(BLOB)})
+            with open(path, 'rb') as fh:
+                self.assertEqual(fh.read(), BLOB)
+            self.assertEqual(os.listdir(tmp), ['song.flac'])
+
+    async def test_download_segmented_failure(self):
+        conn = AsyncConnection('http://127.0.0.1', 'user', 'pass',
+            port=self.server.port, retryPolicy=None)
+        try:
+            with tempfile.TemporaryDirectory() as tmp:
+                path = os.path.join(tmp, 'song.flac')
+                with self.assertRaises(HTTPError):
+                    await conn.downloadSegmented('broken', path,
+                        minSegmentSize=10000, retries=1)
+                # No file with holes is left behind
+                self.assertEqual(os.listdir(tmp), [])
+        finally:
+            await conn.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,105 @@
+"""
+This file is part of py-sonic.
+
+py-sonic is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+py-sonic is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with py-sonic.  If not, see <http://www.gnu.org/licenses/>
+
+Tests for the response cache of libsonic.cache, through a Connection
+talking to a scripted server.
+"""
+
+from libsonic.cache import ResponseCache
+from libsonic.connection import Connection
+from scriptedserver import ScriptedServer, jsonBody
+
+import unittest
+
+
+def _script(view, query):
+    if view == 'getAlbum':
+        aid = query['id']
+        return 200, jsonBody(album={'id': aid, 'song': [
+            {'id': 'song-%s-%d' % (aid, i)} for i in range(3)]})
+    if view == 'getArtists':
+        return 200, jsonBody(artists={'index': []})
+    return 200, jsonBody()
+
+
+class ResponseCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.server = ScriptedServer(_script)
+        self.cache = ResponseCache()
+        self.conn = Connection('http://127.0.0.1', 'user', 'pass',
+            port=self.server.port, cache=self.cache)
+
+    def tearDown(self):
+        self.conn.close()
+        self.server.stop()
+
+    def test_hit(self):
+        first = self.conn.getAlbum('1')
+        first['album']['name'] = 'Changed'
+        second = self.conn.getAlbum('1')
+        self.assertEqual(self.server.views(), ['getAlbum'])
+        # Every hit is decoded into a new result
+        self.assertNotIn('name', second['album'])
+        self.assertEqual(self.cache.stats()['hits'], 1)
+
+    def test_invalidation_by_id(self):
+        self.conn.getAlbum('1')
+        self.conn.getAlbum('2')
+        self.conn.getArtists()
+        self.conn.star(sids=['song-1-2'])
+        self.conn.getAlbum('1')
+        self.conn.getAlbum('2')
+        self.conn.getArtists()
+        # Only the album listing the starred song is fetched again, and
+        # the views which aren't about a single item are dropped whole
+        self.assertEqual(self.server.views(), ['getAlbum', 'getAlbum',
+            'getArtists', 'star', 'getAlbum', 'getArtists'])
+        self.assertEqual(self.server.requests[-2][1]['id'], '1')
+
+    def test_invalidation_without_ids(self):
+        self.conn.getAlbum('1')
+        self.conn.startScan()
+        self.conn.getAlbum('1')
+        self.assertEqual(self.server.views(), ['getAlbum', 'startScan',
+            'getAlbum'])
+
+    def test_stale_generation_not_stored(self):
+        key = ('user', 'getAlbum', (('id', '1'),))
+        generation = self.cache.getGeneration('getAlbum')
+        self.cache.invalidate(['getAlbum'], ['1'])
+        # A response fetched before the invalidation
+        self.cache.set(key, {}, b'{}', generation)
+        self.assertIsNone(self.cache.get(key))
+        self.cache.set(key, {}, b'{}', self.cache.getGeneration('getAlbum'))
+        self.assertIsNotNone(self.cache.get(key))
+
+    def test_lru_eviction(self):
+        cache = ResponseCache(maxEntries=2)
+        for i in range(3):
+            cache.set(('user', 'getAlbum', (('id', str(i)),)), {}, b'{}')
+        self.assertIsNone(cache.get(('user', 'getAlbum', (('id', '0'),))))
+        self.assertEqual(cache.stats()['evictions'], 1)
+        self.assertEqual(cache.stats()['entries'], 2)
+
+    def test_bypass(self):
+        self.conn.getAlbum('1')
+        with self.conn.bypassCache():
+            self.conn.getAlbum('1')
+        self.assertEqual(self.server.views(), ['getAlbum', 'getAlbum'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,94 @@
+"""
+This file is part of py-sonic.
+
+py-sonic is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+py-sonic is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with py-sonic.  If not, see <http://www.gnu.org/licenses/>
+
+Tests for the JSON decoders and the timestamp normalizer of
+libsonic.decoders.
+"""
+
+from libsonic.connection import Connection
+from libsonic.decoders import JSONDecoder, getDecoder, normalizeTimestamps
+from scriptedserver import ScriptedServer, jsonBody
+
+import json
+import unittest
+
+
+class NormalizeTimestampsTest(unittest.TestCase):
+    def test_nested(self):
+        data = {'indexes': {'lastModified': 1303318347000, 'index': [
+            {'artist': [{'id': '1', 'starred': 1303318347500}]}],
+            'child': [{'id': '2', 'created': 0, 'played': -1000}]}}
+        normalizeTimestamps(data)
+        self.assertEqual(data['indexes']['lastModified'], 1303318347.0)
+        self.assertEqual(data['indexes']['index'][0]['artist'][0]['starred'],
+            1303318347.5)
+        self.assertEqual(data['indexes']['child'][0]['created'], 0.0)
+        self.assertEqual(data['indexes']['child'][0]['played'], -1.0)
+
+    def test_other_values_untouched(self):
+        data = {'album': {'id': 5, 'duration': 1303318347000,
+            'created': '2011-04-20T16:52:27.000Z', 'starred': None,
+            'lastModified': True, 'song': [1, 'a', None]}}
+        expected = json.loads(json.dumps(data))
+        self.assertIs(normalizeTimestamps(data), data)
+        self.assertEqual(data, expected)
+
+    def test_body_without_timestamps_skipped(self):
+        data = {'album': {'created': 1000}}
+        # The body says there is nothing to convert
+        normalizeTimestamps(data, b'{"album": {"created": "2011"}}')
+        self.assertEqual(data['album']['created'], 1000)
+        normalizeTimestamps(data, b'{"album": {"created" : 1000}}')
+        self.assertEqual(data['album']['created'], 1.0)
+
+
+class DecoderTest(unittest.TestCase):
+    def test_loads_response(self):
+        body = jsonBody(album={'id': '1', 'name': 'café'})
+        for skipWrapper in (True, False):
+            res = JSONDecoder(skipWrapper).loadsResponse(body)
+            self.assertEqual(res['album'], {'id': '1', 'name': 'café'})
+            self.assertEqual(res['status'], 'ok')
+
+    def test_unusual_layout(self):
+        body = b'{"subsonic-response": {"status": "ok"}, "extra": 1}'
+        self.assertEqual(JSONDecoder().loadsResponse(body),
+            {'status': 'ok'})
+
+    def test_get_decoder(self):
+        self.assertEqual(getDecoder('json').name, 'json')
+        decoder = JSONDecoder()
+        self.assertIs(getDecoder(decoder), decoder)
+        with self.assertRaises(ValueError):
+            getDecoder('nope')
+
+    def test_connection_normalizes(self):
+        server = ScriptedServer(lambda view, query: (200, jsonBody(
+            album={'id': '1', 'created': 1303318347000,
+            'song': [{'id': '2', 'starred': 1303318347000}]})))
+        try:
+            conn = Connection('http://127.0.0.1', 'user', 'pass',
+                port=server.port, jsonDecoder='json')
+            album = conn.getAlbum('1')['album']
+            conn.close()
+        finally:
+            server.stop()
+        self.assertEqual(album['created'], 1303318347.0)
+        self.assertEqual(album['song'][0]['starred'], 1303318347.0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,193 @@
+"""
+This file is part of py-sonic.
+
+py-sonic is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+py-sonic is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with py-sonic.  If not, see <http://www.gnu.org/licenses/>
+
+Tests for the circuit breakers and the adaptive concurrency limit of
+libsonic.overload.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+from libsonic.connection import Connection
+from libsonic.errors import ArgumentError, CircuitOpenError
+from libsonic.overload import CLOSED, HALF_OPEN, OPEN, AdaptiveLimiter, \
+    CircuitBreaker, getEndpointGroup
+from scriptedserver import ScriptedServer, jsonBody
+from urllib.error import HTTPError
+
+import threading
+import time
+import unittest
+
+
+class CircuitBreakerTest(unittest.TestCase):
+    def test_opens_on_failures(self):
+        breaker = CircuitBreaker('browse', minCalls=4, failureRate=0.5)
+        for failed in (False, True, False):
+            breaker.allow()
+            breaker.record(failed, 0.01)
+        self.assertEqual(breaker.state, CLOSED)
+        breaker.allow()
+        breaker.record(True, 0.01)
+        self.assertEqual(breaker.state, OPEN)
+        with self.assertRaises(CircuitOpenError) as ctx:
+            breaker.allow()
+        self.assertGreater(ctx.exception.retryAfter, 0)
+
+    def test_opens_on_slow_calls(self):
+        breaker = CircuitBreaker(minCalls=2, slowCallDuration=1.0,
+            slowCallRate=1.0)
+        for i in range(2):
+            breaker.allow()
+            breaker.record(False, 2.0)
+        self.assertEqual(breaker.state, OPEN)
+
+    def test_half_open(self):
+        breaker = CircuitBreaker(minCalls=1, openDuration=0.05,
+            halfOpenCalls=2)
+        breaker.allow()
+        breaker.record(True, 0.01)
+        time.sleep(0.1)
+        self.assertEqual(breaker.state, HALF_OPEN)
+        breaker.allow()
+        breaker.allow()
+        # Only halfOpenCalls trial calls are let through
+        with self.assertRaises(CircuitOpenError):
+            breaker.allow()
+        breaker.record(False, 0.01)
+        breaker.record(False, 0.01)
+        self.assertEqual(breaker.state, CLOSED)
+
+    def test_failed_trial_reopens(self):
+        breaker = CircuitBreaker(minCalls=1, openDuration=0.05)
+        breaker.allow()
+        breaker.record(True, 0.01)
+        time.sleep(0.1)
+        breaker.allow()
+        breaker.record(True, 0.01)
+        self.assertEqual(breaker.state, OPEN)
+
+    def test_endpoint_groups(self):
+        self.assertEqual([getEndpointGroup(v) for v in ('stream', 'search3',
+            'getAlbum', 'ping', 'star')],
+            ['media', 'search', 'browse', 'browse', 'write'])
+
+
+class AdaptiveLimiterTest(unittest.TestCase):
+    def test_limit(self):
+        limiter = AdaptiveLimiter(initial=2)
+        self.assertTrue(limiter.acquire())
+        self.assertTrue(limiter.acquire())
+        self.assertFalse(limiter.acquire(timeout=0))
+        limiter.release()
+        self.assertTrue(limiter.acquire(timeout=0))
+
+    def test_decrease_and_increase(self):
+        limiter = AdaptiveLimiter(initial=10, latencyTarget=0.5)
+        limiter.record(1.0, key='getAlbum')
+        self.assertEqual(limiter.limit, 9)
+        # At most one decrease per round trip
+        limiter.record(0.1, failed=True, key='getAlbum')
+        self.assertEqual(limiter.limit, 9)
+        for i in range(20):
+            limiter.record(0.1, key='getAlbum')
+        self.assertEqual(limiter.limit, 11)
+
+    def test_latency_baseline(self):
+        limiter = AdaptiveLimiter(initial=10, latencyFloor=0.01)
+        for i in range(5):
+            limiter.record(0.02, key='getAlbum')
+        limit = limiter.limit
+        # Slow for getAlbum, but not compared to the other views
+        limiter.record(0.2, key='search3')
+        self.assertEqual(limiter.limit, limit)
+        limiter.record(0.2, key='getAlbum')
+        self.assertLess(limiter.limit, limit)
+        self.assertEqual(limiter.stats()['baselines']['search3'], 0.2)
+
+
+class ConnectionOverloadTest(unittest.TestCase):
+    def setUp(self):
+        self.failing = False
+        self.release = threading.Event()
+        self.server = ScriptedServer(self._script)
+
+    def tearDown(self):
+        self.release.set()
+        self.server.stop()
+
+    def _script(self, view, query):
+        if self.failing:
+            return 503, b'Busy'
+        if query.get('id', '').startswith('slow'):
+            self.release.wait(5)
+        return 200, jsonBody(album={'id': query.get('id')})
+
+    def test_circuit_breaker(self):
+        conn = Connection('http://127.0.0.1', 'user', 'pass',
+            port=self.server.port, retryPolicy=None,
+            circuitBreaker={'minCalls': 2, 'openDuration': 0.1,
+            'halfOpenCalls': 1})
+        self.failing = True
+        for i in range(2):
+            with self.assertRaises(HTTPError):
+                conn.getAlbum('1')
+        with self.assertRaises(CircuitOpenError):
+            conn.getAlbum('1')
+        self.assertEqual(len(self.server.requests), 2)
+        # The other endpoint groups aren't affected
+        self.failing = False
+        conn.star(['1'])
+        self.assertEqual(conn.getCircuitBreakers()['browse'].state, OPEN)
+
+        time.sleep(0.15)
+        self.assertEqual(conn.getAlbum('1')['album']['id'], '1')
+        self.assertEqual(conn.getCircuitBreakers()['browse'].state, CLOSED)
+        conn.close()
+
+    def test_bulk_lane_limited(self):
+        limiter = AdaptiveLimiter(initial=1, maxLimit=1)
+        conn = Connection('http://127.0.0.1', 'user', 'pass',
+            port=self.server.port, concurrencyLimiter=limiter)
+
+        def bulk(aid):
+            with conn.lane('bulk'):
+                return conn.getAlbum(aid)['album']['id']
+
+        with ThreadPoolExecutor(2) as executor:
+            futures = [executor.submit(bulk, 'slow%d' % i) for i in range(2)]
+            while not self.server.requests:
+                time.sleep(0.01)
+            # The interactive calls go through while the slot is taken
+            self.assertEqual(conn.getAlbum('1')['album']['id'], '1')
+            time.sleep(0.05)
+            self.assertEqual(len(self.server.requests), 2)
+            self.assertEqual(self.server.requests[1][1]['id'], '1')
+            self.release.set()
+            self.assertEqual([f.result() for f in futures],
+                ['slow0', 'slow1'])
+        self.assertEqual(len(self.server.requests), 3)
+        self.assertEqual(limiter.stats()['inflight'], 0)
+        conn.close()
+
+    def test_invalid_lane(self):
+        conn = Connection('http://127.0.0.1', 'user', 'pass',
+            port=self.server.port)
+        with self.assertRaises(ArgumentError):
+            with conn.lane('urgent'):
+                pass
+
+
+if __name__ == '__main__':
+    unittest.main()
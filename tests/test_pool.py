@@ -0,0 +1,127 @@
+"""
+This file is part of py-sonic.
+
+py-sonic is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+py-sonic is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with py-sonic.  If not, see <http://www.gnu.org/licenses/>
+
+Tests for the keep-alive connection pool of libsonic.pool, through a
+Connection talking to a scripted server.
+"""
+
+from libsonic.connection import Connection
+from libsonic.pool import ConnectionPool
+from scriptedserver import ScriptedServer, jsonBody
+
+import time
+import unittest
+
+BLOB = bytes(range(256)) * 100
+
+
+def _script(view, query):
+    if view == 'download':
+        return 200, [('Content-Type', 'audio/flac')], BLOB
+    return 200, jsonBody(album={'id': query.get('id')})
+
+
+class _FakeSock(object):
+    pass
+
+
+class _FakeConn(object):
+    def __init__(self, host, **kw):
+        self.host = host
+        self.sock = _FakeSock()
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+        self.sock = None
+
+
+class ConnectionPoolTest(unittest.TestCase):
+    def setUp(self):
+        self.server = ScriptedServer(_script)
+        self.conn = Connection('http://127.0.0.1', 'user', 'pass',
+            port=self.server.port, retryPolicy=None)
+
+    def tearDown(self):
+        self.conn.close()
+        self.server.stop()
+
+    def test_connection_reused(self):
+        for i in range(5):
+            self.assertEqual(self.conn.getAlbum(str(i))['album']['id'],
+                str(i))
+        self.assertEqual(self.server.connections, 1)
+
+    def test_read_response_releases_connection(self):
+        res = self.conn.download('1')
+        self.assertEqual(res.read(), BLOB)
+        self.conn.getAlbum('1')
+        self.assertEqual(self.server.connections, 1)
+
+    def test_closed_unread_response_discards_connection(self):
+        res = self.conn.download('1')
+        res.read(10)
+        res.close()
+        # The rest of the body is still on the socket, so it can't be
+        # reused
+        self.conn.getAlbum('1')
+        self.assertEqual(self.server.connections, 2)
+
+    def test_idle_connection_closed_by_server(self):
+        self.conn.getAlbum('1')
+        self.server.closeConnections()
+        time.sleep(0.05)
+        # The closed connection is seen as unhealthy and replaced
+        self.assertEqual(self.conn.getAlbum('2')['album']['id'], '2')
+        self.assertEqual(self.server.connections, 2)
+
+    def test_stale_connection_reconnects(self):
+        self.conn.getAlbum('1')
+        # The next request on the pooled connection is dropped without a
+        # response: it is sent again once, on a fresh connection
+        self.server.dropReused = True
+        self.assertEqual(self.conn.getAlbum('2')['album']['id'], '2')
+        self.assertEqual(self.server.views(), ['getAlbum'] * 3)
+        self.assertEqual(self.server.connections, 2)
+
+    def test_without_keep_alive(self):
+        conn = Connection('http://127.0.0.1', 'user', 'pass',
+            port=self.server.port, keepAlive=False)
+        conn.getAlbum('1')
+        conn.getAlbum('2')
+        self.assertEqual(self.server.connections, 2)
+
+    def test_pool_size_and_idle_timeout(self):
+        key = ('http', 'example.com:80')
+        pool = ConnectionPool(maxSize=1, idleTimeout=60)
+        first, reused = pool.getConnection(key, _FakeConn)
+        self.assertFalse(reused)
+        second, _ = pool.getConnection(key, _FakeConn)
+        pool.releaseConnection(key, first)
+        # The pool is full
+        pool.releaseConnection(key, second)
+        self.assertTrue(second.closed)
+        pool.releaseConnection(key, _FakeConn(key[1]), reusable=False)
+
+        pool.idleTimeout = 0
+        conn, reused = pool.getConnection(key, _FakeConn)
+        self.assertFalse(reused)
+        self.assertTrue(first.closed)
+        self.assertIsNot(conn, first)
+
+
+if __name__ == '__main__':
+    unittest.main()
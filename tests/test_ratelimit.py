@@ -0,0 +1,125 @@
+"""
+This file is part of py-sonic.
+
+py-sonic is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+py-sonic is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with py-sonic.  If not, see <http://www.gnu.org/licenses/>
+
+Tests for the lane priority rate limiter of libsonic.ratelimit.
+"""
+
+from libsonic.connection import Connection
+from libsonic.errors import ArgumentError
+from libsonic.ratelimit import RateLimiter
+from scriptedserver import ScriptedServer, jsonBody
+
+import asyncio
+import threading
+import time
+import unittest
+
+
+class RateLimiterTest(unittest.TestCase):
+    def test_burst_then_rate(self):
+        limiter = RateLimiter(20, burst=3)
+        start = time.monotonic()
+        for i in range(3):
+            limiter.acquire()
+        self.assertLess(time.monotonic() - start, 0.05)
+        for i in range(2):
+            limiter.acquire()
+        # Two more tokens at 20 per second
+        self.assertGreaterEqual(time.monotonic() - start, 0.09)
+
+    def _waitQueued(self, limiter, lane, count=1):
+        while limiter.stats()['waiting'][lane] < count:
+            time.sleep(0.005)
+
+    def test_lane_priority(self):
+        limiter = RateLimiter(5, burst=1)
+        limiter.acquire()
+        order = []
+
+        def acquire(lane):
+            limiter.acquire(lane)
+            order.append(lane)
+
+        threads = []
+        for lane in ('bulk', 'background', 'interactive'):
+            thread = threading.Thread(target=acquire, args=(lane,))
+            thread.start()
+            threads.append(thread)
+            self._waitQueued(limiter, lane)
+        for thread in threads:
+            thread.join(5)
+        # Served by priority, not by arrival
+        self.assertEqual(order, ['interactive', 'background', 'bulk'])
+
+    def test_fifo_within_lane(self):
+        limiter = RateLimiter(20, burst=1)
+        limiter.acquire()
+        order = []
+
+        def acquire(i):
+            limiter.acquire('bulk')
+            order.append(i)
+
+        threads = []
+        for i in range(3):
+            thread = threading.Thread(target=acquire, args=(i,))
+            thread.start()
+            threads.append(thread)
+            self._waitQueued(limiter, 'bulk', i + 1)
+        for thread in threads:
+            thread.join(5)
+        self.assertEqual(order, [0, 1, 2])
+
+    def test_async_lane_priority(self):
+        limiter = RateLimiter(5, burst=1)
+        limiter.acquire()
+        order = []
+
+        async def acquire(lane):
+            await limiter.acquireAsync(lane)
+            order.append(lane)
+
+        async def main():
+            bulk = asyncio.ensure_future(acquire('bulk'))
+            while not limiter.stats()['waiting']['bulk']:
+                await asyncio.sleep(0.005)
+            await acquire('interactive')
+            await bulk
+
+        asyncio.run(main())
+        self.assertEqual(order, ['interactive', 'bulk'])
+
+    def test_invalid_lane(self):
+        with self.assertRaises(ArgumentError):
+            RateLimiter(1).acquire('urgent')
+
+    def test_connection_rate_limited(self):
+        server = ScriptedServer(lambda view, query: (200, jsonBody()))
+        try:
+            conn = Connection('http://127.0.0.1', 'user', 'pass',
+                port=server.port, rateLimit=RateLimiter(20, burst=1))
+            start = time.monotonic()
+            for i in range(3):
+                conn.getLicense()
+            conn.close()
+        finally:
+            server.stop()
+        self.assertGreaterEqual(time.monotonic() - start, 0.09)
+        self.assertEqual(len(server.requests), 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
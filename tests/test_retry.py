@@ -0,0 +1,126 @@
+"""
+This file is part of py-sonic.
+
+py-sonic is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+py-sonic is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with py-sonic.  If not, see <http://www.gnu.org/licenses/>
+
+Tests for the retries of libsonic.retry, through a Connection talking to
+a scripted server.
+"""
+
+from email.message import Message
+from libsonic.connection import Connection
+from libsonic.retry import RetryPolicy, isTransient
+from scriptedserver import ScriptedServer, jsonBody
+from urllib.error import HTTPError, URLError
+
+import ssl
+import unittest
+
+
+class RetryPolicyTest(unittest.TestCase):
+    def setUp(self):
+        self.failures = 0
+        self.server = ScriptedServer(self._script)
+
+    def tearDown(self):
+        self.server.stop()
+
+    def _script(self, view, query):
+        if self.failures > 0:
+            self.failures -= 1
+            return 503, b'Busy'
+        return 200, jsonBody()
+
+    def _connect(self, policy):
+        return Connection('http://127.0.0.1', 'user', 'pass',
+            port=self.server.port, retryPolicy=policy)
+
+    def test_transient_failures_retried(self):
+        policy = RetryPolicy(backoff=0)
+        conn = self._connect(policy)
+        self.failures = 2
+        self.assertEqual(conn.getLicense()['status'], 'ok')
+        self.assertEqual(self.server.views(), ['getLicense'] * 3)
+        stats = policy.stats()
+        self.assertEqual((stats['requests'], stats['retries']), (1, 2))
+        conn.close()
+
+    def test_retries_limited(self):
+        conn = self._connect(RetryPolicy(retries=2, backoff=0))
+        self.failures = 5
+        with self.assertRaises(HTTPError) as ctx:
+            conn.getLicense()
+        self.assertEqual(ctx.exception.code, 503)
+        self.assertEqual(len(self.server.requests), 3)
+        conn.close()
+
+    def test_non_idempotent_not_retried(self):
+        conn = self._connect(RetryPolicy(backoff=0))
+        self.failures = 1
+        with self.assertRaises(HTTPError):
+            conn.scrobble('1')
+        self.assertEqual(self.server.views(), ['scrobble'])
+        conn.close()
+
+        conn = self._connect(RetryPolicy(backoff=0,
+            retryViews=('scrobble',)))
+        self.failures = 1
+        conn.scrobble('1')
+        self.assertEqual(self.server.views(), ['scrobble'] * 3)
+        conn.close()
+
+    def test_budget(self):
+        policy = RetryPolicy(backoff=0, budget=2, budgetRatio=0.5)
+        conn = self._connect(policy)
+        self.failures = 2
+        conn.getLicense()
+        # The budget is spent, only half a retry was earned back
+        self.failures = 1
+        with self.assertRaises(HTTPError):
+            conn.getLicense()
+        stats = policy.stats()
+        self.assertEqual(stats['budgetExhausted'], 1)
+        self.assertEqual(stats['budget'], 0.5)
+        # A request later, there is a full retry again
+        self.failures = 1
+        conn.getLicense()
+        self.assertEqual(policy.stats()['retries'], 3)
+        conn.close()
+
+    def test_delays(self):
+        policy = RetryPolicy(backoff=1, maxBackoff=3, jitter=False)
+        self.assertEqual([policy.getDelay(i) for i in range(4)],
+            [1, 2, 3, 3])
+        headers = Message()
+        headers['Retry-After'] = '2.5'
+        e = HTTPError('http://x', 503, 'Busy', headers, None)
+        self.assertEqual(policy.getDelay(0, e), 2.5)
+        headers.replace_header('Retry-After', '60')
+        self.assertEqual(policy.getDelay(0, e), 3)
+        for i in range(10):
+            self.assertLessEqual(RetryPolicy(backoff=1).getDelay(2), 4)
+
+    def test_is_transient(self):
+        self.assertTrue(isTransient(ConnectionResetError()))
+        self.assertTrue(isTransient(HTTPError('http://x', 502, 'Bad', None,
+            None)))
+        self.assertFalse(isTransient(HTTPError('http://x', 404, 'Not found',
+            None, None)))
+        self.assertFalse(isTransient(URLError(
+            ssl.SSLCertVerificationError('bad cert'))))
+        self.assertFalse(isTransient(ValueError()))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,119 @@
+"""
+This file is part of py-sonic.
+
+py-sonic is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+py-sonic is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with py-sonic.  If not, see <http://www.gnu.org/licenses/>
+
+Tests for the coalescing of identical requests, libsonic.singleflight.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+from libsonic.connection import Connection
+from libsonic.singleflight import SingleFlight
+from scriptedserver import ScriptedServer, jsonBody
+
+import threading
+import time
+import unittest
+
+
+class SingleFlightTest(unittest.TestCase):
+    def test_shared_result(self):
+        flight = SingleFlight()
+        release = threading.Event()
+        calls = []
+
+        def func():
+            calls.append(1)
+            release.wait(5)
+            return 'result'
+
+        with ThreadPoolExecutor(5) as executor:
+            futures = [executor.submit(flight.do, 'key', func)
+                for i in range(5)]
+            while flight.shared < 4:
+                time.sleep(0.01)
+            release.set()
+            self.assertEqual([f.result() for f in futures], ['result'] * 5)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual((flight.calls, flight.shared), (1, 4))
+        self.assertEqual(flight.inflight(), 0)
+
+    def test_shared_error(self):
+        flight = SingleFlight()
+        release = threading.Event()
+
+        def func():
+            release.wait(5)
+            raise KeyError('boom')
+
+        with ThreadPoolExecutor(3) as executor:
+            futures = [executor.submit(flight.do, 'key', func)
+                for i in range(3)]
+            while flight.shared < 2:
+                time.sleep(0.01)
+            release.set()
+            for f in futures:
+                with self.assertRaises(KeyError):
+                    f.result()
+        # The next call is made anew
+        self.assertEqual(flight.do('key', lambda: 1), 1)
+        self.assertEqual(flight.calls, 2)
+
+
+class CoalescingTest(unittest.TestCase):
+    def setUp(self):
+        self.release = threading.Event()
+        self.server = ScriptedServer(self._script)
+
+    def tearDown(self):
+        self.release.set()
+        self.server.stop()
+
+    def _script(self, view, query):
+        if view == 'getAlbum':
+            self.release.wait(5)
+        return 200, jsonBody(album={'id': query.get('id')})
+
+    def _getAlbums(self, conn, ids):
+        with ThreadPoolExecutor(len(ids)) as executor:
+            futures = [executor.submit(conn.getAlbum, i) for i in ids]
+            while len(self.server.requests) < len(set(ids)):
+                time.sleep(0.01)
+            # Let the callers of the same album pile up behind the first
+            time.sleep(0.1)
+            self.release.set()
+            return [f.result() for f in futures]
+
+    def test_identical_calls_coalesced(self):
+        conn = Connection('http://127.0.0.1', 'user', 'pass',
+            port=self.server.port)
+        res = self._getAlbums(conn, ['1'] * 5 + ['2'])
+        self.assertEqual([r['album']['id'] for r in res], ['1'] * 5 + ['2'])
+        self.assertEqual(sorted(q['id'] for v, q in self.server.requests),
+            ['1', '2'])
+        # Each caller gets its own copy
+        res[0]['album']['name'] = 'Changed'
+        self.assertNotIn('name', res[1]['album'])
+        conn.close()
+
+    def test_coalescing_disabled(self):
+        conn = Connection('http://127.0.0.1', 'user', 'pass',
+            port=self.server.port, coalesce=False)
+        self._getAlbums(conn, ['1'] * 3)
+        self.assertEqual(self.server.views(), ['getAlbum'] * 3)
+        conn.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,141 @@
+"""
+This file is part of py-sonic.
+
+py-sonic is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+py-sonic is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with py-sonic.  If not, see <http://www.gnu.org/licenses/>
+
+Tests for libsonic.sqlitecache, through a Connection talking to a
+scripted server.
+"""
+
+from libsonic.connection import Connection
+from libsonic.errors import DataNotFoundError
+from libsonic.sqlitecache import SQLiteCache
+from scriptedserver import ScriptedServer, jsonBody
+
+import os
+import tempfile
+import time
+import unittest
+
+
+class _Library(object):
+    """
+    The scripted server's library, which the tests can change
+    """
+    def __init__(self):
+        self.lastModified = 1303318347000
+        self.artists = ['Artist A']
+
+    def __call__(self, view, query):
+        if view == 'getIndexes':
+            indexes = {'lastModified': self.lastModified}
+            if int(query.get('ifModifiedSince', 0)) < self.lastModified:
+                indexes['index'] = [{'name': 'A', 'artist': [
+                    {'id': str(i), 'name': name}
+                    for i, name in enumerate(self.artists)]}]
+            return 200, jsonBody(indexes=indexes)
+        if view == 'getAlbum':
+            if query['id'] == 'missing':
+                return 200, jsonBody(status='failed', error={'code': 70,
+                    'message': 'Album not found'})
+            return 200, jsonBody(album={'id': query['id'], 'artistId': 'ar',
+                'name': 'Album', 'song': [{'id': 's%d' % i, 'albumId':
+                query['id'], 'title': 'Song %d' % i} for i in range(2)]})
+        if view == 'getRandomSongs':
+            return 200, jsonBody(randomSongs={'song': [{'id': 'r%d' % i,
+                'title': 'Random %d' % i} for i in range(3)]})
+        return 404, b'Not found'
+
+
+class SQLiteCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.library = _Library()
+        self.server = ScriptedServer(self.library)
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, 'cache.db')
+        self.conn = self._connect()
+
+    def tearDown(self):
+        self.conn.close()
+        self.conn.cache.close()
+        self.server.stop()
+        self.tmp.cleanup()
+
+    def _connect(self):
+        return Connection('http://127.0.0.1', 'user', 'pass',
+            port=self.server.port, cache=SQLiteCache(self.path,
+            ttls={'getIndexes': 0.05}))
+
+    def _indexNames(self, res):
+        return [a['name'] for i in res['indexes']['index']
+            for a in i['artist']]
+
+    def test_revalidated_when_unchanged(self):
+        self.assertEqual(self._indexNames(self.conn.getIndexes()),
+            ['Artist A'])
+        time.sleep(0.1)
+        # The server answers with no indexes, the cached ones are used
+        self.assertEqual(self._indexNames(self.conn.getIndexes()),
+            ['Artist A'])
+        query = self.server.requests[-1][1]
+        self.assertEqual(query['ifModifiedSince'], '1303318347000')
+        # And they are fresh again
+        self.conn.getIndexes()
+        self.assertEqual(self.server.views(), ['getIndexes'] * 2)
+
+    def test_revalidated_when_modified(self):
+        self.conn.getIndexes()
+        self.library.artists.append('Artist B')
+        self.library.lastModified += 1000
+        time.sleep(0.1)
+        self.assertEqual(self._indexNames(self.conn.getIndexes()),
+            ['Artist A', 'Artist B'])
+        # The new indexes replaced the cached ones
+        self.assertEqual(self._indexNames(self.conn.getIndexes()),
+            ['Artist A', 'Artist B'])
+        self.assertEqual(self.server.views(), ['getIndexes'] * 2)
+
+    def test_persistent(self):
+        self.conn.getAlbum('1')
+        conn = self._connect()
+        try:
+            self.assertEqual(conn.getAlbum('1')['album']['id'], '1')
+        finally:
+            conn.cache.close()
+        self.assertEqual(self.server.views(), ['getAlbum'])
+
+    def test_entities(self):
+        self.conn.getAlbum('1')
+        cache = self.conn.cache
+        self.assertEqual(cache.getAlbum('1')['name'], 'Album')
+        self.assertNotIn('song', cache.getAlbum('1'))
+        self.assertEqual([s['id'] for s in cache.iterSongs('1')],
+            ['s0', 's1'])
+
+    def test_entities_of_uncached_views(self):
+        self.assertIsNone(self.conn.cache.getTtl('getRandomSongs'))
+        self.conn.getRandomSongs()
+        self.assertEqual(self.conn.cache.getSong('r1')['title'],
+            'Random 1')
+        self.assertEqual(self.conn.cache.stats()['entries'], 0)
+
+    def test_failed_response_not_stored(self):
+        with self.assertRaises(DataNotFoundError):
+            self.conn.getAlbum('missing')
+        stats = self.conn.cache.stats()
+        self.assertEqual((stats['entries'], stats['albums']), (0, 0))
+
+
+if __name__ == '__main__':
+    unittest.main()